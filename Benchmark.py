@@ -0,0 +1,299 @@
+# Micro benchmarks for the messaging pipeline
+# Run everything with "python Benchmark.py" or pick benchmarks by name, e.g. "python Benchmark.py wire"
+
+import ExternalIP
+import File
+import Protocol
+import Transport
+from MessageQueue import MessageQueue
+from Constants import SocketCommands
+
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from Crypto.Random import get_random_bytes
+
+# Message sizes in characters, from a short chat line up to a large paste
+MESSAGE_SIZES = (16, 256, 4096, 65536)
+
+# How long each measurement runs for in seconds
+MEASURE_TIME = 1.0
+
+
+def measure(func, duration=MEASURE_TIME):
+    # Call func repeatedly for roughly duration seconds and return calls per second
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < duration:
+        for _ in range(50):
+            func()
+        calls += 50
+        elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+
+def bench_wire():
+    # Compare the JSON+base64 envelope with the binary frame, both sealed and opened once per message
+    aes_key = get_random_bytes(32)
+
+    print("%-8s %-7s %12s %10s %12s" % ('size', 'wire', 'wire bytes', 'overhead', 'msgs/s'))
+    for size in MESSAGE_SIZES:
+        text = 'a' * size
+
+        for name, wire in (('json', Protocol.JSON_WIRE), ('binary', Protocol.BINARY_WIRE)):
+            wire_bytes = len(Protocol.frame(Protocol.seal(aes_key, text, SocketCommands.DISPLAY, wire)))
+            rate = measure(lambda: Protocol.unseal(aes_key, Protocol.seal(aes_key, text, SocketCommands.DISPLAY, wire)))
+
+            print("%-8d %-7s %12d %9.1f%% %12.0f" % (size, name, wire_bytes, (wire_bytes - size) * 100 / size, rate))
+
+
+def bench_cipher():
+    # Per message cost of sealing and opening: the original JSON envelope, EAX per message, then the session AEADs
+    aes_key = get_random_bytes(32)
+    modes = (('json eax', Protocol.JSON_WIRE), ('binary eax', Protocol.BINARY_WIRE),
+             ('aes-gcm', Protocol.GCM_WIRE), ('chacha20', Protocol.CHACHA_WIRE))
+
+    print("%-8s %-11s %12s %12s" % ('size', 'cipher', 'us/msg', 'msgs/s'))
+    for size in MESSAGE_SIZES[:3]:
+        text = 'a' * size
+
+        for name, wire in modes:
+            sender = Protocol.SessionCipher(aes_key)
+            receiver = Protocol.SessionCipher(aes_key)
+            rate = measure(lambda: receiver.unseal(sender.seal(text, SocketCommands.DISPLAY, wire)))
+
+            print("%-8d %-11s %12.1f %12.0f" % (size, name, 1e6 / rate, rate))
+
+
+class ListQueue:
+    # The list and Lock queue Server and Client used before MessageQueue, kept here for comparison
+
+    def __init__(self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        self.lock.acquire()
+        self.items.append(item)
+        self.lock.release()
+
+    def get(self):
+        self.lock.acquire()
+        if len(self.items) > 0:
+            item = self.items.pop(0)
+            self.lock.release()
+            return item
+        self.lock.release()
+        return None
+
+    def __len__(self):
+        self.lock.acquire()
+        total = len(self.items)
+        self.lock.release()
+        return total
+
+
+def bench_queue(messages=100000):
+    # Push messages through each queue, once filled up front like a backlog and once with a producer thread
+    print("%-14s %-10s %12s" % ('queue', 'pattern', 'msgs/s'))
+    for name, make in (('list+lock', ListQueue), ('MessageQueue', MessageQueue)):
+        queue = make()
+        start = time.perf_counter()
+        for i in range(messages):
+            queue.put(i)
+        while len(queue) > 0:
+            queue.get()
+        print("%-14s %-10s %12.0f" % (name, 'backlog', messages / (time.perf_counter() - start)))
+
+        queue = make()
+        producer = threading.Thread(target=lambda: [queue.put(i) for i in range(messages)])
+        received = 0
+        start = time.perf_counter()
+        producer.start()
+        while received < messages:
+            if isinstance(queue, MessageQueue):
+                queue.wait(.1)
+                received += len(queue.drain())
+            elif queue.get() is not None:
+                received += 1
+        producer.join()
+        print("%-14s %-10s %12.0f" % (name, 'threaded', messages / (time.perf_counter() - start)))
+
+
+def recv_all_copying(sock, length):
+    # How recv_all used to read, growing a bytes object with every packet
+    data = b''
+    while len(data) < length:
+        packet = sock.recv(length - len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+
+def bench_receive(total=64 * 1024 * 1024):
+    # Throughput of reading frames over a local socketpair, old recv_all copying against FrameReader
+    print("%-10s %-12s %12s %12s" % ('frame', 'reader', 'MB/s', 'frames/s'))
+    for size in (64, 4096, File.DEFAULT_CHUNKSIZE, 1024 * 1024):
+        count = max(total // size // 8 if size < 4096 else total // size, 1)
+        payload = bytes(size)
+
+        for name in ('recv_all', 'FrameReader'):
+            sender, receiver = socket.socketpair()
+
+            def send():
+                writer = Transport.FrameWriter(sender)
+                for _ in range(count):
+                    writer.write(payload)
+                writer.flush()
+
+            thread = threading.Thread(target=send)
+            start = time.perf_counter()
+            thread.start()
+
+            received = 0
+            if name == 'recv_all':
+                while received < count:
+                    length = Protocol.frame_length(recv_all_copying(receiver, 4))
+                    recv_all_copying(receiver, length)
+                    received += 1
+            else:
+                reader = Transport.FrameReader(receiver)
+                while received < count:
+                    received += len(reader.read())
+
+            elapsed = time.perf_counter() - start
+            thread.join()
+            sender.close()
+            receiver.close()
+
+            print("%-10d %-12s %12.1f %12.0f" % (size, name, count * size / elapsed / 1e6, count / elapsed))
+
+
+def compression_inputs(size=File.DEFAULT_CHUNKSIZE):
+    # Seeded so runs are comparable
+    rng = random.Random(0)
+
+    # Text: chat like sentences from a small vocabulary
+    words = ['secure', 'talk', 'message', 'hello', 'the', 'a', 'key', 'file', 'relay', 'server', 'client', 'send']
+    text = ' '.join(rng.choice(words) for _ in range(size)).encode()[:size]
+
+    # Binary: records of counters, flags and floats like a log or database page
+    records = b''.join(struct.pack('>IHd', i, rng.randrange(4), rng.random()) for i in range(size // 14 + 1))
+    binary = records[:size]
+
+    # Already compressed: random bytes stand in for media, archives and encrypted files
+    compressed = bytes(rng.getrandbits(8) for _ in range(size))
+
+    return {'text': text, 'binary': binary, 'compressed': compressed}
+
+
+def bench_compression():
+    # Ratio and MB/s per codec on one chunk of each input, then what the adaptive Compressor picks
+    print("%-11s %-9s %8s %14s %16s" % ('input', 'codec', 'ratio', 'compress MB/s', 'decompress MB/s'))
+    for name, data in compression_inputs().items():
+        for codec in File.CODECS:
+            compressed = File.COMPRESSORS[codec](data)
+            compressRate = measure(lambda: File.COMPRESSORS[codec](data), MEASURE_TIME / 4)
+            decompressRate = measure(lambda: File.decompress(codec, compressed), MEASURE_TIME / 4)
+
+            print("%-11s %-9s %8.3f %14.1f %16.1f" % (
+                name, File.CODEC_NAMES[codec], len(compressed) / len(data),
+                compressRate * len(data) / 1e6, decompressRate * len(data) / 1e6))
+
+        # Run the adaptive compressor over a stream of these chunks and report its usual pick
+        compressor = File.Compressor()
+        chunks = File.EXPLORE_EVERY * 2
+        picks = Counter()
+        sent = 0
+        start = time.perf_counter()
+        for _ in range(chunks):
+            codec, compressed = compressor.compress(data)
+            picks[codec] += 1
+            sent += len(compressed)
+        elapsed = time.perf_counter() - start
+
+        print("%-11s %-9s %8.3f %14.1f %16s" % (
+            name, 'adaptive', sent / (chunks * len(data)), chunks * len(data) / elapsed / 1e6,
+            'mostly ' + File.CODEC_NAMES[picks.most_common(1)[0][0]]))
+
+
+def bench_fanout(size=256):
+    # Cost per room message: sealing it under every member's link key against sealing it once under the group key
+    text = 'a' * size
+
+    print("%-8s %-10s %12s %12s" % ('members', 'sealing', 'us/msg', 'msgs/s'))
+    for members in (10, 100, 500):
+        ciphers = [Protocol.SessionCipher(get_random_bytes(32)) for _ in range(members)]
+        group = Protocol.GroupCipher(get_random_bytes(32), 1, 0)
+
+        def per_member():
+            for cipher in ciphers:
+                Protocol.frame(cipher.seal(text, SocketCommands.DISPLAY, Protocol.CHACHA_WIRE))
+
+        def once():
+            # The relay then writes these same framed bytes to every member
+            Protocol.frame(group.seal(text, SocketCommands.DISPLAY))
+
+        for name, func in (('per member', per_member), ('group', once)):
+            rate = measure(func, MEASURE_TIME / 2)
+            print("%-8d %-10s %12.1f %12.0f" % (members, name, 1e6 / rate, rate))
+
+
+def import_time(module):
+    # Seconds to import module in a fresh interpreter and whether that pulled in requests
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import %s\n"
+            "print(time.perf_counter() - start, 'requests' in sys.modules)" % module)
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout.split()
+    return float(output[0]), output[1] == 'True'
+
+
+def bench_startup(rounds=200):
+    # How long it takes to import and construct each role, nothing here should touch the network
+    import Client
+    import Server
+
+    # A stub resolver counts lookups in case anything on the startup path still does one
+    lookups = []
+    ExternalIP.shared().resolver = lambda: lookups.append(1) or '192.0.2.1'
+
+    print("%-8s %12s %14s %10s %9s" % ('role', 'import ms', 'construct ms', 'requests', 'lookups'))
+    for name, role in (('Client', Client.Client), ('Server', Server.Server)):
+        importTime, importsRequests = import_time(name)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            role()
+        constructTime = (time.perf_counter() - start) / rounds
+
+        print("%-8s %12.1f %14.3f %10s %9d" % (name, importTime * 1e3, constructTime * 1e3,
+                                               'imported' if importsRequests else 'lazy', len(lookups)))
+
+
+BENCHMARKS = {
+    'wire': bench_wire,
+    'cipher': bench_cipher,
+    'queue': bench_queue,
+    'receive': bench_receive,
+    'compression': bench_compression,
+    'fanout': bench_fanout,
+    'startup': bench_startup,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        print("== %s ==" % name)
+        BENCHMARKS[name]()
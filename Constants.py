@@ -1,29 +1,138 @@
-# Author: Rodrigo Graca
-
-from enum import Enum
-
-# Generate the windows binary
-"""pyinstaller.exe -F -w -i padlock.ico -n "Secure Talk" GUI.py"""
-
-# Define encryption settings (Bytes)
-RSA_KEY_LENGTH = 4096
-AES_KEY_LENGTH = 32
-
-# Define app settings
-WINDOW_SIZE = (450, 500)
-
-# Define how often the output is reloaded
-OUTPUT_REFRESH_RATE = .5
-
-# Public IP of common relay server
-SERVER = 'zenov.ddns.net'
-
-
-# Provide commands to communicate between threads
-class DisplayCommands(Enum):
-    clearOutput = 1
-
-
-class SocketCommands:
-    DISPLAY = '0'
-    FILE_SEND = '1'
+# Author: Rodrigo Graca
+
+from enum import Enum
+from os.path import expanduser, join
+
+# Generate the windows binary
+"""pyinstaller.exe -F -w -i padlock.ico -n "Secure Talk" GUI.py"""
+
+# Define encryption settings (Bytes)
+RSA_KEY_LENGTH = 4096
+AES_KEY_LENGTH = 32
+
+# How clients trade keys, servers accept both. RSA is kept for servers that predate X25519
+RSA_HANDSHAKE = 'rsa'
+X25519_HANDSHAKE = 'x25519'
+HANDSHAKE_MODE = X25519_HANDSHAKE
+
+# How long a server waits for an X25519 hello before falling back to the RSA key trade (Seconds)
+HELLO_WAIT = 1
+
+# A peer that hasn't finished trading keys with the relay by then is dropped (Seconds)
+HANDSHAKE_TIMEOUT = 30
+
+# Peers that advertise heartbeats are pinged this often and dropped once silent for IDLE_TIMEOUT (Seconds)
+HEARTBEAT_INTERVAL = 15
+IDLE_TIMEOUT = 45
+
+# How long a session ticket lets a client resume without trading keys again (Seconds)
+TICKET_LIFETIME = 12 * 60 * 60
+
+# Define app settings
+WINDOW_SIZE = (450, 500)
+
+# Chat lines the window keeps in memory, older ones are paged out to an encrypted temporary file
+HISTORY_LINES = 2000
+HISTORY_PAGE_LINES = 200
+
+# Where received files are written
+DOWNLOAD_DIR = join(expanduser('~'), 'Secure Talk')
+
+# Chat history kept on disk and encrypted, segments are closed and a new one started at MESSAGE_LOG_SEGMENT_SIZE
+MESSAGE_LOG_ENABLED = True
+MESSAGE_LOG_DIR = join(expanduser('~'), '.secure_talk', 'history')
+MESSAGE_LOG_SEGMENT_SIZE = 4 * 1024 * 1024  # Bytes
+MESSAGE_LOG_FLUSH_INTERVAL = .05  # Messages this close together are synced to disk together (Seconds)
+HISTORY_RESULTS = 100  # Most search results shown
+
+# Public IP lookup, done in the background and cached so startup never waits on it
+EXTERNAL_IP_URL = 'https://api.ipify.org'
+EXTERNAL_IP_TIMEOUT = 10  # Seconds
+EXTERNAL_IP_TTL = 60 * 60  # How long a cached answer is used for (Seconds)
+EXTERNAL_IP_CACHE = join(expanduser('~'), '.secure_talk', 'external_ip.json')
+
+# How many file chunks may be sent before the receiver acknowledges them
+FILE_WINDOW = 8
+
+# Chat and file data share the connection in rounds, each channel may send its weight times this many bytes a round
+CHANNEL_QUANTUM = 16 * 1024
+SEND_LOWAT = 64 * 1024  # File data only goes out while less than this is waiting unsent in the socket (Bytes)
+
+# Chat flow control, a peer may send FLOW_WINDOW messages before we hand it more credit
+# Messages that can't go out yet wait in the send queue, addToSend refuses more once SEND_QUEUE_LIMIT are waiting
+FLOW_WINDOW = 256
+SEND_QUEUE_LIMIT = 1024
+
+# Expected link speed in bytes per second, compression picks the codec that gets data across fastest
+COMPRESSION_LINK_SPEED = 2 * 1024 * 1024
+
+# Pre-generated RSA keys, kept topped up by worker processes so handshakes don't wait on key generation
+KEY_POOL_SIZE = 4
+KEY_POOL_WATERMARK = 2  # Refill once this few keys are left
+KEY_POOL_WORKERS = 2
+
+# Public IP of common relay server
+SERVER = 'zenov.ddns.net'
+
+# Port the server and relay listen on
+SERVER_PORT = 65532
+
+# Connecting races every address the server name resolves to, starting another attempt this often (Seconds)
+CONNECT_STAGGER = .25
+CONNECT_TIMEOUT = 10  # Give up on a round of attempts after this long
+CONNECT_BACKOFF_MAX = 30  # Longest wait between rounds, the wait doubles from the client's serverTimeout
+
+# Outgoing frames are coalesced into one write once this many bytes are pending or the oldest waited this long
+WRITE_FLUSH_SIZE = 64 * 1024
+WRITE_FLUSH_DELAY = .002  # Seconds
+
+# Receive buffer per connection, it grows for larger frames and shrinks back once they are handled
+READ_BUFFER_SIZE = 256 * 1024
+
+# How long a daemon gives queued messages to go out once it is asked to stop (Seconds)
+DRAIN_TIMEOUT = 10
+
+# Instrumentation is off unless asked for, Metrics.enable() turns it on at runtime
+METRICS_ENABLED = False
+METRICS_PORT = 9465  # Local port Metrics.serve() answers GET /metrics on
+
+# Relay settings, buffers are kept small since the relay holds thousands of connections
+RELAY_BACKLOG = 1024
+RELAY_BUFFER_LIMIT = 16 * 1024  # Bytes read ahead per connection before the socket is paused
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Anything larger is treated as a broken or hostile peer
+RELAY_KEY_POOL_SIZE = 64
+RELAY_KEY_POOL_WATERMARK = 32
+
+
+# Provide commands to communicate between threads
+class DisplayCommands(Enum):
+    clearOutput = 1
+
+
+class SocketCommands:
+    DISPLAY = '0'
+    FILE_SEND = '1'
+    CAPABILITIES = '2'
+    FILE_ACCEPT = '3'
+    FILE_CHUNK = '4'
+    FILE_ACK = '5'
+    TICKET = '6'
+    HEARTBEAT = '7'
+    ROOM_JOIN = '8'
+    ROOM_LEAVE = '9'
+    GROUP_KEY = '10'
+    CREDIT = '11'
+    FILE_DECLINE = '12'
+
+
+# Logical channels sharing one connection, the command on every frame says which one it belongs to
+class Channels:
+    CONTROL = 0  # Credit, heartbeats, rooms and file offers and acks, small and what keeps the other channels moving
+    CHAT = 1
+    BULK = 2  # File chunks
+
+
+COMMAND_CHANNELS = {SocketCommands.DISPLAY: Channels.CHAT, SocketCommands.FILE_CHUNK: Channels.BULK}
+
+# Share of each round a channel gets while others are waiting too, None goes ahead of everything
+CHANNEL_WEIGHTS = {Channels.CONTROL: None, Channels.CHAT: 8, Channels.BULK: 1}
@@ -0,0 +1,287 @@
+# Headless entry point for running the relay or a server without wxPython or a display
+# "python Daemon.py --mode relay --port 65532", settings can also come from a JSON file given with --config
+# Flags win over the file and the file wins over Constants. SIGTERM or Ctrl+C drains connections before exiting
+
+import Constants
+
+import argparse
+import json
+import logging
+import multiprocessing
+import signal
+import sys
+import threading
+import time
+
+# Every setting the daemon takes, these names are used as is in the config file
+DEFAULTS = {
+    'mode': 'relay',  # 'relay' pairs peers up and hosts rooms, 'server' is one end of a direct conversation
+    'host': '',
+    'port': Constants.SERVER_PORT,
+    'key_length': Constants.RSA_KEY_LENGTH,  # For RSA handshakes with older peers
+    'workers': Constants.KEY_POOL_WORKERS,  # Processes generating RSA keys ahead of time
+    'shards': 1,  # Relay processes sharing the port, 0 runs one per core
+    'pool_size': None,  # Keys kept ready, None uses the relay or server default
+    'metrics_port': None,  # Serve GET /metrics on this local port, None leaves metrics off
+    'drain_timeout': Constants.DRAIN_TIMEOUT,  # Seconds given to queued messages on shutdown
+    'log_level': 'info',
+    'accept_files': False,  # Server mode only, save files the peer offers to Constants.DOWNLOAD_DIR
+    'log_messages': False,  # Server mode only, chat is logged as its length and sender unless this is on
+}
+
+MODES = ('relay', 'server')
+
+log = logging.getLogger('secure_talk')
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, anything passed as extra={'fields': {...}} becomes top level keys
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+
+        if record.exc_info:
+            entry['error'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def event(name, level=logging.INFO, **fields):
+    log.log(level, name, extra={'fields': fields})
+
+
+def parse(argv=None):
+    parser = argparse.ArgumentParser(description='Run Secure Talk without the GUI')
+    parser.add_argument('--config', help='JSON file with any of: ' + ', '.join(DEFAULTS))
+    parser.add_argument('--mode', choices=MODES)
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--key-length', type=int, dest='key_length')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--shards', type=int)
+    parser.add_argument('--pool-size', type=int, dest='pool_size')
+    parser.add_argument('--metrics-port', type=int, dest='metrics_port')
+    parser.add_argument('--drain-timeout', type=float, dest='drain_timeout')
+    parser.add_argument('--log-level', dest='log_level', choices=('debug', 'info', 'warning', 'error'))
+    parser.add_argument('--accept-files', action='store_true', default=None, dest='accept_files',
+                        help='Save files the peer offers, they are declined otherwise')
+    parser.add_argument('--log-messages', action='store_true', default=None, dest='log_messages',
+                        help='Log what peers say, not just who said how much')
+    return parser.parse_args(argv)
+
+
+def settings(args):
+    # Defaults, then the config file, then flags that were actually given
+    merged = dict(DEFAULTS)
+
+    if args.config:
+        with open(args.config) as configFile:
+            config = json.load(configFile)
+
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError('Unknown settings in %s: %s' % (args.config, ', '.join(sorted(unknown))))
+        merged.update(config)
+
+    merged.update({name: value for name, value in vars(args).items() if name in DEFAULTS and value is not None})
+
+    if merged['mode'] not in MODES:
+        raise ValueError('mode has to be one of: ' + ', '.join(MODES))
+    return merged
+
+
+def setupLogging(level):
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    log.addHandler(handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+def onStop(callback):
+    # SIGTERM from a service manager and Ctrl+C both start a graceful shutdown, a second one is ignored
+    stopping = []
+
+    def handler(signum, frame):
+        if not stopping:
+            stopping.append(signum)
+            callback(signal.Signals(signum).name)
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+def keyPool(config, size, watermark):
+    # Modules are imported once the mode is known so the daemon only loads what it runs
+    import KeyPool
+    size = config['pool_size'] or size
+    return KeyPool.KeyPool(key_length=config['key_length'], size=size, watermark=min(watermark, size),
+                           workers=config['workers'])
+
+
+def runRelay(config):
+    import asyncio
+    import Relay
+
+    keys = keyPool(config, Constants.RELAY_KEY_POOL_SIZE, Constants.RELAY_KEY_POOL_WATERMARK)
+
+    async def serve():
+        relay = Relay.Relay((config['host'], config['port']), keys=keys)
+        await relay.start()
+        event('listening', mode='relay', host=config['host'], port=config['port'])
+
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+
+        def stop(reason):
+            loop.call_soon_threadsafe(stopping.set)
+            event('stopping', reason=reason, connections=len(relay.connections))
+
+        onStop(stop)
+        await stopping.wait()
+
+        remaining = await relay.shutdown(config['drain_timeout'])
+        event('stopped', closed=remaining)
+
+    asyncio.run(serve())
+    return 0
+
+
+def runShards(config):
+    import Shard
+
+    # Each shard keeps its own key pool, workers is per shard here
+    shards = Shard.Shards((config['host'], config['port']), workers=config['shards'], keyLength=config['key_length'],
+                          poolSize=config['pool_size'], keyWorkers=config['workers'],
+                          drainTimeout=config['drain_timeout']).start()
+    event('listening', mode='relay', host=config['host'], port=config['port'], shards=shards.pids(),
+          reuse_port=Shard.REUSE_PORT)
+
+    stopping = threading.Event()
+    reasons = []
+
+    def stop(reason):
+        reasons.append(reason)
+        stopping.set()
+
+    onStop(stop)
+
+    # Pairing and rooms go through every shard, losing one means restarting them all
+    while not stopping.wait(.5):
+        if not shards.alive():
+            event('shard stopped unexpectedly', logging.ERROR)
+            shards.stop()
+            shards.join(config['drain_timeout'])
+            return 1
+
+    event('stopping', reason=reasons[0])
+    shards.stop()
+    shards.join(config['drain_timeout'] + 1)
+    event('stopped')
+    return 0
+
+
+def runServer(config):
+    import KeyPool
+    import Server
+    from Constants import DisplayCommands
+
+    # Handshakes take their RSA keys from the shared pool, swap in one built from the config before anything starts
+    KeyPool.sharedPool = keyPool(config, Constants.KEY_POOL_SIZE, Constants.KEY_POOL_WATERMARK).start()
+
+    server = Server.Server(server_addr=(config['host'], config['port']))
+    server.RSA_KEY_LENGTH = config['key_length']
+
+    def display(handle):
+        # No window to show messages in, they are logged instead. Draining promptly keeps credit flowing to the peer
+        for msg in handle.drainDisplay():
+            if msg == DisplayCommands.clearOutput or not msg:
+                continue
+
+            # Chat comes in prefixed with the peer's label, status lines are the server's own and are kept whole
+            text = str(msg)
+            if text.startswith(handle.identifier) and not config['log_messages']:
+                event('message', direction='in', sender=handle.identifier.rstrip(': '),
+                      length=len(text) - len(handle.identifier))
+            else:
+                event('display', text=text)
+
+    server.displayListener = display
+
+    def offered(handle, transferId, name, size):
+        # No one to ask, the config decides
+        event('file offered', size=size, accepted=config['accept_files'])
+        handle.answerFile(transferId, config['accept_files'])
+
+    server.offerListener = offered
+
+    stopping = threading.Event()
+    reasons = []
+
+    def stop(reason):
+        reasons.append(reason)
+        stopping.set()
+
+    onStop(stop)
+    server.start()
+    event('listening', mode='server', host=config['host'], port=config['port'])
+
+    # Signals are only delivered to the main thread, so it waits here rather than joining the server
+    while not stopping.wait(.5):
+        if not server.is_alive():
+            event('server stopped unexpectedly', logging.ERROR)
+            KeyPool.sharedPool.close()
+            return 1
+
+    event('stopping', reason=reasons[0], queued=server.getSendTotal())
+    if server.readyToTransmit:
+        server.addToSend('Server is shutting down')
+
+    # Give messages already queued a chance to reach the peer before the connection is closed
+    deadline = time.monotonic() + config['drain_timeout']
+    while server.readyToTransmit and server.getSendTotal() and time.monotonic() < deadline:
+        time.sleep(.05)
+
+    server.exit()
+    server.join(config['drain_timeout'])
+    KeyPool.sharedPool.close()
+    event('stopped', unsent=server.getSendTotal())
+    return 0
+
+
+def main(argv=None):
+    args = parse(argv)
+    try:
+        config = settings(args)
+    except (OSError, ValueError) as e:
+        print('Could not load settings:', e, file=sys.stderr)
+        return 2
+
+    setupLogging(config['log_level'])
+    event('starting', **config)
+
+    if config['metrics_port'] is not None:
+        import Metrics
+        Metrics.enable()
+        Metrics.serve(config['metrics_port'])
+        event('metrics', port=config['metrics_port'])
+
+    try:
+        if config['mode'] == 'relay' and config['shards'] != 1:
+            return runShards(config)
+        if config['mode'] == 'relay':
+            return runRelay(config)
+        return runServer(config)
+    except OSError as e:
+        event('failed', logging.ERROR, error=str(e))
+        return 1
+
+
+if __name__ == "__main__":
+    # Needed for the key pool's worker processes in a frozen binary
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,131 @@
+# Finds the network's public IP in the background so nothing waits on HTTP, answers are cached on disk
+
+import Constants
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('secure_talk.external_ip')
+
+
+def ipify():
+    # Default resolver, requests is only imported once a lookup actually has to go out
+    from requests import get
+    return get(Constants.EXTERNAL_IP_URL, timeout=Constants.EXTERNAL_IP_TIMEOUT).text.strip()
+
+
+class ExternalIP:
+
+    def __init__(self, resolver=ipify, cachePath=Constants.EXTERNAL_IP_CACHE, ttl=Constants.EXTERNAL_IP_TTL):
+
+        # Any callable returning the address as a string, swap it for a stub to run offline
+        self.resolver = resolver
+
+        # Cache file and how long an answer in it stays good (Seconds), None for no cache file
+        self.cachePath = cachePath
+        self.ttl = ttl
+
+        self.address = None
+        self.resolvedAt = 0
+
+        # Callbacks waiting on the lookup in flight, at most one lookup runs at a time
+        self.waiting = []
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def lookup(self, callback=None):
+        # Returns the address straight away if a fresh one is known, otherwise returns None,
+        # starts a lookup and calls callback(address) from the lookup thread once it is done
+        # The address passed to callback is None if the lookup failed
+        address = self.cached()
+        if address is not None:
+            return address
+
+        self.lock.acquire()
+        if callback is not None:
+            self.waiting.append(callback)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.resolve, daemon=True)
+            self.thread.start()
+        self.lock.release()
+        return None
+
+    def cached(self):
+        if self.address is None:
+            self.load()
+
+        if self.address is not None and time.time() - self.resolvedAt < self.ttl:
+            return self.address
+        return None
+
+    def resolve(self):
+        try:
+            address = self.resolver()
+        except Exception as e:
+            address = None
+            logger.warning('External IP lookup failed: %s', e)
+
+        self.lock.acquire()
+        if address is not None:
+            self.address = address
+            self.resolvedAt = time.time()
+            self.save()
+
+        waiting, self.waiting = self.waiting, []
+        self.thread = None
+        self.lock.release()
+
+        for callback in waiting:
+            callback(address)
+
+    def wait(self, timeout=None):
+        # Block until the lookup in flight finishes, for scripts and benchmarks that need the answer
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.cached()
+
+    def load(self):
+        if self.cachePath is None:
+            return
+
+        try:
+            with open(self.cachePath) as cacheFile:
+                cache = json.load(cacheFile)
+            self.address = cache['address']
+            self.resolvedAt = cache['time']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        if self.cachePath is None:
+            return
+
+        # Written to the side and swapped in so a reader never sees half a file
+        try:
+            os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+            temporaryPath = self.cachePath + '.tmp'
+            with open(temporaryPath, 'w') as cacheFile:
+                json.dump({'address': self.address, 'time': self.resolvedAt}, cacheFile)
+            os.replace(temporaryPath, self.cachePath)
+        except OSError as e:
+            logger.warning('Could not cache the external IP: %s', e)
+
+
+# One lookup per process shared by every connection
+sharedLookup = None
+sharedLock = threading.Lock()
+
+
+def shared():
+    global sharedLookup
+
+    sharedLock.acquire()
+    if sharedLookup is None:
+        sharedLookup = ExternalIP()
+    sharedLock.release()
+
+    return sharedLookup
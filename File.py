@@ -1,17 +1,470 @@
-# Interface with the os and filesystem
-from os.path import getsize, splitext, isfile
-from os import remove, rename
-from sys import exit
-from platform import system
-import subprocess
-import time
-
-# Store file attribute lengths
-import struct
-
-# Compression algorithms
-import lzma
-import bz2
-import gzip
-
-DEFAULT_CHUNKSIZE = 128000  # 1000 bytes = 1 kilobyte
+import Constants
+from Constants import SocketCommands
+
+# Interface with the os and filesystem
+from os.path import getsize, splitext, isfile, basename, join
+from os import remove, rename, makedirs, stat
+from sys import exit
+from platform import system
+import subprocess
+import time
+import threading
+
+# Transfer ids
+import hashlib
+
+# Store file attribute lengths
+import struct
+
+# Compression algorithms
+import lzma
+import bz2
+import gzip
+import zlib
+
+DEFAULT_CHUNKSIZE = 128000  # 1000 bytes = 1 kilobyte
+
+# Codec ids are written into the frame header so they must never be renumbered
+NO_CODEC = 0
+GZIP_CODEC = 1
+BZ2_CODEC = 2
+LZMA_CODEC = 3
+
+CODEC_NAMES = {NO_CODEC: 'none', GZIP_CODEC: 'gzip', BZ2_CODEC: 'bz2', LZMA_CODEC: 'lzma'}
+
+COMPRESSORS = {
+    GZIP_CODEC: lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+    BZ2_CODEC: lambda data: bz2.compress(data, compresslevel=9),
+    LZMA_CODEC: lambda data: lzma.compress(data, preset=1),
+}
+
+CODECS = tuple(COMPRESSORS)
+
+# Starting estimates of compressed size ratio and speed in bytes per second, replaced by measurements as chunks go out
+DEFAULT_RATIOS = {GZIP_CODEC: .35, BZ2_CODEC: .28, LZMA_CODEC: .27}
+DEFAULT_SPEEDS = {GZIP_CODEC: 40e6, BZ2_CODEC: 10e6, LZMA_CODEC: 15e6}
+
+COMPRESS_MIN_SIZE = 1024  # Short chat lines are never worth compressing
+SAMPLE_SIZE = 4096  # Bytes compressed up front to judge how compressible a chunk is
+SKIP_RATIO = .95  # Samples that don't shrink below this are sent as is, usually data that's already compressed
+EXPLORE_EVERY = 16  # Every n chunks a codec is tried round robin so the estimates follow the data
+ESTIMATE_WEIGHT = .3  # How much a new measurement moves the running estimates
+
+
+def decompress(codec, data, limit=Constants.MAX_FRAME_SIZE):
+    if codec == GZIP_CODEC:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif codec == BZ2_CODEC:
+        decompressor = bz2.BZ2Decompressor()
+    elif codec == LZMA_CODEC:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError('Unknown codec %d' % codec)
+
+    # Never inflate past the frame limit, a tiny frame could otherwise expand into gigabytes
+    # Each codec reports corrupt input its own way, callers only need to know the data was bad
+    try:
+        plain_text = decompressor.decompress(data, limit)
+    except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+        raise ValueError('Corrupt data for codec %d: %s' % (codec, e))
+    if not decompressor.eof:
+        raise ValueError('Decompressed data is over the limit')
+
+    return plain_text
+
+
+class Compressor:
+
+    def __init__(self, codecs=CODECS, linkSpeed=Constants.COMPRESSION_LINK_SPEED):
+        self.codecs = [codec for codec in codecs if codec in COMPRESSORS]
+
+        # Bytes per second the link is expected to carry, used to weigh CPU time against bytes saved
+        self.linkSpeed = linkSpeed
+
+        self.ratios = {codec: DEFAULT_RATIOS[codec] for codec in self.codecs}
+        self.speeds = {codec: DEFAULT_SPEEDS[codec] for codec in self.codecs}
+
+        self.chunks = 0
+
+    def compress(self, data):
+        # Returns the codec used and the data to send
+        if not self.codecs or len(data) < COMPRESS_MIN_SIZE:
+            return NO_CODEC, data
+
+        # Compress a sample with the cheapest setting, data that is already compressed won't shrink
+        sample = data[:SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > len(sample) * SKIP_RATIO:
+            return NO_CODEC, data
+
+        codec = self.choose(len(data))
+
+        start = time.perf_counter()
+        compressed = COMPRESSORS[codec](data)
+        self.measure(codec, len(data), len(compressed), time.perf_counter() - start)
+
+        if len(compressed) >= len(data):
+            return NO_CODEC, data
+
+        return codec, compressed
+
+    def choose(self, size):
+        self.chunks += 1
+
+        if self.chunks % EXPLORE_EVERY == 0:
+            return self.codecs[(self.chunks // EXPLORE_EVERY) % len(self.codecs)]
+
+        # Cost of a chunk is the time to compress it plus the time to put the result on the link
+        return min(self.codecs, key=lambda codec: size / self.speeds[codec] + size * self.ratios[codec] / self.linkSpeed)
+
+    def measure(self, codec, size, compressedSize, elapsed):
+        self.ratios[codec] += ESTIMATE_WEIGHT * (compressedSize / size - self.ratios[codec])
+        self.speeds[codec] += ESTIMATE_WEIGHT * (size / max(elapsed, 1e-6) - self.speeds[codec])
+
+
+# Every chunk starts with the transfer id and its index so the receiver can place it
+TRANSFER_ID_SIZE = 16
+CHUNK_HEADER = struct.Struct('>16sI')
+
+# Largest chunk size a peer may offer, leaves room for base64 on the JSON wire and the frame's own headers
+MAX_CHUNKSIZE = Constants.MAX_FRAME_SIZE // 2
+
+
+def transfer_id(filePath):
+    # Same file, size and modification time gives the same id so a re-offer after a reconnect resumes
+    info = stat(filePath)
+    key = '%s|%d|%d' % (basename(filePath), info.st_size, info.st_mtime_ns)
+    return hashlib.sha256(key.encode()).digest()[:TRANSFER_ID_SIZE]
+
+
+def pack_chunk(transferId, index, data):
+    return CHUNK_HEADER.pack(transferId, index) + data
+
+
+def unpack_chunk(chunk):
+    if len(chunk) < CHUNK_HEADER.size:
+        raise ValueError('Chunk of %d bytes is too short' % len(chunk))
+    transferId, index = CHUNK_HEADER.unpack_from(chunk)
+    return transferId, index, chunk[CHUNK_HEADER.size:]
+
+
+class FileSender:
+
+    def __init__(self, filePath, chunkSize=DEFAULT_CHUNKSIZE):
+        self.filePath = filePath
+        self.name = basename(filePath)
+        self.size = getsize(filePath)
+        self.id = transfer_id(filePath)
+
+        self.chunkSize = chunkSize
+        self.totalChunks = (self.size + chunkSize - 1) // chunkSize
+
+        # Next chunk to read and how many the receiver confirmed are on its disk
+        self.nextChunk = 0
+        self.acked = 0
+
+        # Opened once the receiver accepts and says where to resume from
+        self.file = None
+
+    def offer(self):
+        return {'id': self.id.hex(), 'name': self.name, 'size': self.size, 'chunk_size': self.chunkSize}
+
+    def start(self, chunk):
+        # Skip everything the receiver already has
+        self.nextChunk = self.acked = min(chunk, self.totalChunks)
+        self.file = open(self.filePath, 'rb')
+        self.file.seek(self.nextChunk * self.chunkSize)
+
+    def canSend(self, window):
+        # Only a window of chunks is ever in flight so memory stays bounded no matter the file size
+        return self.file is not None and self.nextChunk < self.totalChunks and self.nextChunk - self.acked < window
+
+    def readChunk(self):
+        chunk = pack_chunk(self.id, self.nextChunk, self.file.read(self.chunkSize))
+        self.nextChunk += 1
+        return chunk
+
+    def ack(self, chunk):
+        self.acked = max(self.acked, chunk + 1)
+
+    def isDone(self):
+        return self.file is not None and self.acked >= self.totalChunks
+
+    def close(self):
+        # Nothing goes out again until the receiver accepts a fresh offer
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class FileReceiver:
+
+    def __init__(self, offer, directory):
+        # Everything in the offer comes from the peer, one that doesn't add up is refused before the disk is touched
+        self.id = bytes.fromhex(offer['id'])
+        self.name = basename(offer['name'])
+        self.size = offer['size']
+        self.chunkSize = offer['chunk_size']
+
+        if len(self.id) != TRANSFER_ID_SIZE:
+            raise ValueError('Transfer id has to be %d bytes' % TRANSFER_ID_SIZE)
+        if self.name in ('', '.', '..'):
+            raise ValueError('No usable file name in the offer')
+        if type(self.size) is not int or self.size < 0:
+            raise ValueError('File size has to be a whole number of bytes')
+        if type(self.chunkSize) is not int or not 0 < self.chunkSize <= MAX_CHUNKSIZE:
+            raise ValueError('Chunk size has to be between 1 and %d bytes' % MAX_CHUNKSIZE)
+
+        self.totalChunks = (self.size + self.chunkSize - 1) // self.chunkSize
+
+        self.directory = directory
+
+        # Partial data is kept on disk under the transfer id so an interrupted transfer can resume
+        self.partPath = join(directory, '%s.%s.part' % (self.name, offer['id']))
+
+        # Opened once the offer is accepted
+        self.nextChunk = 0
+        self.file = None
+
+    def open(self):
+        makedirs(self.directory, exist_ok=True)
+
+        if isfile(self.partPath):
+            self.nextChunk = min(getsize(self.partPath) // self.chunkSize, self.totalChunks)
+            self.file = open(self.partPath, 'r+b')
+        else:
+            self.nextChunk = 0
+            self.file = open(self.partPath, 'wb')
+
+        # Drop any partial chunk left behind by the interruption
+        self.file.truncate(self.nextChunk * self.chunkSize)
+        self.file.seek(self.nextChunk * self.chunkSize)
+
+    def write(self, index, data):
+        if index >= self.totalChunks:
+            raise ValueError('Chunk %d of %s is past its end' % (index, self.name))
+
+        # Chunks arrive in order on the stream, anything else is a resend of data we already have
+        if index != self.nextChunk:
+            return False
+
+        # Every chunk is full size except the last, which holds whatever is left
+        if len(data) != min(self.chunkSize, self.size - index * self.chunkSize):
+            raise ValueError('Chunk %d of %s is %d bytes' % (index, self.name, len(data)))
+
+        self.file.write(data)
+        self.file.flush()
+        self.nextChunk += 1
+        return True
+
+    def isDone(self):
+        return self.nextChunk >= self.totalChunks
+
+    def finish(self):
+        self.file.close()
+
+        # Never overwrite an existing file, number the new one instead
+        root, ext = splitext(join(self.directory, self.name))
+        path = root + ext
+        copy = 1
+        while isfile(path):
+            path = '%s (%d)%s' % (root, copy, ext)
+            copy += 1
+
+        rename(self.partPath, path)
+        return path
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class Transfers:
+
+    def __init__(self, display, directory=Constants.DOWNLOAD_DIR, window=Constants.FILE_WINDOW, offered=None):
+
+        # Where to report progress, usually the connection's addToDisplay
+        self.display = display
+
+        # Called with (id, name, size) when the peer offers a file, the answer comes back through answer()
+        self.offered = offered
+
+        self.directory = directory
+        self.window = window
+
+        self.sending = {}
+        self.receiving = {}
+
+        # Offers from the peer waiting to be answered, nothing is written for one until it is accepted
+        self.offers = {}
+
+        # Files queued from the GUI thread that have not been offered yet and (id, accepted) answers to offers
+        self.queued = []
+        self.answers = []
+        self.queueLock = threading.Lock()
+
+    def queue(self, filePath):
+        sender = FileSender(filePath)
+
+        self.queueLock.acquire()
+        self.queued.append(sender)
+        self.queueLock.release()
+
+        self.display('Offering %s (%d bytes)' % (sender.name, sender.size))
+
+    def answer(self, transferId, accepted):
+        # Called from any thread once the user decides on an offer
+        self.queueLock.acquire()
+        self.answers.append((transferId, accepted))
+        self.queueLock.release()
+
+    def pending(self):
+        # Yields (data, command) pairs that should be sent, called from the connection thread
+        self.queueLock.acquire()
+        answers, self.answers = self.answers, []
+        queued, self.queued = self.queued, []
+        self.queueLock.release()
+
+        # Offers that were answered after the session they came in on ended are gone, the answer goes with them
+        for transferId, accepted in answers:
+            receiver = self.offers.pop(transferId, None)
+            if receiver is None:
+                continue
+
+            if accepted:
+                yield from self.accept(receiver)
+            else:
+                self.display('Declined %s' % receiver.name)
+                yield {'id': transferId.hex()}, SocketCommands.FILE_DECLINE
+
+        for sender in queued:
+            self.sending[sender.id] = sender
+            yield sender.offer(), SocketCommands.FILE_SEND
+
+        for sender in self.sending.values():
+            while sender.canSend(self.window):
+                yield sender.readChunk(), SocketCommands.FILE_CHUNK
+
+    def handle(self, command, data):
+        # Returns the (data, command) replies for a file command received from the peer
+        if command == SocketCommands.FILE_SEND:
+            return self.receiveOffer(data)
+        if command == SocketCommands.FILE_ACCEPT:
+            return self.startSending(data)
+        if command == SocketCommands.FILE_CHUNK:
+            return self.receiveChunk(data)
+        if command == SocketCommands.FILE_ACK:
+            return self.receiveAck(data)
+        if command == SocketCommands.FILE_DECLINE:
+            return self.receiveDecline(data)
+        return []
+
+    def receiveOffer(self, offer):
+        receiver = FileReceiver(offer, self.directory)
+
+        # Still waiting on the user, a resumed session offers the same file again
+        if receiver.id in self.offers:
+            return []
+
+        # Partial data means this file was accepted before, anything else waits for the user to say yes
+        if not isfile(receiver.partPath):
+            self.offers[receiver.id] = receiver
+            self.display('Peer offers %s (%d bytes)' % (receiver.name, receiver.size))
+            if self.offered is not None:
+                self.offered(receiver.id, receiver.name, receiver.size)
+            return []
+
+        return self.accept(receiver)
+
+    def accept(self, receiver):
+        receiver.open()
+
+        if receiver.nextChunk:
+            self.display('Resuming %s at %d of %d bytes' % (
+                receiver.name, receiver.nextChunk * receiver.chunkSize, receiver.size))
+        else:
+            self.display('Receiving %s (%d bytes)' % (receiver.name, receiver.size))
+
+        replies = [({'id': receiver.id.hex(), 'chunk': receiver.nextChunk}, SocketCommands.FILE_ACCEPT)]
+
+        if receiver.isDone():
+            self.display('Saved %s' % receiver.finish())
+        else:
+            self.receiving[receiver.id] = receiver
+
+        return replies
+
+    def startSending(self, data):
+        sender = self.sending.get(bytes.fromhex(data['id']))
+        if sender is None:
+            return []
+
+        sender.start(data['chunk'])
+        return self.finishSending(sender)
+
+    def receiveChunk(self, chunk):
+        transferId, index, data = unpack_chunk(chunk)
+
+        receiver = self.receiving.get(transferId)
+        if receiver is None or not receiver.write(index, data):
+            return []
+
+        # Acknowledge only once the chunk is on disk, that's where a resume picks up
+        replies = [({'id': transferId.hex(), 'chunk': index}, SocketCommands.FILE_ACK)]
+
+        if receiver.isDone():
+            del self.receiving[transferId]
+            self.display('Saved %s' % receiver.finish())
+
+        return replies
+
+    def receiveAck(self, data):
+        sender = self.sending.get(bytes.fromhex(data['id']))
+        if sender is None:
+            return []
+
+        sender.ack(data['chunk'])
+        return self.finishSending(sender)
+
+    def receiveDecline(self, data):
+        sender = self.sending.pop(bytes.fromhex(data['id']), None)
+        if sender is not None:
+            sender.close()
+            self.display('%s was declined' % sender.name)
+        return []
+
+    def finishSending(self, sender):
+        if sender.isDone():
+            del self.sending[sender.id]
+            sender.close()
+            self.display('Sent %s' % sender.name)
+        return []
+
+    def suspend(self):
+        # The connection dropped, partial files stay on disk and the transfers are kept in case it resumes
+        for transfer in list(self.sending.values()) + list(self.receiving.values()):
+            transfer.close()
+
+    def resume(self):
+        # Offer unfinished files again ahead of anything queued since, the receiver answers with where its
+        # partial file ends and sending carries on from there. Its side is opened again by the offer
+        self.queueLock.acquire()
+        self.queued[:0] = self.sending.values()
+        self.queueLock.release()
+
+        self.sending.clear()
+        self.receiving.clear()
+
+    def abort(self):
+        # The session they belonged to is gone for good, partial files are still kept for a later offer
+        self.queueLock.acquire()
+        queued, self.queued = self.queued, []
+        self.queueLock.release()
+
+        transfers = list(self.sending.values()) + list(self.receiving.values()) + list(self.offers.values())
+        for transfer in transfers + queued:
+            transfer.close()
+            self.display('Transfer of %s aborted' % transfer.name)
+        self.sending.clear()
+        self.receiving.clear()
+        self.offers.clear()
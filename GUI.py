@@ -1,239 +1,448 @@
-# Author: Rodrigo Graca
-
-import Constants
-from Constants import DisplayCommands
-from Server import Server
-from Client import Client
-
-import wx
-import time
-import threading
-import sys, os
-
-
-class SecureTalk(wx.Frame):
-    def __init__(self, *args, **kw):
-        # ensure the parent's __init__ is called
-        super(SecureTalk, self).__init__(*args, **kw)
-
-        if sys.platform == 'win32':
-            # only do this on windows, so we don't
-            # cause an error dialog on other platforms
-            exeName = sys.executable
-            icon = wx.Icon(exeName, wx.BITMAP_TYPE_ICO)
-            self.SetIcon(icon)
-
-        # create a panel in the frame
-        self.pnl = wx.Panel(self)
-
-        # Add all elements which are in the panel
-        self.makePanelElements()
-
-        # create a menu bar
-        self.makeMenuBar()
-
-        # and a status bar
-        self.CreateStatusBar()
-        self.SetStatusText("Welcome to Secure Talk! Communicate wirelessly without worry!")
-
-        # Can be either Server or Client
-        self.currentConnectionHandle: Client = None
-
-        # How often the output is refreshed
-        self.OUTPUT_REFRESH_RATE = Constants.OUTPUT_REFRESH_RATE
-
-        # Small thread to independently update the output box
-        self.updateOutputThread = threading.Thread(target=self.updateOutput, daemon=True)
-        self.updateOutputThread.start()
-
-        # What should be displayed as the user's name in 'output'
-        self.identifier = "Me: "
-
-    def makePanelElements(self):
-
-        # Labels
-        outputLabel = wx.StaticText(self.pnl, label="Chat", pos=(25, 3))
-        inputLabel = wx.StaticText(self.pnl, label="User input", pos=(25, 348))
-
-        font = outputLabel.GetFont()
-        font.PointSize += 3
-        outputLabel.SetFont(font)
-        inputLabel.SetFont(font)
-
-        # TextControl
-        self.output = wx.TextCtrl(self.pnl, pos=(18, 25), size=(395, 300), style=wx.TE_READONLY | wx.TE_MULTILINE)
-        self.ClientInput = wx.TextCtrl(self.pnl, pos=(18, 370), size=(395, 22), style=wx.TE_PROCESS_ENTER)
-
-        # Adjust the text size of the output
-        font = self.output.GetFont()
-        font.PointSize += 1
-        self.output.SetFont(font)
-
-        self.Bind(wx.EVT_TEXT_ENTER, self.OnEnter, self.ClientInput)
-
-    def makeMenuBar(self):
-        # Make a file menu with File and Exit items
-        fileMenu = wx.Menu()
-
-        # Add a call to send files
-        fileItem = fileMenu.Append(-1, "&Send File...\tCtrl-F", "Send a file over this protocol")
-        fileMenu.AppendSeparator()
-
-        # Exit program and it's daemons
-        exitItem = fileMenu.Append(wx.ID_EXIT)
-
-        # Now a help menu for the about item
-        helpMenu = wx.Menu()
-        aboutItem = helpMenu.Append(wx.ID_ABOUT)
-
-        # Connection Handler
-        connectionMenu = wx.Menu()
-
-        # Control and start connections
-        serverItem = connectionMenu.Append(0, "&Server", "Act as the server and prepare for a connection")
-        clientItem = connectionMenu.Append(1, "&Client", "Connect to a server at a given IP")
-        closeItem = connectionMenu.Append(2, "&Close", "Close the current connection")
-
-        # Apply all these menus to the bar
-        menuBar = wx.MenuBar()
-        menuBar.Append(fileMenu, "&File")
-        menuBar.Append(helpMenu, "&Help")
-        menuBar.Append(connectionMenu, "&Connections")
-
-        # Give the menu bar to the frame
-        self.SetMenuBar(menuBar)
-
-        # Finally, associate a handler function with the EVT_MENU event for
-        # each of the menu items. That means that when that menu item is
-        # activated then the associated handler function will be called.
-        self.Bind(wx.EVT_MENU, self.OnFileSend, fileItem)
-        self.Bind(wx.EVT_MENU, self.OnExit, exitItem)
-        self.Bind(wx.EVT_MENU, self.OnAbout, aboutItem)
-        self.Bind(wx.EVT_MENU, self.OnServer, serverItem)
-        self.Bind(wx.EVT_MENU, self.OnClient, clientItem)
-        self.Bind(wx.EVT_MENU, self.onClose, closeItem)
-
-    def OnFileSend(self, event):
-        if self.currentConnectionHandle:
-            if self.currentConnectionHandle.readyToTransmit:
-                # TODO Add ability to send files
-
-                openFile = wx.FileDialog(self, "Select file to send", ".", "", "*", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
-
-                openFile.ShowModal()
-                filePath = openFile.GetPath()
-                print(filePath)
-                openFile.Destroy()
-
-                self.currentConnectionHandle.sendFile(filePath)
-            else:
-                wx.MessageBox("Connection not stabilized yet!", style=wx.ICON_INFORMATION)
-        else:
-            wx.MessageBox("You are not connected to anyone yet!", style=wx.ICON_INFORMATION)
-
-    def OnExit(self, event):
-        # Close the frame and terminate any connection
-
-        self.closeConn()
-        self.Close(True)
-
-    def OnAbout(self, event):
-        # Display an About dialog
-        wx.MessageBox("This is the about dialog for Secure Talk",
-                      "About Secure Talk",
-                      wx.OK | wx.ICON_INFORMATION)
-
-    def OnEnter(self, event):
-
-        # Get the value of the input, store & display it, then clear to be ready for more input
-        text = self.ClientInput.GetValue()
-
-        if text != "":
-            if self.currentConnectionHandle:
-                self.currentConnectionHandle.addToDisplay(self.identifier + text)
-                self.currentConnectionHandle.addToSend(text)
-
-            else:
-                wx.MessageBox("You are not connected to anyone yet!", style=wx.ICON_INFORMATION)
-
-            self.ClientInput.Clear()
-
-    def OnServer(self, event):
-        # Start a new server handle if no handle is currently active, otherwise deny
-        if not self.currentConnectionHandle:
-            self.currentConnectionHandle = Server()
-            self.currentConnectionHandle.start()
-        else:
-            wx.MessageBox("You're already trying/are connected to someone!", style=wx.ICON_INFORMATION)
-
-    def OnClient(self, event):
-        # Start a new client handle if no handle is currently active, otherwise deny
-        if not self.currentConnectionHandle:
-            # TODO Bug: When selecting cancel in dialog program continues
-            serverIP = self.ask(message="Where would you like to connect to? Please enter the IP below ",
-                                default_value="localhost", caption="Server IP")
-            self.currentConnectionHandle = Client(server_addr=(serverIP, 65532))
-            self.currentConnectionHandle.start()
-        else:
-            wx.MessageBox("You're already trying/are connected to someone!", style=wx.ICON_INFORMATION)
-
-    def ask(self, parent=None, message='', default_value='', caption='Hello'):
-        dlg = wx.TextEntryDialog(parent, message, value=default_value, caption=caption)
-        dlg.ShowModal()
-        result = dlg.GetValue()
-        dlg.Destroy()
-        return result
-
-    def updateOutput(self):
-
-        # TODO Just no, fix this
-        while True:
-            if self.currentConnectionHandle:
-
-                if self.currentConnectionHandle.isRunning():
-                    if self.currentConnectionHandle.getRecvTotal() > 0:
-                        msg = self.currentConnectionHandle.nextToDisplay()
-
-                        if msg == DisplayCommands.clearOutput:
-                            self.output.Clear()
-                        elif msg:
-                            self.output.AppendText(str(msg) + "\n")
-                else:
-                    wx.MessageBox("Connection dissolved! Did the recipient abruptly exit?", style=wx.ICON_ERROR)
-                    self.closeConn()
-
-            time.sleep(self.OUTPUT_REFRESH_RATE)
-
-    def onClose(self, event):
-        if self.currentConnectionHandle:
-            result = wx.MessageBox("Would you like to end the connection?", style=wx.OK | wx.CANCEL | wx.CANCEL_DEFAULT)
-
-            # Result: 4 == OK
-            if result == 4:
-                self.closeConn()
-
-    def closeConn(self):
-        if self.currentConnectionHandle:
-            self.currentConnectionHandle.exit()
-        self.currentConnectionHandle = None
-        self.output.Clear()
-        self.ClientInput.Clear()
-
-
-def startGUI():
-    # Next, create an application object.
-    app = wx.App()
-
-    # Then a frame.
-    frm = SecureTalk(None, title="Secure Talk", size=Constants.WINDOW_SIZE,
-                     style=wx.DEFAULT_FRAME_STYLE & ~(wx.RESIZE_BORDER | wx.MAXIMIZE_BOX))
-
-    # Show it.
-    frm.Show()
-
-    # Start the event loop.
-    app.MainLoop()
-
-
-if __name__ == "__main__":
-    startGUI()
+# Author: Rodrigo Graca
+
+import Constants
+from Constants import DisplayCommands
+from Server import Server
+from Client import Client
+from History import History, LogHistory
+import KeyPool
+import MessageLog
+
+import wx
+import wx.lib.dialogs
+import time
+import multiprocessing
+import sys, os
+import textwrap
+
+
+class HistoryView(wx.ListCtrl):
+    # Virtual list over the chat history, wx only asks for the rows it is about to draw
+    # so the cost of an update doesn't grow with the length of the conversation
+
+    def __init__(self, parent, history, **kw):
+        super(HistoryView, self).__init__(parent, style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_NO_HEADER, **kw)
+        self.history = history
+
+        self.InsertColumn(0, '', width=self.GetClientSize().width)
+        self.Bind(wx.EVT_KEY_DOWN, self.OnKey)
+
+    def OnGetItemText(self, item, column):
+        return self.history.line(item)
+
+    def OnKey(self, event):
+        # Rows can't be selected as text, Ctrl+C copies the selected ones instead
+        if event.ControlDown() and event.GetKeyCode() == ord('C'):
+            rows = []
+            item = self.GetFirstSelected()
+            while item != -1:
+                rows.append(self.history.line(item))
+                item = self.GetNextSelected(item)
+
+            if rows and wx.TheClipboard.Open():
+                wx.TheClipboard.SetData(wx.TextDataObject("\n".join(rows)))
+                wx.TheClipboard.Close()
+        else:
+            event.Skip()
+
+    def columns(self):
+        # Characters that fit on one row, rows don't wrap by themselves so long messages are split up front
+        width = self.GetClientSize().width - wx.SystemSettings.GetMetric(wx.SYS_VSCROLL_X)
+        return max(width // max(self.GetCharWidth(), 1), 10)
+
+    def append(self, lines):
+        # Follow new messages only if the user was already at the bottom, otherwise leave them reading
+        following = self.GetTopItem() + self.GetCountPerPage() >= self.GetItemCount()
+
+        rows = []
+        for line in lines:
+            for part in line.split("\n"):
+                rows.extend(textwrap.wrap(part, self.columns()) or [''])
+
+        self.history.append(rows)
+        self.SetItemCount(len(self.history))
+
+        if following:
+            self.EnsureVisible(len(self.history) - 1)
+
+    def clear(self):
+        self.history.clear()
+        self.SetItemCount(0)
+
+
+class SecureTalk(wx.Frame):
+    def __init__(self, *args, **kw):
+        # ensure the parent's __init__ is called
+        super(SecureTalk, self).__init__(*args, **kw)
+
+        if sys.platform == 'win32':
+            # only do this on windows, so we don't
+            # cause an error dialog on other platforms
+            exeName = sys.executable
+            icon = wx.Icon(exeName, wx.BITMAP_TYPE_ICO)
+            self.SetIcon(icon)
+
+        # create a panel in the frame
+        self.pnl = wx.Panel(self)
+
+        # Add all elements which are in the panel
+        self.makePanelElements()
+
+        # create a menu bar
+        self.makeMenuBar()
+
+        # and a status bar
+        self.CreateStatusBar()
+        self.SetStatusText("Welcome to Secure Talk! Communicate wirelessly without worry!")
+
+        # Can be either Server or Client
+        self.currentConnectionHandle: Client = None
+
+        # Set while an output update is queued on the GUI thread so bursts of messages share one update
+        self.outputScheduled = False
+
+        # What should be displayed as the user's name in 'output'
+        self.identifier = "Me: "
+
+        # Encrypted history of every conversation, opened when the first one starts
+        self.messageLog = None
+        self.historyOn = Constants.MESSAGE_LOG_ENABLED
+
+    def makePanelElements(self):
+
+        # Labels
+        outputLabel = wx.StaticText(self.pnl, label="Chat", pos=(25, 3))
+        inputLabel = wx.StaticText(self.pnl, label="User input", pos=(25, 348))
+
+        font = outputLabel.GetFont()
+        font.PointSize += 3
+        outputLabel.SetFont(font)
+        inputLabel.SetFont(font)
+
+        # TextControl
+        self.output = HistoryView(self.pnl, History(), pos=(18, 25), size=(395, 300))
+        self.ClientInput = wx.TextCtrl(self.pnl, pos=(18, 370), size=(395, 22), style=wx.TE_PROCESS_ENTER)
+
+        # Adjust the text size of the output
+        font = self.output.GetFont()
+        font.PointSize += 1
+        self.output.SetFont(font)
+
+        self.Bind(wx.EVT_TEXT_ENTER, self.OnEnter, self.ClientInput)
+
+    def makeMenuBar(self):
+        # Make a file menu with File and Exit items
+        fileMenu = wx.Menu()
+
+        # Add a call to send files
+        fileItem = fileMenu.Append(-1, "&Send File...\tCtrl-F", "Send a file over this protocol")
+        searchItem = fileMenu.Append(-1, "Search &History...\tCtrl-H", "Find messages from earlier conversations")
+        browseItem = fileMenu.Append(-1, "&Browse History...\tCtrl-B", "Read back an earlier conversation")
+        fileMenu.AppendSeparator()
+
+        # Exit program and it's daemons
+        exitItem = fileMenu.Append(wx.ID_EXIT)
+
+        # Now a help menu for the about item
+        helpMenu = wx.Menu()
+        aboutItem = helpMenu.Append(wx.ID_ABOUT)
+
+        # Connection Handler
+        connectionMenu = wx.Menu()
+
+        # Control and start connections
+        serverItem = connectionMenu.Append(0, "&Server", "Act as the server and prepare for a connection")
+        clientItem = connectionMenu.Append(1, "&Client", "Connect to a server at a given IP")
+        closeItem = connectionMenu.Append(2, "&Close", "Close the current connection")
+        connectionMenu.AppendSeparator()
+
+        # Group chat through a relay
+        joinRoomItem = connectionMenu.Append(3, "&Join Room...", "Chat with everyone in a room on the relay")
+        leaveRoomItem = connectionMenu.Append(4, "&Leave Room", "Leave the current room")
+
+        # Apply all these menus to the bar
+        menuBar = wx.MenuBar()
+        menuBar.Append(fileMenu, "&File")
+        menuBar.Append(helpMenu, "&Help")
+        menuBar.Append(connectionMenu, "&Connections")
+
+        # Give the menu bar to the frame
+        self.SetMenuBar(menuBar)
+
+        # Finally, associate a handler function with the EVT_MENU event for
+        # each of the menu items. That means that when that menu item is
+        # activated then the associated handler function will be called.
+        self.Bind(wx.EVT_MENU, self.OnFileSend, fileItem)
+        self.Bind(wx.EVT_MENU, self.OnSearchHistory, searchItem)
+        self.Bind(wx.EVT_MENU, self.OnBrowseHistory, browseItem)
+        self.Bind(wx.EVT_MENU, self.OnExit, exitItem)
+        self.Bind(wx.EVT_MENU, self.OnAbout, aboutItem)
+        self.Bind(wx.EVT_MENU, self.OnServer, serverItem)
+        self.Bind(wx.EVT_MENU, self.OnClient, clientItem)
+        self.Bind(wx.EVT_MENU, self.onClose, closeItem)
+        self.Bind(wx.EVT_MENU, self.OnJoinRoom, joinRoomItem)
+        self.Bind(wx.EVT_MENU, self.OnLeaveRoom, leaveRoomItem)
+
+    def OnFileSend(self, event):
+        if self.currentConnectionHandle:
+            if self.currentConnectionHandle.readyToTransmit:
+                openFile = wx.FileDialog(self, "Select file to send", ".", "", "*", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+
+                # Nothing is sent when the dialog is cancelled
+                if openFile.ShowModal() == wx.ID_OK:
+                    self.currentConnectionHandle.sendFile(openFile.GetPath())
+                openFile.Destroy()
+            else:
+                wx.MessageBox("Connection not stabilized yet!", style=wx.ICON_INFORMATION)
+        else:
+            wx.MessageBox("You are not connected to anyone yet!", style=wx.ICON_INFORMATION)
+
+    def OnSearchHistory(self, event):
+        log = self.openLog()
+        if log is None:
+            wx.MessageBox("History is turned off", style=wx.ICON_INFORMATION)
+            return
+
+        query = self.ask(message="Find messages containing all of these words", caption="Search History")
+        if not query:
+            return
+
+        # Newest conversations first, each one answers from its word index without reading its messages
+        lines = []
+        for started, name in log.sessions():
+            for number, stamp, sender, text in log.session(name).search(query, limit=Constants.HISTORY_RESULTS):
+                lines.append("%s  [%s]  %s: %s" % (time.strftime('%Y-%m-%d %H:%M', time.localtime(stamp)), name,
+                                                  sender, text))
+            if len(lines) >= Constants.HISTORY_RESULTS:
+                break
+
+        dlg = wx.lib.dialogs.ScrolledMessageDialog(self, "\n".join(lines[:Constants.HISTORY_RESULTS]) or "No matches",
+                                                   "Search History")
+        dlg.ShowModal()
+        dlg.Destroy()
+
+    def OnBrowseHistory(self, event):
+        log = self.openLog()
+        if log is None:
+            wx.MessageBox("History is turned off", style=wx.ICON_INFORMATION)
+            return
+
+        names = [name for started, name in log.sessions()]
+        if not names:
+            wx.MessageBox("No conversations have been kept yet", style=wx.ICON_INFORMATION)
+            return
+
+        choice = wx.SingleChoiceDialog(self, "Which conversation would you like to read?", "Browse History", names)
+        if choice.ShowModal() == wx.ID_OK:
+            name = names[choice.GetSelection()]
+
+            # Same view as the chat, it reads messages from the log as they scroll into sight
+            dlg = wx.Dialog(self, title=name, size=Constants.WINDOW_SIZE)
+            view = HistoryView(dlg, LogHistory(log.session(name)), size=dlg.GetClientSize())
+            view.SetItemCount(len(view.history))
+            if len(view.history):
+                view.EnsureVisible(len(view.history) - 1)
+
+            dlg.ShowModal()
+            dlg.Destroy()
+        choice.Destroy()
+
+    def OnJoinRoom(self, event):
+        if self.currentConnectionHandle and self.currentConnectionHandle.readyToTransmit:
+            room = self.ask(message="Which room would you like to join?", default_value="lobby", caption="Join Room")
+            if room:
+                self.currentConnectionHandle.joinRoom(room)
+        else:
+            wx.MessageBox("Connect to a relay first!", style=wx.ICON_INFORMATION)
+
+    def OnLeaveRoom(self, event):
+        if self.currentConnectionHandle and self.currentConnectionHandle.room is not None:
+            self.currentConnectionHandle.leaveRoom()
+        else:
+            wx.MessageBox("You are not in a room!", style=wx.ICON_INFORMATION)
+
+    def OnExit(self, event):
+        # Close the frame and terminate any connection
+
+        self.closeConn()
+        if KeyPool.sharedPool is not None:
+            KeyPool.sharedPool.close()
+        if self.messageLog is not None:
+            self.messageLog.close()
+        self.Close(True)
+
+    def OnAbout(self, event):
+        # Display an About dialog
+        wx.MessageBox("This is the about dialog for Secure Talk",
+                      "About Secure Talk",
+                      wx.OK | wx.ICON_INFORMATION)
+
+    def OnEnter(self, event):
+
+        # Get the value of the input, store & display it, then clear to be ready for more input
+        text = self.ClientInput.GetValue()
+
+        if text != "":
+            if self.currentConnectionHandle:
+                # The input is kept when the peer has fallen too far behind to queue any more
+                if not self.currentConnectionHandle.addToSend(text):
+                    wx.MessageBox("Your peer isn't keeping up, try again in a moment", style=wx.ICON_INFORMATION)
+                    return
+                self.currentConnectionHandle.addToDisplay(self.identifier + text)
+
+            else:
+                wx.MessageBox("You are not connected to anyone yet!", style=wx.ICON_INFORMATION)
+
+            self.ClientInput.Clear()
+
+    def OnServer(self, event):
+        # Start a new server handle if no handle is currently active, otherwise deny
+        if not self.currentConnectionHandle:
+            # Only a server answers RSA handshakes from older clients, keys are generated ahead once one is started
+            # A client trading RSA keys starts the pool itself on the first one
+            KeyPool.shared().start()
+
+            self.currentConnectionHandle = Server()
+            self.currentConnectionHandle.displayListener = self.scheduleOutput
+            self.currentConnectionHandle.offerListener = self.scheduleOffer
+            self.currentConnectionHandle.log = self.conversation("Server on port %d" % Constants.SERVER_PORT)
+            self.currentConnectionHandle.start()
+        else:
+            wx.MessageBox("You're already trying/are connected to someone!", style=wx.ICON_INFORMATION)
+
+    def OnClient(self, event):
+        # Start a new client handle if no handle is currently active, otherwise deny
+        if not self.currentConnectionHandle:
+            serverIP = self.ask(message="Where would you like to connect to? Please enter the IP below ",
+                                default_value="localhost", caption="Server IP")
+            if not serverIP:
+                return
+            self.currentConnectionHandle = Client(server_addr=(serverIP, Constants.SERVER_PORT))
+            self.currentConnectionHandle.displayListener = self.scheduleOutput
+            self.currentConnectionHandle.offerListener = self.scheduleOffer
+            self.currentConnectionHandle.log = self.conversation("Client to " + serverIP)
+            self.currentConnectionHandle.start()
+        else:
+            wx.MessageBox("You're already trying/are connected to someone!", style=wx.ICON_INFORMATION)
+
+    def openLog(self):
+        # The history is opened on first use with its passphrase, giving none or a broken history turns it off
+        while self.messageLog is None and self.historyOn:
+            if MessageLog.hasKey():
+                message = "Passphrase for your chat history, leave it empty to keep history off"
+            else:
+                message = "Choose a passphrase to encrypt your chat history with, leave it empty to keep history off"
+
+            passphrase = self.askPassphrase(message)
+            if not passphrase:
+                self.SetStatusText("History is off")
+                self.historyOn = False
+                break
+
+            try:
+                self.messageLog = MessageLog.MessageLog(passphrase)
+                self.messageLog.start()
+            except ValueError as e:
+                # Usually a mistyped passphrase, ask again
+                wx.MessageBox(str(e), style=wx.ICON_ERROR)
+            except OSError as e:
+                self.SetStatusText("History is off: " + str(e))
+                self.historyOn = False
+                self.messageLog = None
+        return self.messageLog
+
+    def conversation(self, name):
+        # Every connection is kept as its own conversation, named after who and when
+        log = self.openLog()
+        if log is None:
+            return None
+        return log.session(time.strftime('%Y-%m-%d %H:%M:%S ') + name)
+
+    def ask(self, parent=None, message='', default_value='', caption='Hello'):
+        # Cancel gives back nothing, even with a default filled in
+        dlg = wx.TextEntryDialog(parent, message, value=default_value, caption=caption)
+        result = dlg.GetValue() if dlg.ShowModal() == wx.ID_OK else ''
+        dlg.Destroy()
+        return result
+
+    def askPassphrase(self, message):
+        dlg = wx.PasswordEntryDialog(self, message, caption="History")
+        result = dlg.GetValue() if dlg.ShowModal() == wx.ID_OK else ''
+        dlg.Destroy()
+        return result
+
+    def scheduleOutput(self, handle):
+        # Called from any thread, only one update is queued on the GUI thread at a time
+        if not self.outputScheduled:
+            self.outputScheduled = True
+            wx.CallAfter(self.updateOutput)
+
+    def scheduleOffer(self, handle, transferId, name, size):
+        # Called from the connection's thread, the question is asked on the GUI thread
+        wx.CallAfter(self.askFile, handle, transferId, name, size)
+
+    def askFile(self, handle, transferId, name, size):
+        result = wx.MessageBox("Your peer would like to send you %s (%d bytes). Accept it?" % (name, size),
+                               "Incoming File", style=wx.YES_NO | wx.ICON_QUESTION)
+        handle.answerFile(transferId, result == wx.YES)
+
+    def updateOutput(self):
+        # Runs on the GUI thread, clear the flag first so anything added while draining schedules another update
+        self.outputScheduled = False
+
+        # Closed connections may still notify, only the current one is ever displayed
+        handle = self.currentConnectionHandle
+        if not handle:
+            return
+
+        # Append everything pending at once
+        lines = []
+        for msg in handle.drainDisplay():
+            if msg == DisplayCommands.clearOutput:
+                self.output.clear()
+                lines = []
+            elif msg:
+                lines.append(str(msg))
+
+        if lines:
+            self.output.append(lines)
+
+        if not handle.isRunning():
+            wx.MessageBox("Connection dissolved! Did the recipient abruptly exit?", style=wx.ICON_ERROR)
+            self.closeConn()
+
+    def onClose(self, event):
+        if self.currentConnectionHandle:
+            result = wx.MessageBox("Would you like to end the connection?", style=wx.OK | wx.CANCEL | wx.CANCEL_DEFAULT)
+
+            # Result: 4 == OK
+            if result == 4:
+                self.closeConn()
+
+    def closeConn(self):
+        if self.currentConnectionHandle:
+            self.currentConnectionHandle.exit()
+        self.currentConnectionHandle = None
+        self.output.clear()
+        self.ClientInput.Clear()
+
+
+def startGUI():
+    # Next, create an application object.
+    app = wx.App()
+
+    # Then a frame.
+    frm = SecureTalk(None, title="Secure Talk", size=Constants.WINDOW_SIZE,
+                     style=wx.DEFAULT_FRAME_STYLE & ~(wx.RESIZE_BORDER | wx.MAXIMIZE_BOX))
+
+    # Show it.
+    frm.Show()
+
+    # Start the event loop.
+    app.MainLoop()
+
+
+if __name__ == "__main__":
+    # Needed for the key pool's worker processes in the frozen windows binary
+    multiprocessing.freeze_support()
+    startGUI()
@@ -0,0 +1,111 @@
+# X25519 key agreement, a one round trip alternative to trading AES keys over RSA-OAEP
+# Also session tickets, which let a client that lost its connection skip the key trade altogether
+
+import Constants
+
+import struct
+import time
+
+from Crypto.Cipher import ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC
+from Crypto.Random import get_random_bytes
+
+# Clients that support X25519 open the connection with this marker followed by their public key
+HELLO = b'STX25519'
+
+# Binds the derived keys to this protocol so they can't be confused with keys from anything else
+KEY_CONTEXT = b'Secure Talk X25519 session keys'
+
+# Clients holding a ticket open with this marker, a random value and the ticket
+# The server answers with the same marker and its own random value, or RESUME_REJECTED to ask for a full key trade
+RESUME = b'STRESUME'
+RESUME_REJECTED = b'STREJECT'
+RESUME_CONTEXT = b'Secure Talk resumed session keys'
+RANDOM_LENGTH = 32
+
+# Sealed inside the ticket ahead of the secret
+TICKET_EXPIRY = struct.Struct('>Q')
+TICKET_NONCE_LENGTH = 12
+TICKET_TAG_LENGTH = 16
+
+
+def generate():
+    # Fresh keys for every connection, returns the private key and the DER public key to send
+    private_key = ECC.generate(curve='Curve25519')
+    return private_key, private_key.public_key().export_key(format='DER')
+
+
+def hello(public_key):
+    return HELLO + public_key
+
+
+def is_hello(data):
+    return data is not None and data.startswith(HELLO)
+
+
+def hello_key(data):
+    return data[len(HELLO):]
+
+
+def derive_keys(private_key, peer_public, client_public, server_public, key_length=Constants.AES_KEY_LENGTH):
+    # Returns (client_aes_key, server_aes_key), each direction gets its own key
+    peer_key = ECC.import_key(peer_public)
+    if peer_key.curve != 'Curve25519':
+        raise ValueError('Peer sent a %s key' % peer_key.curve)
+
+    # Salting with both public keys ties the session keys to exactly what was traded
+    def kdf(shared_secret):
+        return HKDF(shared_secret, key_length, client_public + server_public, SHA256, num_keys=2, context=KEY_CONTEXT)
+
+    client_aes_key, server_aes_key = key_agreement(static_priv=private_key, static_pub=peer_key, kdf=kdf)
+    return client_aes_key, server_aes_key
+
+
+def issue_ticket(ticket_key, lifetime=Constants.TICKET_LIFETIME, key_length=Constants.AES_KEY_LENGTH):
+    # Returns (ticket, secret). The secret is sealed under a key only the server knows so it keeps no state per client
+    secret = get_random_bytes(key_length)
+    nonce = get_random_bytes(TICKET_NONCE_LENGTH)
+
+    cipher = ChaCha20_Poly1305.new(key=ticket_key, nonce=nonce)
+    sealed, tag = cipher.encrypt_and_digest(TICKET_EXPIRY.pack(int(time.time()) + lifetime) + secret)
+    return nonce + sealed + tag, secret
+
+
+def open_ticket(ticket_key, ticket):
+    # The secret inside a ticket, or None if it wasn't issued with this key or has expired
+    nonce = ticket[:TICKET_NONCE_LENGTH]
+    sealed = ticket[TICKET_NONCE_LENGTH:-TICKET_TAG_LENGTH]
+    tag = ticket[-TICKET_TAG_LENGTH:]
+
+    try:
+        plain_text = ChaCha20_Poly1305.new(key=ticket_key, nonce=nonce).decrypt_and_verify(sealed, tag)
+    except ValueError:
+        return None
+
+    if len(plain_text) <= TICKET_EXPIRY.size or TICKET_EXPIRY.unpack_from(plain_text)[0] < time.time():
+        return None
+    return plain_text[TICKET_EXPIRY.size:]
+
+
+def resume(random, ticket=b''):
+    return RESUME + random + ticket
+
+
+def is_resume(data):
+    return data is not None and data.startswith(RESUME) and len(data) >= len(RESUME) + RANDOM_LENGTH
+
+
+def resume_fields(data):
+    # Returns (random, ticket), the server's reply carries no ticket
+    body = data[len(RESUME):]
+    return body[:RANDOM_LENGTH], body[RANDOM_LENGTH:]
+
+
+def resume_keys(secret, client_random, server_random, key_length=Constants.AES_KEY_LENGTH):
+    # Returns (client_aes_key, server_aes_key). Both randoms go in so every resumption gets keys of its own
+    client_aes_key, server_aes_key = HKDF(secret, key_length, client_random + server_random, SHA256, num_keys=2,
+                                          context=RESUME_CONTEXT)
+    return client_aes_key, server_aes_key
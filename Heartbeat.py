@@ -0,0 +1,61 @@
+# Liveness for one link: pings on an interval, measures the round trip and notices when the peer goes quiet
+
+import Constants
+
+import time
+
+
+class Heartbeat:
+    # Slots keep this small, the relay holds one for every connection
+
+    __slots__ = ('interval', 'timeout', 'enabled', 'lastReceived', 'lastPing', 'rtt', 'srtt')
+
+    def __init__(self, interval=Constants.HEARTBEAT_INTERVAL, timeout=Constants.IDLE_TIMEOUT):
+
+        # Seconds between pings and how long the peer may stay silent before the link is considered dead
+        self.interval = interval
+        self.timeout = timeout
+
+        # Only peers that advertise heartbeats answer pings, older ones are never evicted for being quiet
+        self.enabled = False
+
+        now = time.monotonic()
+        self.lastReceived = now
+        self.lastPing = now
+
+        # Latest round trip and a smoothed one like TCP's SRTT (Seconds), None until the first pong
+        self.rtt = None
+        self.srtt = None
+
+    def received(self):
+        # Any traffic from the peer counts as a sign of life
+        self.lastReceived = time.monotonic()
+
+    def ping(self):
+        # Data for a ping when one is due, otherwise None
+        now = time.monotonic()
+        if not self.enabled or now - self.lastPing < self.interval:
+            return None
+
+        self.lastPing = now
+        return {'ping': now}
+
+    def timeUntilDue(self):
+        # Seconds until the next ping, None when pings are off
+        if not self.enabled:
+            return None
+        return max(self.lastPing + self.interval - time.monotonic(), 0)
+
+    def handle(self, data):
+        # Returns the reply for a ping, pongs carry our own timestamp back and give a round trip sample
+        if 'ping' in data:
+            return {'pong': data['ping']}
+
+        sent = data.get('pong')
+        if isinstance(sent, (int, float)) and sent <= time.monotonic():
+            self.rtt = time.monotonic() - sent
+            self.srtt = self.rtt if self.srtt is None else self.srtt * 7 / 8 + self.rtt / 8
+        return None
+
+    def idle(self):
+        return self.enabled and time.monotonic() - self.lastReceived > self.timeout
@@ -0,0 +1,135 @@
+# Chat history behind the output view, only the newest lines stay in memory
+# Older lines are written out in pages to a temporary file that disappears when it is closed. Pages are
+# encrypted under a key that only lives in memory, so what is left on disk can't be read back by anyone else
+# Lines are numbered from the start of the conversation, the view asks for them by number as it scrolls
+
+import Constants
+
+import json
+import tempfile
+import time
+import zlib
+
+from collections import deque, OrderedDict
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+# Pages kept decrypted for scrolling back and forth over the same stretch
+CACHED_PAGES = 8
+
+
+class History:
+
+    def __init__(self, capacity=Constants.HISTORY_LINES, pageLines=Constants.HISTORY_PAGE_LINES):
+        # Lines held in memory, once there are more than capacity the oldest pageLines go to disk as one page
+        self.capacity = capacity
+        self.pageLines = pageLines
+
+        self.recent = deque()
+
+        # (offset, length) of every page written so far, page i holds lines i * pageLines up to the next page
+        self.pages = []
+        self.cache = OrderedDict()
+
+        self.key = get_random_bytes(Constants.AES_KEY_LENGTH)
+        self.file = None
+
+    def __len__(self):
+        return len(self.pages) * self.pageLines + len(self.recent)
+
+    def append(self, lines):
+        self.recent.extend(lines)
+
+        while len(self.recent) > self.capacity:
+            self.spill([self.recent.popleft() for _ in range(self.pageLines)])
+
+    def line(self, index):
+        # Any line still held, recent lines come from memory and older ones a page at a time from disk
+        spilled = len(self.pages) * self.pageLines
+        if index >= spilled:
+            return self.recent[index - spilled]
+
+        page, offset = divmod(index, self.pageLines)
+        return self.page(page)[offset]
+
+    def spill(self, lines):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+
+        plain_text = zlib.compress(json.dumps(lines).encode())
+        aes_cipher = AES.new(self.key, AES.MODE_EAX, nonce=get_random_bytes(16), mac_len=16)
+        cipher_text, tag = aes_cipher.encrypt_and_digest(plain_text)
+
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        self.file.write(aes_cipher.nonce + tag + cipher_text)
+        self.pages.append((offset, 32 + len(cipher_text)))
+
+    def page(self, number):
+        if number in self.cache:
+            self.cache.move_to_end(number)
+            return self.cache[number]
+
+        offset, length = self.pages[number]
+        self.file.seek(offset)
+        data = self.file.read(length)
+
+        aes_cipher = AES.new(self.key, AES.MODE_EAX, nonce=data[:16], mac_len=16)
+        lines = json.loads(zlib.decompress(aes_cipher.decrypt_and_verify(data[32:], data[16:32])))
+
+        self.cache[number] = lines
+        if len(self.cache) > CACHED_PAGES:
+            self.cache.popitem(last=False)
+        return lines
+
+    def clear(self):
+        # Forget everything, the file is dropped too so nothing from this conversation stays on disk
+        self.recent.clear()
+        self.pages = []
+        self.cache.clear()
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class LogHistory:
+    # Read only view of a conversation kept in the MessageLog, one line per message
+    # Messages are read from the log a page at a time as the view scrolls, however long the conversation is
+
+    def __init__(self, conversation, pageLines=Constants.HISTORY_PAGE_LINES):
+        self.conversation = conversation
+        self.pageLines = pageLines
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.conversation)
+
+    def line(self, index):
+        page, offset = divmod(index, self.pageLines)
+
+        # The last page may have been read before the conversation grew, it is read again once a line is missing
+        lines = self.cache.get(page)
+        if lines is None or offset >= len(lines):
+            lines = [self.format(record) for record in
+                     self.conversation.page(page * self.pageLines, self.pageLines)]
+            self.cache[page] = lines
+            if len(self.cache) > CACHED_PAGES:
+                self.cache.popitem(last=False)
+
+        self.cache.move_to_end(page)
+        return lines[offset] if offset < len(lines) else ''
+
+    def format(self, record):
+        number, stamp, sender, text = record
+        return "%s  %s: %s" % (time.strftime('%Y-%m-%d %H:%M', time.localtime(stamp)), sender,
+                               text.replace("\n", " "))
+
+    def clear(self):
+        self.cache.clear()
+
+    def close(self):
+        self.cache.clear()
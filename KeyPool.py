@@ -0,0 +1,147 @@
+import Constants
+
+import logging
+import multiprocessing
+import threading
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from Crypto.PublicKey import RSA
+
+logger = logging.getLogger('secure_talk.key_pool')
+
+
+def generate_key(key_length):
+    # Runs in a worker process, the key crosses back to the parent as DER
+    return RSA.generate(key_length).export_key('DER')
+
+
+class KeyPool:
+
+    def __init__(self, key_length=Constants.RSA_KEY_LENGTH, size=Constants.KEY_POOL_SIZE,
+                 watermark=Constants.KEY_POOL_WATERMARK, workers=Constants.KEY_POOL_WORKERS):
+
+        # In Bytes
+        self.RSA_KEY_LENGTH = key_length
+
+        # Keys kept ready and the level at which the pool is topped back up to size
+        self.size = size
+        self.watermark = watermark
+        self.workers = workers
+
+        self.keys = deque()
+        self.pending = 0  # Keys being generated by the workers
+        self.lock = threading.Lock()
+
+        # Metrics, a miss means a handshake had to generate its own key inline
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+        self.executor = None
+
+    def start(self):
+        self.lock.acquire()
+        if self.executor is None:
+            # Spawned rather than forked, a pool started with connections open would keep their sockets in the workers
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        self.lock.release()
+
+        self.refill()
+        return self
+
+    def refill(self):
+        self.lock.acquire()
+
+        if self.executor is None:
+            self.lock.release()
+            return
+
+        needed = self.size - len(self.keys) - self.pending
+        self.pending += max(needed, 0)
+        self.lock.release()
+
+        for _ in range(needed):
+            self.executor.submit(generate_key, self.RSA_KEY_LENGTH).add_done_callback(self.keyReady)
+
+    def keyReady(self, future):
+        # Called on the executor's thread once a worker is done, or right away for keys dropped by close
+        if future.cancelled():
+            self.lock.acquire()
+            self.pending -= 1
+            self.lock.release()
+            return
+
+        try:
+            key = RSA.import_key(future.result())
+        except Exception as e:
+            key = None
+            logger.error('Key generation failed: %s', e)
+
+        self.lock.acquire()
+        self.pending -= 1
+        if key is None:
+            self.failures += 1
+        else:
+            self.keys.append(key)
+        self.lock.release()
+
+    def take(self):
+        # Returns a private key for one handshake, keys are never handed out twice
+        if self.executor is None:
+            self.start()
+
+        self.lock.acquire()
+        if self.keys:
+            key = self.keys.popleft()
+            self.hits += 1
+        else:
+            key = None
+            self.misses += 1
+        low = len(self.keys) + self.pending <= self.watermark
+        self.lock.release()
+
+        if low:
+            self.refill()
+
+        if key is None:
+            key = RSA.generate(self.RSA_KEY_LENGTH)
+
+        return key
+
+    def metrics(self):
+        self.lock.acquire()
+        metrics = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'failures': self.failures,
+            'available': len(self.keys),
+            'pending': self.pending,
+            'size': self.size,
+            'watermark': self.watermark,
+        }
+        self.lock.release()
+        return metrics
+
+    def close(self):
+        # Keys not started yet are dropped, the ones under way finish in the background without holding up the caller
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+# One pool per process shared by every connection
+sharedPool = None
+sharedLock = threading.Lock()
+
+
+def shared():
+    global sharedPool
+
+    sharedLock.acquire()
+    if sharedPool is None:
+        sharedPool = KeyPool()
+    sharedLock.release()
+
+    return sharedPool
@@ -0,0 +1,324 @@
+# End to end load test, Server and Client pairs talking over loopback inside this process
+# Measures handshake latency, messages per second, bytes and CPU per message and memory per session across
+# message sizes and numbers of concurrent sessions, then writes it all to a JSON file for comparing runs
+# "python LoadTest.py" runs the default matrix, "python LoadTest.py --help" lists what can be changed
+# Needs Linux for the memory figures. Runs offline, the public IP lookup is stubbed out
+
+import Client
+import Constants
+import ExternalIP
+import KeyPool
+import Metrics
+import Server
+
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# Message sizes in characters and how many sessions run at once
+SIZES = (16, 256, 4096, 65536)
+CONCURRENCY = (1, 4, 16)
+HANDSHAKES = (Constants.X25519_HANDSHAKE, Constants.RSA_HANDSHAKE)
+
+# Messages each client sends per size, cut down for large sizes so a step moves at most BUDGET bytes
+MESSAGES = 2000
+BUDGET = 64 * 1024 * 1024
+
+# Seconds to wait for sessions to come up and for messages to arrive before giving up on a step
+TIMEOUT = 60
+
+# Stand-in for the public IP lookup, from the range reserved for documentation
+STUB_IP = '192.0.2.1'
+
+
+def percentiles(values):
+    # Exact figures from the raw values, the metrics histograms only know which bucket a value fell in
+    if not values:
+        return None
+
+    ordered = sorted(values)
+
+    def at(fraction):
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'min': ordered[0],
+        'p50': at(.5),
+        'p90': at(.9),
+        'p99': at(.99),
+        'max': ordered[-1],
+    }
+
+
+def rss():
+    # Resident memory of this process in bytes
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def revision():
+    # The commit being measured, so results can be lined up against history
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=5,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def mean(metrics, name):
+    # Exact mean of one histogram across connections, sum and count are kept as is
+    count = sum(m.histograms[name].count for m in metrics if name in m.histograms)
+    total = sum(m.histograms[name].sum for m in metrics if name in m.histograms)
+    return total / count if count else None
+
+
+class Pair:
+    # One Server and the Client connected to it, the server counts the messages it is handed
+
+    def __init__(self, handshake, keyLength):
+        self.delivered = 0
+
+        self.server = Server.Server(server_addr=('127.0.0.1', 0))
+        self.server.RSA_KEY_LENGTH = keyLength
+        self.server.displayListener = self.received
+        self.server.start()
+
+        self.handshake = handshake
+        self.keyLength = keyLength
+        self.client = None
+
+    def received(self, handle):
+        # Runs on the server's thread, draining right away keeps flow control credit going back to the client
+        for msg in handle.drainDisplay():
+            if isinstance(msg, str) and msg.startswith(handle.identifier):
+                self.delivered += 1
+
+    def connect(self):
+        # The server picks its own port, wait for it to be bound before pointing the client at it
+        while self.server.server_addr[1] == 0:
+            time.sleep(.001)
+
+        self.client = Client.Client(server_addr=self.server.server_addr)
+        self.client.HANDSHAKE_MODE = self.handshake
+        self.client.RSA_KEY_LENGTH = self.keyLength
+        self.client.displayListener = lambda handle: handle.drainDisplay()
+        self.client.start()
+
+    def ready(self):
+        # Both ends have keys and know each other's window, anything sent now is measured as traffic
+        return all(end.readyToTransmit and end.credit is not None for end in (self.server, self.client))
+
+    def close(self):
+        for end in (self.client, self.server):
+            if end is not None:
+                end.exit()
+
+    def join(self):
+        for end in (self.client, self.server):
+            if end is not None:
+                end.join(TIMEOUT)
+
+
+def waitFor(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(.001)
+
+
+def prepareKeys(keyLength, count, workers):
+    # RSA handshakes take keys from the shared pool, filling it first keeps key generation out of the timings
+    # the same way a long running server has its pool full before anyone connects
+    if KeyPool.sharedPool is not None:
+        KeyPool.sharedPool.close()
+    KeyPool.sharedPool = KeyPool.KeyPool(key_length=keyLength, size=count, watermark=0, workers=workers).start()
+
+    start = time.perf_counter()
+    while KeyPool.sharedPool.metrics()['available'] < count:
+        time.sleep(.05)
+    return time.perf_counter() - start
+
+
+def sendAll(pairs, text, messages):
+    # Keeps every client's send queue topped up, addToSend refuses once a queue is full
+    remaining = [messages] * len(pairs)
+    while any(remaining):
+        progress = False
+        for i, pair in enumerate(pairs):
+            while remaining[i] and pair.client.addToSend(text):
+                remaining[i] -= 1
+                progress = True
+        if not progress:
+            time.sleep(.0005)
+
+
+def runStep(pairs, size, messages):
+    clients = [pair.client.metrics for pair in pairs]
+    servers = [pair.server.metrics for pair in pairs]
+    for metrics in clients + servers:
+        metrics.reset()
+    for pair in pairs:
+        pair.delivered = 0
+
+    # Random text, a repeated character would compress to almost nothing and flatter bytes per message
+    text = base64.b64encode(os.urandom(size))[:size].decode()
+    total = messages * len(pairs)
+
+    gc.collect()
+    cpu = time.process_time()
+    start = time.perf_counter()
+
+    sendAll(pairs, text, messages)
+    waitFor(lambda: sum(pair.delivered for pair in pairs) >= total)
+
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    bytesOut = sum(metrics.counters.get('bytes_out', 0) for metrics in clients)
+
+    return {
+        'size': size,
+        'messages': total,
+        'seconds': elapsed,
+        'messages_per_second': total / elapsed,
+        'bytes_per_message': bytesOut / total,
+        'megabytes_per_second': bytesOut / elapsed / 1e6,
+        # Both ends and the load generator share this process, so this is the cost of a message end to end
+        'cpu_us_per_message': cpu / total * 1e6,
+        'seal_us': (mean(clients, 'seal_seconds') or 0) * 1e6,
+        'unseal_us': (mean(servers, 'unseal_seconds') or 0) * 1e6,
+        'flow_blocked': sum(metrics.counters.get('flow_blocked', 0) for metrics in clients),
+    }
+
+
+def runLevel(handshake, concurrency, sizes, config):
+    # Tickets from an earlier level would turn these into resumes, every handshake here is a full one
+    Client.tickets.clear()
+
+    if handshake == Constants.RSA_HANDSHAKE:
+        keyTime = prepareKeys(config.key_length, concurrency * 2, config.workers)
+        print("   %d RSA keys ready in %.1f s" % (concurrency * 2, keyTime))
+
+    gc.collect()
+    memory = rss()
+
+    pairs = [Pair(handshake, config.key_length) for _ in range(concurrency)]
+    try:
+        start = time.perf_counter()
+        for pair in pairs:
+            pair.connect()
+        waitFor(lambda: all(pair.ready() for pair in pairs))
+        setup = time.perf_counter() - start
+
+        gc.collect()
+        result = {
+            'handshake': handshake,
+            'concurrency': concurrency,
+            'setup_seconds': setup,
+            'handshake_seconds': percentiles([pair.client.metrics.histograms['handshake_seconds'].sum
+                                              for pair in pairs]),
+            'key_exchange_seconds': percentiles([pair.client.metrics.histograms['handshake_key_exchange_seconds'].sum
+                                                 for pair in pairs]),
+            'server_handshake_seconds': percentiles([pair.server.metrics.histograms['handshake_seconds'].sum
+                                                     for pair in pairs]),
+            # Both ends of a session, the server and client threads with their sockets and queues
+            'memory_per_session_bytes': (rss() - memory) / concurrency,
+            'sizes': [],
+        }
+        print("   handshake p50 %.2f ms  p99 %.2f ms  memory %.0f KiB per session" % (
+            result['handshake_seconds']['p50'] * 1e3, result['handshake_seconds']['p99'] * 1e3,
+            result['memory_per_session_bytes'] / 1024))
+
+        print("   %8s %10s %12s %10s %12s %10s %10s" % ('size', 'messages', 'msgs/s', 'B/msg', 'cpu us/msg',
+                                                       'seal us', 'unseal us'))
+        for size in sizes:
+            messages = max(min(config.messages, config.budget // (size * concurrency)), 10)
+            step = runStep(pairs, size, messages)
+            result['sizes'].append(step)
+            print("   %8d %10d %12.0f %10.1f %12.1f %10.1f %10.1f" % (
+                size, step['messages'], step['messages_per_second'], step['bytes_per_message'],
+                step['cpu_us_per_message'], step['seal_us'], step['unseal_us']))
+
+    finally:
+        for pair in pairs:
+            pair.close()
+        for pair in pairs:
+            pair.join()
+
+    return result
+
+
+def parse(argv=None):
+    def numbers(text):
+        return [int(number) for number in text.split(',')]
+
+    parser = argparse.ArgumentParser(description='End to end load test for Server and Client over loopback')
+    parser.add_argument('--output', default='loadtest.json', help='Where the JSON results go')
+    parser.add_argument('--sizes', type=numbers, default=list(SIZES), help='Message sizes, e.g. 16,4096')
+    parser.add_argument('--concurrency', type=numbers, default=list(CONCURRENCY),
+                        help='Sessions running at once, e.g. 1,8')
+    parser.add_argument('--handshakes', type=lambda text: text.split(','), default=list(HANDSHAKES),
+                        help=', '.join(HANDSHAKES))
+    parser.add_argument('--messages', type=int, default=MESSAGES, help='Messages per client for each size')
+    parser.add_argument('--budget', type=int, default=BUDGET, help='Most bytes sent for one size and level')
+    parser.add_argument('--key-length', type=int, default=Constants.RSA_KEY_LENGTH, dest='key_length',
+                        help='RSA key length for RSA handshakes')
+    parser.add_argument('--workers', type=int, default=Constants.KEY_POOL_WORKERS,
+                        help='Processes generating RSA keys before each RSA level')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    config = parse(argv)
+
+    # Nothing here should leave the machine
+    ExternalIP.shared().resolver = lambda: STUB_IP
+    ExternalIP.shared().cachePath = None
+
+    Metrics.enable()
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {
+            'sizes': config.sizes,
+            'concurrency': config.concurrency,
+            'handshakes': config.handshakes,
+            'messages': config.messages,
+            'budget': config.budget,
+            'key_length': config.key_length,
+            'flow_window': Constants.FLOW_WINDOW,
+            'send_queue_limit': Constants.SEND_QUEUE_LIMIT,
+        },
+        'runs': [],
+    }
+
+    try:
+        for handshake in config.handshakes:
+            for concurrency in config.concurrency:
+                print("== %s, %d sessions ==" % (handshake, concurrency))
+                results['runs'].append(runLevel(handshake, concurrency, config.sizes, config))
+    finally:
+        if KeyPool.sharedPool is not None:
+            KeyPool.sharedPool.close()
+
+    with open(config.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=2)
+    print("Results written to", config.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
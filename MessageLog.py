@@ -0,0 +1,444 @@
+# Encrypted history of every conversation, kept on disk across runs
+# Each conversation is a directory of append-only segments. Every record is sealed with AES-GCM on its own and bound
+# to its number, so records can't be swapped or moved between conversations unnoticed. A fixed width offset index
+# next to each segment finds any record without reading the ones before it, and every full segment gets an
+# encrypted inverted index of its words for searching
+# Appending only queues the message, a writer thread seals it and syncs to disk once per batch
+# Nothing in it can be read without the passphrase the history was started with
+
+import Constants
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from bisect import bisect_right
+from collections import OrderedDict
+
+from Crypto.Cipher import AES
+from Crypto.Protocol.KDF import scrypt
+from Crypto.Random import get_random_bytes
+
+logger = logging.getLogger('secure_talk.message_log')
+
+RECORD_PREFIX = struct.Struct('>I')
+INDEX_ENTRY = struct.Struct('>QI')  # Where a record's sealed data starts in its segment and how long it is
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+KEY_FILE = 'key'
+NAME_FILE = 'name'
+
+# Most messages written together before one sync
+BATCH_SIZE = 512
+
+# Inverted indexes of full segments kept decrypted between searches
+CACHED_INDEXES = 16
+
+WORD = re.compile(r'\w+')
+
+
+def words(text):
+    return set(WORD.findall(text.lower()))
+
+
+def seal(key, aad, plain_text):
+    aes_cipher = AES.new(key, AES.MODE_GCM, nonce=get_random_bytes(NONCE_SIZE), mac_len=TAG_SIZE)
+    aes_cipher.update(aad)
+    cipher_text, tag = aes_cipher.encrypt_and_digest(plain_text)
+    return aes_cipher.nonce + tag + cipher_text
+
+
+def unseal(key, aad, data):
+    aes_cipher = AES.new(key, AES.MODE_GCM, nonce=data[:NONCE_SIZE], mac_len=TAG_SIZE)
+    aes_cipher.update(aad)
+    return aes_cipher.decrypt_and_verify(data[NONCE_SIZE + TAG_SIZE:], data[NONCE_SIZE:NONCE_SIZE + TAG_SIZE])
+
+
+def passphraseKey(passphrase, salt):
+    return scrypt(passphrase, salt, Constants.AES_KEY_LENGTH, N=2 ** 15, r=8, p=1)
+
+
+def hasKey(directory=Constants.MESSAGE_LOG_DIR):
+    # Whether a history was started here, its passphrase was chosen then
+    return os.path.exists(os.path.join(directory, KEY_FILE))
+
+
+def loadKey(directory, passphrase):
+    # Records are sealed under a random key that only goes to disk wrapped under one derived from the passphrase,
+    # nothing kept next to the history opens it without the passphrase
+    if not passphrase:
+        raise ValueError('History needs a passphrase')
+
+    path = os.path.join(directory, KEY_FILE)
+    stored = {}
+    if os.path.exists(path):
+        with open(path) as keyFile:
+            stored = json.load(keyFile)
+
+    if 'wrapped' in stored:
+        try:
+            return unseal(passphraseKey(passphrase, bytes.fromhex(stored['salt'])), KEY_FILE.encode(),
+                          bytes.fromhex(stored['wrapped']))
+        except ValueError:
+            raise ValueError('Wrong passphrase for this history')
+
+    # A new history, or one kept by an older version with its key in the clear, which is wrapped from now on
+    key = bytes.fromhex(stored['key']) if 'key' in stored else get_random_bytes(Constants.AES_KEY_LENGTH)
+    salt = get_random_bytes(16)
+    stored = {'salt': salt.hex(), 'wrapped': seal(passphraseKey(passphrase, salt), KEY_FILE.encode(), key).hex()}
+
+    temporaryPath = path + '.tmp'
+    keyFile = os.open(temporaryPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(keyFile, 'w') as keyFile:
+        json.dump(stored, keyFile)
+        keyFile.flush()
+        os.fsync(keyFile.fileno())
+    os.replace(temporaryPath, path)
+
+    return key
+
+
+class Conversation:
+    # One session's records, numbered from 0. Only the writer thread appends, reads take the log's lock
+
+    def __init__(self, log, directory, name):
+        self.log = log
+        self.key = log.key
+        self.directory = directory
+        self.name = name
+
+        # Bound into every record so it only opens in this conversation
+        self.tag = os.path.basename(directory).encode()
+
+        # First record number of every segment, the segment's files are named after it
+        self.bases = sorted(int(fileName[:-4]) for fileName in os.listdir(directory) if fileName.endswith('.log'))
+        if not self.bases:
+            self.bases = [0]
+
+        # Open segment, the only one still written to
+        self.logFile = None
+        self.indexFile = None
+        self.size = 0
+        self.count = 0
+
+        # Words of the open segment, full segments keep theirs on disk
+        self.postings = {}
+        self.indexes = OrderedDict()
+
+        # Read handles by segment
+        self.readers = {}
+
+        self.recover()
+
+    def path(self, base, extension):
+        return os.path.join(self.directory, '%012d.%s' % (base, extension))
+
+    def aad(self, number):
+        return self.tag + struct.pack('>Q', number)
+
+    def wordsAad(self, base):
+        return self.tag + b'words' + struct.pack('>Q', base)
+
+    def recover(self):
+        # A crash can leave the open segment with a record the index doesn't have, or half an index entry
+        # Both are cut back to the last record that made it in whole
+        base = self.bases[-1]
+        self.logFile = open(self.path(base, 'log'), 'ab')
+        self.indexFile = open(self.path(base, 'idx'), 'ab')
+
+        logSize = os.path.getsize(self.path(base, 'log'))
+        with open(self.path(base, 'idx'), 'rb') as indexFile:
+            table = indexFile.read()
+        entries = list(INDEX_ENTRY.iter_unpack(table[:len(table) - len(table) % INDEX_ENTRY.size]))
+
+        while entries and entries[-1][0] + entries[-1][1] > logSize:
+            entries.pop()
+
+        self.size = entries[-1][0] + entries[-1][1] if entries else 0
+        self.logFile.truncate(self.size)
+        self.indexFile.truncate(len(entries) * INDEX_ENTRY.size)
+        self.count = base + len(entries)
+
+        # The open segment is at most one segment's worth, its words are rebuilt from the records
+        for number, (_, _, _, text) in enumerate(self.read(base, self.count), base):
+            for word in words(text):
+                self.postings.setdefault(word, []).append(number)
+
+        # A crash right after rolling over can leave the previous segment without its word index
+        for previous, following in zip(self.bases, self.bases[1:]):
+            if not os.path.exists(self.path(previous, 'words')):
+                postings = {}
+                for number, (_, _, _, text) in enumerate(self.read(previous, following), previous):
+                    for word in words(text):
+                        postings.setdefault(word, []).append(number)
+                self.saveWords(previous, postings)
+
+    def write(self, records):
+        # Writer thread only, the caller holds the lock and syncs afterwards
+        for stamp, sender, text in records:
+            if self.size >= self.log.segmentSize:
+                self.roll()
+
+            number = self.count
+            data = seal(self.key, self.aad(number), json.dumps([stamp, sender, text]).encode())
+
+            self.logFile.write(RECORD_PREFIX.pack(len(data)) + data)
+            self.indexFile.write(INDEX_ENTRY.pack(self.size + RECORD_PREFIX.size, len(data)))
+            self.size += RECORD_PREFIX.size + len(data)
+            self.count += 1
+
+            for word in words(text):
+                self.postings.setdefault(word, []).append(number)
+
+        # Readers use their own handles, they see everything written once it leaves our buffers
+        self.logFile.flush()
+        self.indexFile.flush()
+
+    def sync(self):
+        self.logFile.flush()
+        self.indexFile.flush()
+        os.fsync(self.logFile.fileno())
+        os.fsync(self.indexFile.fileno())
+
+    def roll(self):
+        # The open segment is full, it is synced and closed along with its words and a new one is started
+        self.sync()
+        self.logFile.close()
+        self.indexFile.close()
+
+        base = self.bases[-1]
+        self.saveWords(base, self.postings)
+        self.remember(base, self.postings)
+
+        self.bases.append(self.count)
+        self.logFile = open(self.path(self.count, 'log'), 'ab')
+        self.indexFile = open(self.path(self.count, 'idx'), 'ab')
+        self.size = 0
+        self.postings = {}
+
+    def saveWords(self, base, postings):
+        temporaryPath = self.path(base, 'words.tmp')
+        with open(temporaryPath, 'wb') as wordsFile:
+            wordsFile.write(seal(self.key, self.wordsAad(base), json.dumps(postings).encode()))
+            wordsFile.flush()
+            os.fsync(wordsFile.fileno())
+        os.replace(temporaryPath, self.path(base, 'words'))
+
+    def remember(self, base, postings):
+        self.indexes[base] = postings
+        self.indexes.move_to_end(base)
+        if len(self.indexes) > CACHED_INDEXES:
+            self.indexes.popitem(last=False)
+
+    def segmentWords(self, base):
+        if base == self.bases[-1]:
+            return self.postings
+
+        if base in self.indexes:
+            self.indexes.move_to_end(base)
+            return self.indexes[base]
+
+        with open(self.path(base, 'words'), 'rb') as wordsFile:
+            postings = json.loads(unseal(self.key, self.wordsAad(base), wordsFile.read()))
+        self.remember(base, postings)
+        return postings
+
+    def reader(self, base):
+        if base not in self.readers:
+            self.readers[base] = (open(self.path(base, 'log'), 'rb'), open(self.path(base, 'idx'), 'rb'))
+        return self.readers[base]
+
+    def read(self, start, stop):
+        # Records start up to stop as (number, time, sender, text), one index read per segment and one read per record
+        records = []
+        number = start
+        while number < stop:
+            i = bisect_right(self.bases, number) - 1
+            end = min(stop, self.bases[i + 1]) if i + 1 < len(self.bases) else stop
+            logFile, indexFile = self.reader(self.bases[i])
+
+            indexFile.seek((number - self.bases[i]) * INDEX_ENTRY.size)
+            for offset, length in INDEX_ENTRY.iter_unpack(indexFile.read((end - number) * INDEX_ENTRY.size)):
+                logFile.seek(offset)
+                stamp, sender, text = json.loads(unseal(self.key, self.aad(number), logFile.read(length)))
+                records.append((number, stamp, sender, text))
+                number += 1
+        return records
+
+    def append(self, sender, text):
+        # Never blocks, the writer thread picks it up
+        self.log.append(self, sender, text)
+
+    def __len__(self):
+        return self.count
+
+    def page(self, start, count):
+        # count records from start, what it costs depends on count and not on how long the history is
+        self.log.lock.acquire()
+        try:
+            return self.read(max(start, 0), min(start + count, self.count))
+        finally:
+            self.log.lock.release()
+
+    def last(self, count):
+        self.log.lock.acquire()
+        try:
+            return self.read(max(self.count - count, 0), self.count)
+        finally:
+            self.log.lock.release()
+
+    def search(self, query, limit=50):
+        # Records holding every word in query, newest first
+        wanted = words(query)
+        if not wanted:
+            return []
+
+        self.log.lock.acquire()
+        try:
+            found = []
+            for base in reversed(self.bases):
+                postings = self.segmentWords(base)
+                matches = [postings.get(word) for word in wanted]
+                if all(matches):
+                    found.extend(sorted(set.intersection(*map(set, matches)), reverse=True))
+                if len(found) >= limit:
+                    break
+
+            return [self.read(number, number + 1)[0] for number in found[:limit]]
+        finally:
+            self.log.lock.release()
+
+    def close(self):
+        for logFile, indexFile in self.readers.values():
+            logFile.close()
+            indexFile.close()
+        self.readers = {}
+        self.logFile.close()
+        self.indexFile.close()
+
+
+class MessageLog(threading.Thread):
+
+    def __init__(self, passphrase, directory=Constants.MESSAGE_LOG_DIR,
+                 segmentSize=Constants.MESSAGE_LOG_SEGMENT_SIZE, flushInterval=Constants.MESSAGE_LOG_FLUSH_INTERVAL):
+        super(MessageLog, self).__init__(daemon=True)
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.directory = directory
+        self.key = loadKey(directory, passphrase)
+
+        # Segments roll over once they reach segmentSize bytes, writes arriving within flushInterval share a sync
+        self.segmentSize = segmentSize
+        self.flushInterval = flushInterval
+
+        # (conversation, time, sender, text) waiting for the writer, None stops it
+        self.queue = queue.SimpleQueue()
+
+        # Held while records are written and while they are read back
+        self.lock = threading.RLock()
+        self.conversations = {}
+
+        # Metrics
+        self.written = 0
+        self.syncs = 0
+        self.failures = 0
+
+    def session(self, name):
+        # The conversation called name, created the first time. Directory names are keyed hashes so the
+        # names, which say who was talked to, stay inside the encryption
+        tag = hmac.new(self.key, name.encode(), hashlib.sha256).hexdigest()[:32]
+
+        self.lock.acquire()
+        try:
+            if tag not in self.conversations:
+                directory = os.path.join(self.directory, tag)
+                if not os.path.exists(os.path.join(directory, NAME_FILE)):
+                    os.makedirs(directory, mode=0o700, exist_ok=True)
+                    with open(os.path.join(directory, NAME_FILE), 'wb') as nameFile:
+                        nameFile.write(seal(self.key, tag.encode(), json.dumps([name, time.time()]).encode()))
+
+                self.conversations[tag] = Conversation(self, directory, name)
+            return self.conversations[tag]
+        finally:
+            self.lock.release()
+
+    def sessions(self):
+        # (started, name) of every conversation kept, newest first
+        found = []
+        for tag in os.listdir(self.directory):
+            try:
+                with open(os.path.join(self.directory, tag, NAME_FILE), 'rb') as nameFile:
+                    name, started = json.loads(unseal(self.key, tag.encode(), nameFile.read()))
+            except (OSError, ValueError):
+                continue
+            found.append((started, name))
+        return sorted(found, reverse=True)
+
+    def append(self, conversation, sender, text):
+        self.queue.put((conversation, time.time(), sender, text))
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            # Gather whatever else arrives shortly after so the whole burst costs one sync
+            batch = [item]
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self.write(batch)
+
+    def write(self, batch):
+        byConversation = {}
+        for conversation, stamp, sender, text in batch:
+            byConversation.setdefault(conversation, []).append((stamp, sender, text))
+
+        try:
+            self.lock.acquire()
+            try:
+                for conversation, records in byConversation.items():
+                    conversation.write(records)
+            finally:
+                self.lock.release()
+
+            # Readers don't need to wait for the disk, only for the data to be written
+            for conversation in byConversation:
+                conversation.sync()
+            self.written += len(batch)
+            self.syncs += 1
+
+        except OSError as e:
+            self.failures += 1
+            logger.error('Could not write the message log: %s', e)
+
+    def close(self, timeout=None):
+        # Everything queued so far is written and synced before the files are closed
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout)
+
+        self.lock.acquire()
+        for conversation in self.conversations.values():
+            conversation.close()
+        self.conversations = {}
+        self.lock.release()
@@ -0,0 +1,90 @@
+import threading
+
+from collections import deque
+
+
+class MessageQueue:
+    # deque append and popleft are atomic so producers and consumers never take a lock on the fast path
+    # Events are only touched to wake someone who is actually waiting
+
+    def __init__(self, highWater=None):
+        self.items = deque()
+
+        # Producers wait once this many items are queued, None means the queue is unbounded
+        self.highWater = highWater
+
+        # Set when items are available and when there is room below the high water mark
+        self.ready = threading.Event()
+        self.space = threading.Event()
+        self.space.set()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, timeout=None):
+        # Returns False if the queue stayed full for the whole timeout, timeout=0 never blocks
+        if self.highWater is not None and not self.waitForSpace(timeout):
+            return False
+
+        self.items.append(item)
+
+        if not self.ready.is_set():
+            self.ready.set()
+        return True
+
+    def putBack(self, items):
+        # Items that were taken but never went anywhere go back in front, oldest first
+        # They were let in once already so the high water mark doesn't apply
+        if items:
+            self.items.extendleft(reversed(items))
+            if not self.ready.is_set():
+                self.ready.set()
+
+    def get(self):
+        # Next item or None when empty
+        try:
+            item = self.items.popleft()
+        except IndexError:
+            return None
+
+        self.freeSpace()
+        return item
+
+    def drain(self, limit=None):
+        # Everything queued right now, or at most limit items, oldest first
+        drained = []
+        while limit is None or len(drained) < limit:
+            try:
+                drained.append(self.items.popleft())
+            except IndexError:
+                break
+
+        if drained:
+            self.freeSpace()
+        return drained
+
+    def wait(self, timeout=None):
+        # Block until something is queued, returns False on timeout
+        if self.items:
+            return True
+
+        # Clear then check again, an item added in between would otherwise be missed
+        self.ready.clear()
+        if self.items:
+            return True
+
+        return self.ready.wait(timeout)
+
+    def waitForSpace(self, timeout=None):
+        if len(self.items) < self.highWater:
+            return True
+
+        self.space.clear()
+        if len(self.items) < self.highWater:
+            return True
+
+        return self.space.wait(timeout) or len(self.items) < self.highWater
+
+    def freeSpace(self):
+        if self.highWater is not None and not self.space.is_set() and len(self.items) < self.highWater:
+            self.space.set()
@@ -0,0 +1,207 @@
+# Counters, gauges and histograms for seeing where time and bytes go under load
+# Every connection keeps its own, the registry adds them up. Callers check metrics.enabled first on hot paths
+# so a disabled instance costs one attribute lookup
+
+import Constants
+
+import bisect
+import itertools
+import json
+import threading
+import weakref
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds, doubling so a handful of buckets covers microseconds to seconds and bytes to MiB
+TIME_BUCKETS = tuple(1e-6 * 2 ** i for i in range(25))  # 1 us to about 17 s
+SIZE_BUCKETS = tuple(16 * 2 ** i for i in range(21))  # 16 B to 16 MiB
+COUNT_BUCKETS = tuple(2 ** i for i in range(17))  # 1 to 65536
+
+# Whether new Metrics record anything, enable() also switches on every existing one
+enabled = Constants.METRICS_ENABLED
+
+# Every live Metrics, snapshot() reports them one by one and in total
+registry = weakref.WeakSet()
+registryLock = threading.Lock()
+names = itertools.count(1)
+
+
+class Histogram:
+
+    __slots__ = ('bounds', 'buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+        # One bucket per bound plus one for anything larger
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket the percentile falls in, exact enough to tell microseconds from milliseconds
+        if not self.count:
+            return None
+
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(.5),
+            'p90': self.percentile(.9),
+            'p99': self.percentile(.99),
+        }
+
+
+class Metrics:
+
+    def __init__(self, name='connection', on=None):
+        # Numbered so several connections of the same kind stay apart in the snapshot
+        self.name = '%s-%d' % (name, next(names))
+        self.enabled = enabled if on is None else on
+
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+        registryLock.acquire()
+        registry.add(self)
+        registryLock.release()
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def observe(self, name, value, bounds=TIME_BUCKETS):
+        # bounds only matters the first time a name is seen
+        if self.enabled:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def reset(self):
+        # Start again from nothing, for measuring one phase of a run at a time
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def snapshot(self):
+        # Copies are taken in one step each, the owning thread may be updating them while we read
+        return {
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+            'histograms': {name: histogram.snapshot() for name, histogram in list(self.histograms.items())},
+        }
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+    registryLock.acquire()
+    for metrics in list(registry):
+        metrics.enabled = on
+    registryLock.release()
+
+
+def snapshot():
+    # Every connection's metrics and their sum, gauges are added up too so they read as totals
+    registryLock.acquire()
+    everything = sorted(registry, key=lambda metrics: metrics.name)
+    registryLock.release()
+
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for metrics in everything:
+        for name, value in list(metrics.counters.items()):
+            counters[name] = counters.get(name, 0) + value
+        for name, value in list(metrics.gauges.items()):
+            gauges[name] = gauges.get(name, 0) + value
+        for name, histogram in list(metrics.histograms.items()):
+            if name not in histograms:
+                histograms[name] = Histogram(histogram.bounds)
+            histograms[name].merge(histogram)
+
+    return {
+        'enabled': enabled,
+        'total': {
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': {name: histogram.snapshot() for name, histogram in histograms.items()},
+        },
+        'connections': {metrics.name: metrics.snapshot() for metrics in everything},
+    }
+
+
+def dump(path=None):
+    # The snapshot as JSON, written to path if one is given
+    text = json.dumps(snapshot(), indent=2, sort_keys=True)
+    if path is not None:
+        with open(path, 'w') as dumpFile:
+            dumpFile.write(text)
+    return text
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = dump().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out everything else on stdout
+        pass
+
+
+def serve(port=Constants.METRICS_PORT, host='127.0.0.1'):
+    # Pull endpoint, GET /metrics returns the JSON dump. Only listens locally unless told otherwise
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
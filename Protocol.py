@@ -0,0 +1,354 @@
+# Wire helpers shared by Server, Client and the asyncio Relay so every role frames and seals data the same way
+
+import File
+
+import json
+import lzma
+import struct
+import zlib
+
+from base64 import b64encode, b64decode
+from Crypto.Cipher import AES, ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+
+# Every frame on the socket starts with its length as a big endian unsigned int
+LENGTH_PREFIX = struct.Struct('>I')
+
+# What a broken or hostile frame raises on its way through framing, unsealing and decoding
+MALFORMED = (ValueError, struct.error, zlib.error, lzma.LZMAError)
+
+# Wire formats. JSON is understood by every peer, the binary ones are only used once the peer advertises them
+JSON_WIRE = 0
+BINARY_WIRE = 1  # EAX with a random nonce per message
+GCM_WIRE = 2  # AES-GCM with counter nonces from a SessionCipher
+CHACHA_WIRE = 3  # ChaCha20-Poly1305 with counter nonces from a SessionCipher
+GROUP_WIRE = 4  # ChaCha20-Poly1305 under a room's group key, only sent to the relay once in a room
+SUPPORTED_WIRES = (BINARY_WIRE, GCM_WIRE, CHACHA_WIRE)
+
+# Most preferred first, ChaCha20-Poly1305 has the cheapest setup per message (see Benchmark.py cipher)
+WIRE_PREFERENCE = (CHACHA_WIRE, GCM_WIRE, BINARY_WIRE)
+
+# Binary frame: version, command, flags, EAX nonce and MAC tag followed by the raw cipher text
+# The version, command and flags bytes are authenticated along with the cipher text
+BINARY_HEADER = struct.Struct('>BBB16s16s')
+FLAG_JSON_DATA = 0x01  # Data is not text and was serialized as JSON
+FLAG_RAW_DATA = 0x02  # Data is raw bytes
+FLAG_CODEC_SHIFT = 2  # Bits 2 and 3 hold the File codec the plain text was compressed with
+FLAG_CODEC_MASK = 0x03 << FLAG_CODEC_SHIFT
+
+# Session frame: version, command, flags and the message counter, all authenticated, then cipher text and tag
+SESSION_HEADER = struct.Struct('>BBBQ')
+SESSION_TAG_SIZE = 16
+
+# Counter AEADs run under a key derived from the traded one so it is never shared with the EAX formats
+SESSION_KEY_CONTEXT = b'Secure Talk session AEAD'
+
+# Group frame: version, command, flags, key epoch, sender's member id and its counter, then cipher text and tag
+# Members share the key so the nonce is the member id and counter, no two members ever use the same one
+GROUP_HEADER = struct.Struct('>BBBIIQ')
+
+
+def frame(data):
+    # Get length of data and prepend it so the receiver knows how much to read
+    return LENGTH_PREFIX.pack(len(data)) + data
+
+
+def frame_length(raw_data_len):
+    # Unpack the 4 byte length prefix into an integer
+    return LENGTH_PREFIX.unpack(raw_data_len)[0]
+
+
+def capabilities(codecs=File.CODECS, wires=SUPPORTED_WIRES, window=None):
+    # Sent to the peer right after the key trade so both sides can agree on a wire format and compression
+    # Advertising heartbeat promises to answer pings, only then will the peer drop us for going quiet
+    # Advertising a window promises to hand back credit, only then will the peer hold messages back for us
+    advertised = {'wire': list(wires), 'codecs': list(codecs), 'heartbeat': True}
+    if window is not None:
+        advertised['window'] = window
+    return advertised
+
+
+def choose_wire(peer_capabilities, wires=SUPPORTED_WIRES):
+    # Pick the preferred format both sides support, old peers never advertise so they stay on JSON
+    peer_wires = peer_capabilities.get('wire', ())
+    for wire in WIRE_PREFERENCE:
+        if wire in wires and wire in peer_wires:
+            return wire
+    return JSON_WIRE
+
+
+def choose_codecs(peer_capabilities, wires=SUPPORTED_WIRES, codecs=File.CODECS):
+    # Codecs both sides can decompress, compression is only used on the binary wires
+    if choose_wire(peer_capabilities, wires) == JSON_WIRE:
+        return []
+    return [codec for codec in codecs if codec in peer_capabilities.get('codecs', ())]
+
+
+def seal(aes_key, data, command, wire=JSON_WIRE, compressor=None):
+    if wire == BINARY_WIRE:
+        return seal_binary(aes_key, data, command, compressor)
+    return seal_json(aes_key, data, command)
+
+
+def unseal(aes_key, formatted_data):
+    # JSON envelopes always start with '{', anything else has to be a versioned binary frame
+    if formatted_data[:1] == b'{':
+        return unseal_json(aes_key, formatted_data)
+    return unseal_binary(aes_key, formatted_data)
+
+
+def seal_json(aes_key, data, command):
+
+    # Return random bytes for header and set up EAX mode with random 256 bit IV, MAC length 128 bits
+    header = get_random_bytes(16)
+    aes_cipher = AES.new(aes_key, AES.MODE_EAX, nonce=get_random_bytes(32), mac_len=16)
+
+    # Update EAX mode AES header
+    aes_cipher.update(header)
+
+    # Raw bytes such as file chunks can't go through JSON directly so they are base64'd and marked
+    envelope = {'com': command, 'data': data}
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        envelope['data'] = b64encode(data).decode('utf-8')
+        envelope['raw'] = True
+
+    data = json.dumps(envelope).encode()
+
+    # Encrypt the message. Returns the encrypted message with MAC tag to verify
+    cipher_text, tag = aes_cipher.encrypt_and_digest(data)
+
+    # json.dumps() returns dictionary as string and .encode() translates str to bytes
+    return json.dumps({
+        'nonce': b64encode(aes_cipher.nonce).decode('utf-8'),
+        'cipher_text': b64encode(cipher_text).decode('utf-8'),
+        'header': b64encode(header).decode('utf-8'),
+        'MAC': b64encode(tag).decode('utf-8')
+    }).encode()
+
+
+def unseal_json(aes_key, formatted_data):
+    # An envelope missing a field or shaped wrong is as broken as one that fails to open
+    try:
+        return open_json(aes_key, formatted_data)
+    except (KeyError, TypeError, IndexError, AttributeError) as e:
+        raise ValueError('Malformed JSON envelope: %r' % e)
+
+
+def open_json(aes_key, formatted_data):
+
+    # json can't parse straight out of a receive buffer view
+    datab64 = json.loads(bytes(formatted_data))
+
+    aes_cipher = AES.new(
+        aes_key,
+        AES.MODE_EAX,
+        nonce=b64decode(
+            datab64['nonce']
+        ))
+    aes_cipher.update(
+        b64decode(
+            datab64['header']
+        ))
+
+    cipher_text = b64decode(datab64['cipher_text'])
+    MAC = b64decode(datab64['MAC'])
+
+    data = json.loads(aes_cipher.decrypt_and_verify(cipher_text, MAC))
+
+    if data.get('raw'):
+        return {'command': data['com'], 'data': b64decode(data['data'])}
+
+    return {'command': data['com'], 'data': data['data']}
+
+
+def encode_data(data, compressor=None):
+    # Turns data into plain text bytes for the binary wires, returns the flags describing it
+    flags = 0
+    if isinstance(data, str):
+        plain_text = data.encode()
+    elif isinstance(data, (bytes, bytearray, memoryview)):
+        plain_text = data
+        flags |= FLAG_RAW_DATA
+    else:
+        plain_text = json.dumps(data).encode()
+        flags |= FLAG_JSON_DATA
+
+    # Compress before encrypting, cipher text never compresses
+    if compressor is not None:
+        codec, plain_text = compressor.compress(plain_text)
+        flags |= codec << FLAG_CODEC_SHIFT
+
+    return flags, plain_text
+
+
+def decode_data(flags, plain_text):
+    codec = (flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT
+    if codec:
+        plain_text = File.decompress(codec, plain_text)
+
+    if flags & FLAG_RAW_DATA:
+        return plain_text
+    if flags & FLAG_JSON_DATA:
+        return json.loads(plain_text)
+    return plain_text.decode()
+
+
+def seal_binary(aes_key, data, command, compressor=None):
+
+    # Commands are numeric strings below 256 so they fit in one byte
+    flags, plain_text = encode_data(data, compressor)
+    header = bytes((BINARY_WIRE, int(command), flags))
+
+    # Fresh 128 bit nonce per message, the header takes the place of the random EAX header
+    aes_cipher = AES.new(aes_key, AES.MODE_EAX, nonce=get_random_bytes(16), mac_len=16)
+    aes_cipher.update(header)
+    cipher_text, tag = aes_cipher.encrypt_and_digest(plain_text)
+
+    return header + aes_cipher.nonce + tag + cipher_text
+
+
+def unseal_binary(aes_key, formatted_data):
+
+    if len(formatted_data) < BINARY_HEADER.size:
+        raise ValueError('Frame of %d bytes is too short' % len(formatted_data))
+
+    version, command, flags, nonce, tag = BINARY_HEADER.unpack_from(formatted_data)
+    if version != BINARY_WIRE:
+        raise ValueError('Unsupported wire version %d' % version)
+
+    aes_cipher = AES.new(aes_key, AES.MODE_EAX, nonce=nonce, mac_len=16)
+    aes_cipher.update(formatted_data[:3])
+    plain_text = aes_cipher.decrypt_and_verify(formatted_data[BINARY_HEADER.size:], tag)
+
+    return {'command': str(command), 'data': decode_data(flags, plain_text)}
+
+
+class SessionCipher:
+    # Seals and opens every message under one traded key for the life of a session
+    # Counter AEAD nonces need no randomness and double as replay protection
+
+    def __init__(self, aes_key):
+        self.aes_key = aes_key
+        self.session_key = HKDF(aes_key, 32, b'', SHA256, context=SESSION_KEY_CONTEXT)
+
+        # Next counter to send and the last counter accepted from the peer
+        self.sent = 0
+        self.received = -1
+
+    def new(self, wire, counter):
+        # 96 bit nonce, the counter never repeats under this key
+        nonce = bytes(4) + counter.to_bytes(8, 'big')
+        if wire == CHACHA_WIRE:
+            return ChaCha20_Poly1305.new(key=self.session_key, nonce=nonce)
+        if wire == GCM_WIRE:
+            return AES.new(self.session_key, AES.MODE_GCM, nonce=nonce, mac_len=SESSION_TAG_SIZE)
+        raise ValueError('Unsupported wire version %d' % wire)
+
+    def seal(self, data, command, wire=JSON_WIRE, compressor=None):
+        if wire not in (GCM_WIRE, CHACHA_WIRE):
+            return seal(self.aes_key, data, command, wire, compressor)
+
+        flags, plain_text = encode_data(data, compressor)
+        header = SESSION_HEADER.pack(wire, int(command), flags, self.sent)
+
+        aead = self.new(wire, self.sent)
+        self.sent += 1
+
+        aead.update(header)
+        cipher_text, tag = aead.encrypt_and_digest(plain_text)
+
+        return header + cipher_text + tag
+
+    def unseal(self, formatted_data):
+        if not formatted_data:
+            raise ValueError('Empty frame')
+
+        wire = formatted_data[0]
+        if wire not in (GCM_WIRE, CHACHA_WIRE):
+            return unseal(self.aes_key, formatted_data)
+
+        if len(formatted_data) < SESSION_HEADER.size + SESSION_TAG_SIZE:
+            raise ValueError('Frame of %d bytes is too short' % len(formatted_data))
+
+        wire, command, flags, counter = SESSION_HEADER.unpack_from(formatted_data)
+
+        # Counters only ever go up, anything else is a replayed or reordered frame
+        if counter <= self.received:
+            raise ValueError('Replayed message %d' % counter)
+
+        aead = self.new(wire, counter)
+        aead.update(formatted_data[:SESSION_HEADER.size])
+        plain_text = aead.decrypt_and_verify(formatted_data[SESSION_HEADER.size:-SESSION_TAG_SIZE],
+                                             formatted_data[-SESSION_TAG_SIZE:])
+        self.received = counter
+
+        return {'command': str(command), 'data': decode_data(flags, plain_text)}
+
+
+def is_group(formatted_data):
+    return formatted_data[:1] == bytes((GROUP_WIRE,))
+
+
+def group_sender(formatted_data):
+    # (epoch, member) of a group frame, the relay checks these without decrypting anything
+    return GROUP_HEADER.unpack_from(formatted_data)[3:5]
+
+
+class GroupCipher:
+    # One key for everyone in a room, a message is sealed once and the same bytes go to every member
+    # A new GroupCipher replaces this one whenever the relay rotates the key
+
+    def __init__(self, group_key, epoch, member, previous=None):
+        self.group_key = group_key
+        self.epoch = epoch
+        self.member = member
+
+        # Messages sealed under the key before this one may still be in flight, they can be opened but not sent
+        self.previous = previous
+        if previous is not None:
+            previous.previous = None
+
+        # Next counter to send and the last counter accepted from each member
+        self.sent = 0
+        self.received = {}
+
+    def new(self, member, counter):
+        nonce = member.to_bytes(4, 'big') + counter.to_bytes(8, 'big')
+        return ChaCha20_Poly1305.new(key=self.group_key, nonce=nonce)
+
+    def seal(self, data, command, compressor=None):
+        flags, plain_text = encode_data(data, compressor)
+
+        header = GROUP_HEADER.pack(GROUP_WIRE, int(command), flags, self.epoch, self.member, self.sent)
+        aead = self.new(self.member, self.sent)
+        self.sent += 1
+
+        aead.update(header)
+        cipher_text, tag = aead.encrypt_and_digest(plain_text)
+        return header + cipher_text + tag
+
+    def unseal(self, formatted_data):
+        # Returns the message along with the member that sent it
+        if len(formatted_data) < GROUP_HEADER.size + SESSION_TAG_SIZE:
+            raise ValueError('Frame of %d bytes is too short' % len(formatted_data))
+
+        wire, command, flags, epoch, member, counter = GROUP_HEADER.unpack_from(formatted_data)
+
+        if epoch != self.epoch:
+            if self.previous is not None and epoch == self.previous.epoch:
+                return self.previous.unseal(formatted_data)
+            raise ValueError('Message under group key %d, current key is %d' % (epoch, self.epoch))
+
+        # Counters only go up per member, anything else is a replayed or reordered frame
+        if counter <= self.received.get(member, -1):
+            raise ValueError('Replayed group message %d from member %d' % (counter, member))
+
+        aead = self.new(member, counter)
+        aead.update(formatted_data[:GROUP_HEADER.size])
+        plain_text = aead.decrypt_and_verify(formatted_data[GROUP_HEADER.size:-SESSION_TAG_SIZE],
+                                             formatted_data[-SESSION_TAG_SIZE:])
+
+        self.received[member] = counter
+        return {'command': str(command), 'data': decode_data(flags, plain_text), 'member': member}
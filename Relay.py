@@ -0,0 +1,476 @@
+import Constants
+import Handshake
+import Heartbeat
+import KeyPool
+import Metrics
+import Protocol
+from Constants import SocketCommands
+
+import asyncio
+import logging
+import time
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+logger = logging.getLogger('secure_talk.relay')
+
+
+class RelayConnection:
+    # Slots keep the per connection footprint down when thousands of peers are connected
+    __slots__ = ('reader', 'writer', 'address', 'peer_aes_key', 'relay_aes_key', 'recv_cipher', 'send_cipher',
+                 'wire', 'partner', 'heartbeat', 'room', 'member', 'id')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+
+        # Key the peer encrypts with and key the relay encrypts with towards the peer
+        self.peer_aes_key = None
+        self.relay_aes_key = None
+
+        # Session ciphers for each direction, created once the keys are traded
+        self.recv_cipher = None
+        self.send_cipher = None
+
+        # Wire format the relay uses towards this peer
+        self.wire = Protocol.JSON_WIRE
+
+        # The connection this one is paired with
+        self.partner = None
+
+        # Liveness and round trip time, pings start once the peer advertises heartbeats
+        self.heartbeat = None
+
+        # Room this connection is in and its member id there, a connection is either paired or in a room
+        self.room = None
+        self.member = None
+
+        # Set by a sharded relay so other workers can refer to this connection
+        self.id = None
+
+
+class Room:
+    # Members share one group key that is replaced whenever someone joins or leaves
+
+    __slots__ = ('name', 'members', 'epoch', 'nextMember', 'joined', 'left', 'rotating')
+
+    def __init__(self, name):
+        self.name = name
+
+        # Member ids by connection, ids are never reused so nonces under the group key can't repeat
+        self.members = {}
+        self.nextMember = 0
+        self.epoch = 0
+
+        # Changes since the last rotation, several joins in a row share one rotation
+        self.joined = {}
+        self.left = []
+        self.rotating = False
+
+
+class Relay:
+
+    def __init__(self, server_addr=('', Constants.SERVER_PORT), keys=None,
+                 heartbeatInterval=Constants.HEARTBEAT_INTERVAL, idleTimeout=Constants.IDLE_TIMEOUT):
+
+        # In Bytes
+        self.RSA_KEY_LENGTH = Constants.RSA_KEY_LENGTH
+        self.AES_KEY_LENGTH = Constants.AES_KEY_LENGTH
+
+        # RSA keys are generated ahead of time by worker processes
+        # The pool only starts on the first RSA handshake, relays that only see X25519 never spawn the workers
+        self.keys = keys or KeyPool.KeyPool(size=Constants.RELAY_KEY_POOL_SIZE,
+                                            watermark=Constants.RELAY_KEY_POOL_WATERMARK)
+
+        # Address to run on
+        self.server_addr = server_addr
+
+        # Connection waiting for a partner, at most one peer is ever unpaired
+        self.waiting = None
+
+        # Every connection that finished the handshake
+        self.connections = set()
+
+        # Group chat rooms by name
+        self.rooms = {}
+
+        # Seconds between pings and how long a silent peer keeps its connection
+        self.HEARTBEAT_INTERVAL = heartbeatInterval
+        self.IDLE_TIMEOUT = idleTimeout
+
+        self.server = None
+        self.heartbeatTask = None
+
+        # One set for the whole relay, per connection metrics would be thousands of entries
+        self.metrics = Metrics.Metrics('relay')
+
+    async def start(self):
+        self.server = await self.listen()
+        self.heartbeatTask = asyncio.ensure_future(self.heartbeat())
+        return self.server
+
+    async def listen(self):
+        host, port = self.server_addr
+        return await asyncio.start_server(self.handle, host or None, port,
+                                          limit=Constants.RELAY_BUFFER_LIMIT, backlog=Constants.RELAY_BACKLOG)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def shutdown(self, timeout=Constants.DRAIN_TIMEOUT):
+        # Stop taking new peers, tell everyone connected and give what is buffered for them timeout seconds to
+        # go out before closing. Returns how many connections were closed
+        self.server.close()
+        if self.heartbeatTask is not None:
+            self.heartbeatTask.cancel()
+
+        connections = list(self.connections)
+        for conn in connections:
+            self.send_encrypted(conn, 'Relay is shutting down', SocketCommands.DISPLAY)
+
+        if connections:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(conn.writer.drain() for conn in connections),
+                                                      return_exceptions=True), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        # Closing wakes every connection's reader, handle() then cleans each of them up
+        for conn in connections:
+            conn.writer.close()
+
+        # Let the handlers finish on their own rather than being cancelled along with the event loop
+        deadline = time.monotonic() + 1
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(.01)
+
+        self.keys.close()
+        return len(connections)
+
+    async def handle(self, reader, writer):
+        conn = RelayConnection(reader, writer)
+
+        try:
+            # A peer that stalls partway through would otherwise hold on to its socket forever
+            await asyncio.wait_for(self.handshake(conn), Constants.HANDSHAKE_TIMEOUT)
+
+            conn.recv_cipher = Protocol.SessionCipher(conn.peer_aes_key)
+            conn.send_cipher = Protocol.SessionCipher(conn.relay_aes_key)
+            conn.heartbeat = Heartbeat.Heartbeat(self.HEARTBEAT_INTERVAL, self.IDLE_TIMEOUT)
+            self.connections.add(conn)
+            self.metrics.gauge('connections', len(self.connections))
+
+            # Peers are asked not to compress towards the relay, it would only be spending CPU to inflate it again
+            self.send_encrypted(conn, Protocol.capabilities(codecs=()), SocketCommands.CAPABILITIES)
+
+            self.pair(conn)
+            await self.forward(conn)
+
+        except asyncio.TimeoutError:
+            logger.warning('%s did not finish trading keys in %d seconds', conn.address, Constants.HANDSHAKE_TIMEOUT)
+            self.metrics.count('handshake_timeouts')
+
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.info('%s disconnected: %s', conn.address, e)
+            self.metrics.count('connection_errors')
+
+        except Protocol.MALFORMED + (KeyError, TypeError) as e:
+            # A frame that doesn't open or a request missing what it needs, the peer can't be followed any further
+            logger.warning('%s sent a malformed frame: %s', conn.address, e)
+            self.metrics.count('malformed_frames')
+
+        finally:
+            self.drop(conn)
+            writer.close()
+
+    async def handshake(self, conn):
+        # Newer clients open with an X25519 hello, older ones wait for the relay's RSA key
+        hello = await self.recv_hello(conn.reader)
+        start = time.perf_counter()
+
+        # The relay doesn't issue session tickets, a client trying to resume follows up with a normal hello
+        if Handshake.is_resume(hello):
+            self.send_to(conn, Handshake.RESUME_REJECTED)
+            hello = await self.recv_hello(conn.reader)
+
+        if Handshake.is_hello(hello):
+            self.setup_X25519(conn, hello)
+            await conn.writer.drain()
+            self.metrics.count('handshakes_x25519')
+        else:
+            await self.setup_AES(conn)
+            self.metrics.count('handshakes_rsa')
+        self.metrics.observe('handshake_seconds', time.perf_counter() - start)
+
+    async def recv_hello(self, reader):
+        try:
+            return await asyncio.wait_for(self.recv_from(reader), Constants.HELLO_WAIT)
+        except asyncio.TimeoutError:
+            return None
+
+    async def forward(self, conn):
+        while True:
+            formatted_data = await self.recv_from(conn.reader)
+
+            # Room messages are sealed under the group key and go out to every member as they are
+            if Protocol.is_group(formatted_data):
+                conn.heartbeat.received()
+                await self.broadcast(conn, formatted_data)
+                continue
+
+            data = conn.recv_cipher.unseal(formatted_data)
+            conn.heartbeat.received()
+
+            # Capabilities and heartbeats describe the link to the relay, not the conversation, never forward them
+            if data['command'] == SocketCommands.CAPABILITIES:
+                conn.wire = Protocol.choose_wire(data['data'])
+                conn.heartbeat.enabled = bool(data['data'].get('heartbeat'))
+                continue
+
+            if data['command'] == SocketCommands.HEARTBEAT:
+                reply = conn.heartbeat.handle(data['data'])
+                if reply is not None:
+                    self.send_encrypted(conn, reply, SocketCommands.HEARTBEAT)
+                continue
+
+            if data['command'] == SocketCommands.ROOM_JOIN:
+                self.join(conn, str(data['data']['room']))
+                continue
+
+            if data['command'] == SocketCommands.ROOM_LEAVE:
+                self.leave(conn)
+                self.send_encrypted(conn, {'room': data['data']['room'], 'key': None}, SocketCommands.GROUP_KEY)
+                self.pair(conn)
+                continue
+
+            partner = conn.partner
+            if partner is None:
+                self.send_encrypted(conn, 'No one is connected yet, message was not delivered', SocketCommands.DISPLAY)
+                continue
+
+            # Re-seal under the partner's key, draining the partner applies backpressure to this sender
+            self.send_encrypted(partner, data['data'], data['command'])
+            self.metrics.count('frames_forwarded')
+            try:
+                await partner.writer.drain()
+            except ConnectionError:
+                # Only the partner's session ends, aborting wakes its own task which cleans it up and unpairs us
+                self.metrics.count('forward_errors')
+                partner.writer.transport.abort()
+
+    async def heartbeat(self):
+        # Ping every peer that supports it and close the ones that went quiet, which frees their memory and socket
+        while True:
+            await asyncio.sleep(min(self.HEARTBEAT_INTERVAL, self.IDLE_TIMEOUT) / 4)
+
+            for conn in list(self.connections):
+                if conn.heartbeat.idle():
+                    logger.info('%s silent for %d seconds, closing', conn.address, self.IDLE_TIMEOUT)
+                    self.metrics.count('idle_evictions')
+                    # Aborting wakes the connection's reader, handle() then cleans it up
+                    conn.writer.transport.abort()
+                    continue
+
+                ping = conn.heartbeat.ping()
+                if ping is not None:
+                    self.send_encrypted(conn, ping, SocketCommands.HEARTBEAT)
+
+    def latencies(self):
+        # Smoothed round trip time in seconds for every peer that has answered a ping
+        return {conn.address: conn.heartbeat.srtt for conn in self.connections if conn.heartbeat.srtt is not None}
+
+    def pair(self, conn):
+        if self.waiting is None or self.waiting is conn:
+            self.waiting = conn
+            self.send_encrypted(conn, 'Waiting for someone to connect...', SocketCommands.DISPLAY)
+            return
+
+        partner = self.waiting
+        self.waiting = None
+
+        conn.partner = partner
+        partner.partner = conn
+
+        self.send_encrypted(conn, 'Connected to a peer through the relay', SocketCommands.DISPLAY)
+        self.send_encrypted(partner, 'Connected to a peer through the relay', SocketCommands.DISPLAY)
+
+    def drop(self, conn):
+        self.connections.discard(conn)
+        self.metrics.gauge('connections', len(self.connections))
+        self.leave(conn)
+        self.unpair(conn)
+
+    def unpair(self, conn):
+        if self.waiting is conn:
+            self.waiting = None
+
+        partner = conn.partner
+        conn.partner = None
+
+        # The remaining peer goes back to waiting for someone new
+        if partner is not None:
+            partner.partner = None
+            self.send_encrypted(partner, 'Peer disconnected', SocketCommands.DISPLAY)
+            self.pair(partner)
+
+    def join(self, conn, name):
+        self.leave(conn)
+        self.unpair(conn)
+
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name)
+            self.metrics.gauge('rooms', len(self.rooms))
+
+        conn.room = room
+        conn.member = room.nextMember
+        room.nextMember += 1
+        room.members[conn] = conn.member
+        room.joined[str(conn.member)] = '%s:%d' % conn.address[:2]
+        self.scheduleRotation(room)
+
+    def leave(self, conn):
+        room = conn.room
+        if room is None:
+            return
+
+        member = str(conn.member)
+        del room.members[conn]
+        conn.room = None
+        conn.member = None
+
+        # Someone who leaves before their join was announced is never announced at all
+        if room.joined.pop(member, None) is None:
+            room.left.append(member)
+        self.scheduleRotation(room)
+
+    def scheduleRotation(self, room):
+        # Everyone who joins or leaves during this pass of the event loop is covered by one new key
+        if not room.rotating:
+            room.rotating = True
+            asyncio.get_running_loop().call_soon(self.rotate, room)
+
+    def rotate(self, room):
+        room.rotating = False
+
+        if not room.members:
+            if self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+                self.metrics.gauge('rooms', len(self.rooms))
+            return
+
+        # A fresh key every time so whoever left can't read on and whoever joined can't read back
+        room.epoch += 1
+        key = get_random_bytes(self.AES_KEY_LENGTH).hex()
+        joined, left = room.joined, room.left
+        room.joined, room.left = {}, []
+        self.metrics.count('group_key_rotations')
+
+        # The key goes to each member over its own link, only changes in membership are sent along with it
+        for conn, member in room.members.items():
+            if str(member) in joined:
+                names = {str(other): '%s:%d' % peer.address[:2] for peer, other in room.members.items()}
+                changes = {'joined': names, 'left': []}
+            else:
+                changes = {'joined': joined, 'left': left}
+
+            self.send_encrypted(conn, dict(room=room.name, epoch=room.epoch, key=key, member=member, **changes),
+                                SocketCommands.GROUP_KEY)
+
+    async def broadcast(self, conn, formatted_data):
+        room = conn.room
+        if room is None:
+            return
+
+        # Only the current key and the one before it are accepted and members can only send as themselves
+        epoch, member = Protocol.group_sender(formatted_data)
+        if member != conn.member or epoch not in (room.epoch, room.epoch - 1):
+            self.metrics.count('group_frames_rejected')
+            return
+
+        self.metrics.observe('broadcast_members', len(room.members) - 1, Metrics.COUNT_BUCKETS)
+        self.metrics.count('frames_broadcast')
+        await self.fanout(conn, room.members, formatted_data)
+
+    async def fanout(self, conn, members, formatted_data):
+        # Framed once, every member other than the sender gets the same bytes
+        framed = Protocol.frame(formatted_data)
+        behind = []
+        sent = 0
+        for peer in members:
+            if peer is not conn:
+                peer.writer.write(framed)
+                sent += 1
+                if peer.writer.transport.get_write_buffer_size() > Constants.RELAY_BUFFER_LIMIT:
+                    behind.append(peer.writer.drain())
+        self.metrics.count('bytes_out', len(framed) * sent)
+
+        # Only members that are falling behind hold up the sender
+        if behind:
+            await asyncio.gather(*behind, return_exceptions=True)
+
+    def send_to(self, conn, data):
+        # Writes are buffered by the transport, callers drain when they can wait
+        conn.writer.write(Protocol.frame(data))
+        self.metrics.count('bytes_out', len(data) + 4)
+
+    async def recv_from(self, reader):
+        # Read message length and unpack it into an integer
+        data_len = Protocol.frame_length(await reader.readexactly(4))
+        if data_len > Constants.MAX_FRAME_SIZE:
+            raise ValueError('Frame of %d bytes is over the limit' % data_len)
+
+        # Read the message data
+        self.metrics.count('bytes_in', data_len + 4)
+        return await reader.readexactly(data_len)
+
+    def send_encrypted(self, conn, data, command: SocketCommands):
+        self.send_to(conn, conn.send_cipher.seal(data, command, conn.wire))
+
+    def setup_X25519(self, conn, hello):
+        # Key agreement takes about a millisecond so it runs right on the event loop
+        private_key, relay_public = Handshake.generate()
+        self.send_to(conn, Handshake.hello(relay_public))
+
+        client_public = Handshake.hello_key(hello)
+        conn.peer_aes_key, conn.relay_aes_key = Handshake.derive_keys(private_key, client_public,
+                                                                      client_public, relay_public)
+
+    async def setup_AES(self, conn):
+        loop = asyncio.get_running_loop()
+
+        # Taking a key is instant when the pool has one, an empty pool generates inline so keep it off the event loop
+        private_key = await loop.run_in_executor(None, self.keys.take)
+        conn.relay_aes_key = get_random_bytes(self.AES_KEY_LENGTH)
+
+        # Send relay's public RSA key to client
+        self.send_to(conn, private_key.publickey().export_key())
+        await conn.writer.drain()
+
+        # Receive client's public key and the client's AES key encrypted with ours
+        client_key = await self.recv_from(conn.reader)
+        encrypted_key = await self.recv_from(conn.reader)
+
+        # Every RSA step takes milliseconds with long keys, on the event loop that would stall every other peer
+        conn.peer_aes_key, reply = await loop.run_in_executor(None, self.trade_AES, private_key, client_key,
+                                                              encrypted_key, conn.relay_aes_key)
+
+        # Send relay's own AES key
+        self.send_to(conn, reply)
+        await conn.writer.drain()
+
+    def trade_AES(self, private_key, client_key, encrypted_key, relay_aes_key):
+        # Returns the client's AES key and the relay's encrypted for the client
+        peer_aes_key = PKCS1_OAEP.new(private_key).decrypt(encrypted_key)
+        client_rsa_cipher = PKCS1_OAEP.new(RSA.import_key(client_key))
+        return peer_aes_key, client_rsa_cipher.encrypt(relay_aes_key)
+
+
+if __name__ == "__main__":
+    asyncio.run(Relay().serve_forever())
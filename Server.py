@@ -1,327 +1,214 @@
-# Author: Rodrigo Graca
-
-import Constants
-from Constants import DisplayCommands, SocketCommands
-
-import json
-import socket
-import struct
-import time
-import threading
-import select
-
-from requests import get
-from base64 import b64encode, b64decode
-from Crypto.Cipher import AES
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
-
-# server_addr = (internal_IP, 65532)
-
-
-class Server(threading.Thread):
-
-    # TODO Put port in const file
-    def __init__(self, server_addr=('', 65532), recvTimeout=1, daemon=True):
-
-        # Getting the local address of the computer in the network
-        super(Server, self).__init__(daemon=daemon)
-        self.local_hostname = socket.gethostname()
-        self.internal_IP = socket.gethostbyname(self.local_hostname)
-
-        # TODO Find a use for this or get rid of
-        # Getting the external address of the network (Site may not always work)
-        # self.external_IP = get('https://api.ipify.org', timeout=10).text
-        self.external_IP = 'Disabled'
-
-        # Controls if the thread is functioning
-        self.running = True
-
-        # Program commands to run
-        self.commands = {SocketCommands.DISPLAY: self.displayText}
-
-        # What should be displayed as the user's name in 'output'
-        self.identifier = "Client: "
-
-        # In Bytes
-        self.RSA_KEY_LENGTH = Constants.RSA_KEY_LENGTH
-        self.AES_KEY_LENGTH = Constants.AES_KEY_LENGTH
-
-        # Server address to run on
-        self.server_addr = server_addr
-
-        # How long to wait for a response from the client before preforming other tasks
-        self.RECV_TIMEOUT = recvTimeout
-
-        # Write and read lists to allow easier threading
-        self.received = []  # Read
-        self.send = []  # Write
-
-        # Lock to prevent bleh to received list
-        self.recvLock = threading.Lock()
-        self.sendLock = threading.Lock()
-
-    def run(self):
-
-        self.addToDisplay(">>>RSA KEY LENGTH -> " + str(self.RSA_KEY_LENGTH) + " bytes<<<")
-        self.addToDisplay(">>>AES KEY LENGTH (EAX MODE) -> " + str(self.AES_KEY_LENGTH) + " bytes<<<")
-
-        # Setup socket for usage and bind to port
-        serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        serversock.bind(self.server_addr)
-
-        self.addToDisplay("Server on %s at Internal IP of: %s and External IP of: %s" % (
-            self.local_hostname, self.internal_IP, self.external_IP
-        ))
-
-        # TODO Use select to unblock these and apply running status
-        self.addToDisplay("Listening...")
-        # Wait for a connection
-        serversock.listen(1)
-
-        client, client_address = serversock.accept()
-        time.sleep(1)
-
-        self.addToDisplay('----------------------------------')
-        self.addToDisplay('Servicing client: ' + client_address[0])
-
-        self.addToDisplay('Creating RSA keys for connection')
-        private_key = RSA.generate(self.RSA_KEY_LENGTH)
-        rsa_cipher = PKCS1_OAEP.new(private_key)
-        self.addToDisplay('Keys and cipher created')
-
-        self.addToDisplay('Creating AES key for connection')
-        server_aes_key = get_random_bytes(self.AES_KEY_LENGTH)
-        self.addToDisplay('AES key created')
-
-        try:
-            self.addToDisplay("Trading keys...")
-            client_rsa_cipher, client_aes_key = self.setup_AES(client, private_key, rsa_cipher, server_aes_key)
-            self.addToDisplay("Keys traded!")
-
-            self.addToDisplay(DisplayCommands.clearOutput)
-
-            self.beginCommunication(client, client_aes_key, server_aes_key)
-
-        except socket.error as e:
-            self.addToDisplay('>>>Connection Error<<<')
-            print(e)
-
-            client.close()
-            self.exit()
-
-        serversock.close()
-
-    def beginCommunication(self, client, client_aes_key, server_aes_key):
-
-        # Wait however long the timeout is for a response in buffer
-        # Then continue executing code if none is found
-        while self.running:
-            ready = select.select([client], [], [], self.RECV_TIMEOUT)
-            if ready[0]:
-                data = self.recv_encrypted(client, client_aes_key)
-                print(data)
-                command = data['command']
-
-                # TODO Add change username command
-                # If the data refers to a command like 'change username' then execute that and don't display
-                if command in self.commands:
-                    self.commands[command](client, server_aes_key, data)
-                else:
-
-                    if data == b'':
-                        self.exit()
-                        break
-
-                    if data == b'Bro?':
-                        print(data)
-                        self.send_encrypted(client, server_aes_key, '<3', SocketCommands.DISPLAY)
-
-            else:
-                # print("No data")
-                pass
-
-            while self.getSendTotal() > 0:
-                msg = self.nextToSend()
-                self.send_encrypted(client, server_aes_key, msg, SocketCommands.DISPLAY)
-
-    def addToDisplay(self, msg):
-        self.recvLock.acquire()
-
-        self.received.append(msg)
-
-        self.recvLock.release()
-
-    def nextToDisplay(self):
-        self.recvLock.acquire()
-
-        if len(self.received) > 0:
-
-            toDisplay = self.received.pop(0)
-            self.recvLock.release()
-            return toDisplay
-        else:
-            self.recvLock.release()
-            return None
-
-    def getRecvTotal(self):
-        self.recvLock.acquire()
-
-        total = len(self.received)
-
-        self.recvLock.release()
-
-        return total
-
-    def addToSend(self, msg):
-        self.sendLock.acquire()
-
-        self.send.append(msg)
-
-        self.sendLock.release()
-
-    def nextToSend(self):
-        self.sendLock.acquire()
-
-        if len(self.send) > 0:
-
-            toSend = self.send.pop(0)
-            self.sendLock.release()
-            return toSend
-        else:
-            self.sendLock.release()
-            return None
-
-    def getSendTotal(self):
-        self.sendLock.acquire()
-
-        total = len(self.send)
-
-        self.sendLock.release()
-
-        return total
-
-    def displayText(self, client, server_aes_key, data):
-        # TODO Define different decoding like UTF-32
-
-        text = data['data']
-        self.addToDisplay(self.identifier + text)
-
-    def send_to(self, client, data):
-        # Get length of data and append so we can receive all data
-        length = struct.pack('>I', len(data))
-        formatted_data = length + data
-
-        try:
-            # Send data to server, str encoded as bytes
-            client.send(formatted_data)
-            return True
-        except Exception as e:
-            print(e)
-            return False
-
-    # TODO Make recv function for files based in chunk size rather than receiving all at once and keeping data in memory
-    def recv_all(self, client, len_bytes):
-        # Helper function to receive number bytes or return None if EOF is hit
-        data = b''
-        while len(data) < len_bytes:
-            packet = client.recv(len_bytes - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
-
-    def recv_from(self, client):
-        # Read message length and unpack it into an integer
-        raw_data_len = self.recv_all(client, 4)
-        if not raw_data_len:
-            return None
-        data_len = struct.unpack('>I', raw_data_len)[0]
-        # Read the message data
-        return self.recv_all(client, data_len)
-
-    def recv_encrypted(self, client, client_aes_key):
-
-        formatted_data = self.recv_from(client)
-
-        if formatted_data is None:
-            return b''
-
-        datab64 = json.loads(formatted_data)
-
-        client_aes_cipher = AES.new(
-            client_aes_key,
-            AES.MODE_EAX,
-            nonce=b64decode(
-                datab64['nonce']
-            ))
-        client_aes_cipher.update(
-            b64decode(
-                datab64['header']
-            ))
-
-        cipher_text = b64decode(datab64['cipher_text'])
-        MAC = b64decode(datab64['MAC'])
-
-        data = json.loads(client_aes_cipher.decrypt_and_verify(cipher_text, MAC))
-
-        result = {'command': data['com'], 'data': data['data']}
-
-        return result
-
-    def send_encrypted(self, client, server_aes_key, data, command: SocketCommands):
-
-        # Return random bytes for header and set up EAX mode with random 256 bit IV, MAC length 128 bits
-        header = get_random_bytes(16)
-        client_aes_cipher = AES.new(server_aes_key, AES.MODE_EAX, nonce=get_random_bytes(32), mac_len=16)
-
-        # Update EAX mode AES header
-        client_aes_cipher.update(header)
-
-        data = json.dumps({
-            'com': command,
-            'data': data
-        }).encode()
-
-        # Encrypt the message. Returns the encrypted message with MAC tag to verify
-        cipher_text, tag = client_aes_cipher.encrypt_and_digest(data)
-
-        # json.dumps() returns dictionary as string and .encode() translates str to bytes
-        cipher_json = json.dumps({
-            'nonce': b64encode(client_aes_cipher.nonce).decode('utf-8'),
-            'cipher_text': b64encode(cipher_text).decode('utf-8'),
-            'header': b64encode(header).decode('utf-8'),
-            'MAC': b64encode(tag).decode('utf-8')
-        }).encode()
-
-        # Send to the server and return success
-        return self.send_to(client, cipher_json)
-
-    def sendFile(self, filePath):
-        pass
-
-    def setup_AES(self, client, server_key, server_rsa_cipher, server_aes_key):
-        # Send server's public RSA key to client
-        self.send_to(client, server_key.publickey().export_key())
-
-        # Receive client's public key, we can now communicate without jeopardizing the AES keys
-        client_public = self.recv_from(client)
-
-        # Setup public key RSA cipher to encrypt messages
-        client_key = RSA.import_key(client_public)
-        client_rsa_cipher = PKCS1_OAEP.new(client_key)
-
-        # Receive the client's AES key
-        client_aes_key = server_rsa_cipher.decrypt(self.recv_from(client))
-
-        # Send server's own AES key
-        self.send_to(client, client_rsa_cipher.encrypt(server_aes_key))
-
-        return client_rsa_cipher, client_aes_key
-
-    def exit(self):
-        self.running = False
-
-    def isRunning(self):
-        return self.running
+# Author: Rodrigo Graca
+
+import Constants
+import Handshake
+import KeyPool
+import Protocol
+from Session import Connection
+from Constants import SocketCommands
+
+import logging
+import socket
+import select
+import time
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+
+logger = logging.getLogger('secure_talk.server')
+
+# server_addr = (internal_IP, 65532)
+
+
+class Server(Connection):
+
+    def __init__(self, server_addr=('', Constants.SERVER_PORT), recvTimeout=1, daemon=True):
+
+        super(Server, self).__init__("Client: ", recvTimeout=recvTimeout, daemon=daemon)
+
+        # TODO Find a use for this or get rid of
+        # Getting the external address of the network (Site may not always work), run self.lookupExternalIP() to enable
+        self.external_IP = 'Disabled'
+
+        # Server address to run on
+        self.server_addr = server_addr
+
+        # Seals the session tickets handed to clients, it never leaves this server
+        self.ticketKey = get_random_bytes(self.AES_KEY_LENGTH)
+
+        # Tickets are single use, a replayed resume is turned away
+        # Kept by the time they expire at the latest, in the order they were used, so old ones can be dropped
+        self.usedTickets = {}
+
+    def run(self):
+
+        self.addToDisplay(">>>RSA KEY LENGTH -> " + str(self.RSA_KEY_LENGTH) + " bytes<<<")
+        self.addToDisplay(">>>AES KEY LENGTH (EAX MODE) -> " + str(self.AES_KEY_LENGTH) + " bytes<<<")
+
+        # Setup socket for usage and bind to port
+        serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serversock.bind(self.server_addr)
+        # Port 0 lets the system pick, keep the one it chose so it can be handed to clients
+        self.server_addr = serversock.getsockname()
+
+        self.addToDisplay("Server on %s at Internal IP of: %s and External IP of: %s" % (
+            self.local_hostname, self.internal_IP, self.external_IP
+        ))
+
+        self.addToDisplay("Listening...")
+        # Wait for a connection
+        serversock.listen(1)
+
+        while self.running:
+            client, client_address = self.accept(serversock)
+            if client is None:
+                break
+
+            self.addToDisplay('----------------------------------')
+            self.addToDisplay('Servicing client: ' + client_address[0])
+
+            try:
+                client_aes_key, server_aes_key, resumed = self.handshake(client)
+
+            except (socket.error,) + Protocol.MALFORMED as e:
+                # One client dropping out or sending a bad hello or key shouldn't stop the server, wait for the next
+                self.addToDisplay('>>>Handshake failed, waiting for another client<<<')
+                logger.warning('Handshake with %s failed: %s', client_address[0], e)
+                self.metrics.count('handshake_failures')
+                client.close()
+                continue
+
+            self.startSession(client, server_aes_key, resumed)
+
+            # Hand out a fresh ticket every session so a dropped client can come back in one round trip
+            ticket, secret = Handshake.issue_ticket(self.ticketKey)
+            self.send_encrypted(client, server_aes_key, {'ticket': ticket.hex(), 'secret': secret.hex()},
+                                SocketCommands.TICKET)
+
+            dropped = self.beginCommunication(client, client_aes_key, server_aes_key)
+            client.close()
+
+            if dropped and self.running:
+                self.addToDisplay('>>>Client disconnected, waiting for it to reconnect<<<')
+            else:
+                self.exit()
+
+        serversock.close()
+        self.finish()
+
+    def accept(self, serversock):
+        # Poll for connections so exit() is noticed while no one is connecting
+        while self.running:
+            if select.select([serversock], [], [], self.RECV_TIMEOUT)[0]:
+                return serversock.accept()
+        return None, None
+
+    def recv_hello(self, client):
+        # Newer clients open with a hello, older ones say nothing and wait for our RSA key
+        if select.select([client], [], [], Constants.HELLO_WAIT)[0]:
+            return self.recv_from(client)
+        return None
+
+    def handshake(self, client):
+        # Returns (client_aes_key, server_aes_key, resumed)
+        hello = self.recv_hello(client)
+        start = time.perf_counter()
+
+        if Handshake.is_resume(hello):
+            keys = self.resume(client, hello)
+            self.observeSince('handshake_key_exchange_seconds', start)
+            if keys is not None:
+                self.addToDisplay("Session resumed!")
+                self.metrics.count('handshakes_resumed')
+                self.observeSince('handshake_seconds', start)
+                return keys + (True,)
+
+            # Turned away, the client follows up with a normal hello
+            self.addToDisplay("Ticket was not accepted, trading keys again")
+            hello = self.recv_hello(client)
+
+        if Handshake.is_hello(hello):
+            self.addToDisplay("Trading keys (X25519)...")
+            exchange = time.perf_counter()
+            client_aes_key, server_aes_key = self.setup_X25519(client, hello)
+            self.observeSince('handshake_key_exchange_seconds', exchange)
+            self.metrics.count('handshakes_x25519')
+        else:
+            self.addToDisplay('Getting RSA keys for connection')
+            # Keys come pre-generated from the pool, generating 4096 bit keys inline takes seconds
+            generation = time.perf_counter()
+            private_key = KeyPool.shared().take()
+            rsa_cipher = PKCS1_OAEP.new(private_key)
+            self.observeSince('handshake_rsa_key_seconds', generation)
+            self.addToDisplay('Keys and cipher created')
+
+            self.addToDisplay('Creating AES key for connection')
+            server_aes_key = get_random_bytes(self.AES_KEY_LENGTH)
+            self.addToDisplay('AES key created')
+
+            self.addToDisplay("Trading keys...")
+            exchange = time.perf_counter()
+            client_rsa_cipher, client_aes_key = self.setup_AES(client, private_key, rsa_cipher, server_aes_key)
+            self.observeSince('handshake_key_exchange_seconds', exchange)
+            self.metrics.count('handshakes_rsa')
+        self.addToDisplay("Keys traded!")
+
+        self.observeSince('handshake_seconds', start)
+        return client_aes_key, server_aes_key, False
+
+    def resume(self, client, hello):
+        # Derive the session keys from the secret in the client's ticket, None if the ticket is no good
+        client_random, ticket = Handshake.resume_fields(hello)
+
+        secret = Handshake.open_ticket(self.ticketKey, ticket)
+        if secret is None or ticket in self.usedTickets:
+            self.send_to(client, Handshake.RESUME_REJECTED)
+            return None
+        self.forgetTickets()
+        self.usedTickets[ticket] = time.time() + Constants.TICKET_LIFETIME
+
+        server_random = get_random_bytes(Handshake.RANDOM_LENGTH)
+        self.send_to(client, Handshake.resume(server_random))
+
+        return Handshake.resume_keys(secret, client_random, server_random)
+
+    def forgetTickets(self):
+        # An expired ticket is turned away by open_ticket anyway, it doesn't need remembering
+        now = time.time()
+        for ticket, expiry in list(self.usedTickets.items()):
+            if expiry > now:
+                break
+            del self.usedTickets[ticket]
+
+    def setup_AES(self, client, server_key, server_rsa_cipher, server_aes_key):
+        # Send server's public RSA key to client
+        self.send_to(client, server_key.publickey().export_key())
+
+        # Receive client's public key, we can now communicate without jeopardizing the AES keys
+        client_public = self.recv_from(client)
+        if client_public is None:
+            raise ValueError('Client left during the key trade')
+
+        # Setup public key RSA cipher to encrypt messages
+        client_key = RSA.import_key(client_public)
+        client_rsa_cipher = PKCS1_OAEP.new(client_key)
+
+        # Receive the client's AES key
+        sealed_key = self.recv_from(client)
+        if sealed_key is None:
+            raise ValueError('Client left during the key trade')
+        client_aes_key = server_rsa_cipher.decrypt(sealed_key)
+
+        # Send server's own AES key
+        self.send_to(client, client_rsa_cipher.encrypt(server_aes_key))
+
+        return client_rsa_cipher, client_aes_key
+
+    def setup_X25519(self, client, hello):
+        # Answer the client's hello with our own public key, both sides then derive the same keys
+        private_key, server_public = Handshake.generate()
+        self.send_to(client, Handshake.hello(server_public))
+
+        client_public = Handshake.hello_key(hello)
+        return Handshake.derive_keys(private_key, client_public, client_public, server_public)
@@ -0,0 +1,615 @@
+# Connection core shared by Server and Client, everything that happens once the keys are traded lives here
+# The roles only differ in how they find each other and trade keys
+
+import Constants
+import ExternalIP
+import File
+import Heartbeat
+import Metrics
+import Protocol
+import Transport
+from MessageQueue import MessageQueue
+from Constants import Channels, DisplayCommands, SocketCommands
+
+import logging
+import socket
+import threading
+import select
+import time
+
+logger = logging.getLogger('secure_talk.session')
+
+
+class Connection(threading.Thread):
+
+    # Backends, swap these on a subclass or an instance before start() to change how both roles
+    # frame, seal and queue messages. Each is called the same way as the default
+    Writer = Transport.FrameWriter  # Writer(sock), batches outgoing frames
+    Reader = Transport.FrameReader  # Reader(sock), parses incoming frames out of a reusable buffer
+    Cipher = Protocol.SessionCipher  # Cipher(aes_key), seals and opens messages and keeps the nonce counters
+    Queue = MessageQueue  # Queue(highWater=None), display and send queues shared with the GUI thread
+    Scheduler = Transport.Scheduler  # Scheduler(), decides which channel's messages go out next
+
+    def __init__(self, identifier, recvTimeout=1, daemon=True, wires=Protocol.SUPPORTED_WIRES, codecs=File.CODECS):
+
+        # Getting the local address of the computer in the network
+        super(Connection, self).__init__(daemon=daemon)
+        self.local_hostname = socket.gethostname()
+        self.internal_IP = socket.gethostbyname(self.local_hostname)
+
+        # Public IP, looked up in the background by lookupExternalIP() so constructing a connection never waits on it
+        self.external_IP = 'Unknown'
+        self.ipLookup = ExternalIP.shared()
+
+        # Controls if the thread is functioning, stopped is set along with it for anything waiting on a timer
+        self.running = True
+        self.stopped = threading.Event()
+
+        # Flag to transmit
+        self.readyToTransmit = False
+
+        # Program commands to run
+        self.commands = {SocketCommands.DISPLAY: self.displayText,
+                         SocketCommands.CAPABILITIES: self.setCapabilities,
+                         SocketCommands.FILE_SEND: self.handleFile,
+                         SocketCommands.FILE_ACCEPT: self.handleFile,
+                         SocketCommands.FILE_CHUNK: self.handleFile,
+                         SocketCommands.FILE_ACK: self.handleFile,
+                         SocketCommands.FILE_DECLINE: self.handleFile,
+                         SocketCommands.HEARTBEAT: self.handleHeartbeat,
+                         SocketCommands.GROUP_KEY: self.setGroupKey,
+                         SocketCommands.CREDIT: self.addCredit}
+
+        # File transfers in both directions, streamed in chunks alongside the chat
+        self.files = File.Transfers(self.addToDisplay, offered=self.fileOffered)
+
+        # Wire formats and codecs offered to the peer, leave one out to turn it off for this connection
+        self.wires = wires
+        self.codecs = codecs
+
+        # Wire format used for outgoing messages, upgraded once the peer advertises what it supports
+        self.wireFormat = Protocol.JSON_WIRE
+
+        # Compresses large messages and file chunks once the peer says which codecs it can decompress
+        self.compressor = None
+
+        # Session ciphers by AES key, they keep the message counters used as nonces
+        self.ciphers = {}
+
+        # What should be displayed as the peer's name in 'output'
+        self.identifier = identifier
+
+        # Conversation from a MessageLog, chat in both directions is kept there when one is set
+        self.log = None
+
+        # In Bytes
+        self.RSA_KEY_LENGTH = Constants.RSA_KEY_LENGTH
+        self.AES_KEY_LENGTH = Constants.AES_KEY_LENGTH
+
+        # How long to wait for a response from the peer before preforming other tasks
+        self.RECV_TIMEOUT = recvTimeout
+
+        # Seconds between pings and how long a silent peer is given before the connection counts as dropped
+        self.HEARTBEAT_INTERVAL = Constants.HEARTBEAT_INTERVAL
+        self.IDLE_TIMEOUT = Constants.IDLE_TIMEOUT
+
+        # Liveness and round trip time of the current session
+        self.heartbeat = Heartbeat.Heartbeat(self.HEARTBEAT_INTERVAL, self.IDLE_TIMEOUT)
+
+        # Write and read queues shared with the GUI thread, addToSend refuses new messages once send is full
+        self.received = self.Queue()  # Read
+        self.send = self.Queue(Constants.SEND_QUEUE_LIMIT)  # Write
+
+        # Other threads set this after queueing something so the network thread sends it without waiting out select
+        self.wakeup = Transport.Wakeup()
+
+        # Messages the peer may send before it has to wait for more credit, advertised with our capabilities
+        self.FLOW_WINDOW = Constants.FLOW_WINDOW
+
+        # Messages we may still send and messages the peer may still send us
+        # Both stay None for peers that don't advertise a window, they get everything as soon as it is queued
+        self.credit = None
+        self.peerCredit = None
+
+        # (data, command) pairs other threads want sent, like joining a room
+        self.control = self.Queue()
+
+        # Messages on their way out of the network thread, kept by channel so file data never holds up chat
+        self.outbox = self.Scheduler()
+
+        # Room this connection is in through a relay, chat is sealed once under the room's key and the relay fans it out
+        self.room = None
+        self.roomMembers = {}  # Names by member id
+        self.group = None
+
+        # Called with this connection whenever there is something new to display or it stops running
+        self.displayListener = None
+
+        # Called with (connection, transfer id, name, size) when the peer offers a file, answer it with answerFile
+        # Nothing is written to disk until then, without a listener offers wait until the connection ends
+        self.offerListener = None
+
+        # Coalesces outgoing frames once communication begins, the handshake writes directly
+        self.writer = None
+
+        # Reusable receive buffer that parses every frame from a read at once
+        self.reader = None
+
+        # Counters and timings for this connection, they only record once Metrics is enabled
+        self.metrics = Metrics.Metrics(type(self).__name__.lower())
+
+        # When the current session started, cleared once its first message arrives
+        self.sessionStarted = None
+
+    def lookupExternalIP(self):
+        # A cached answer is used right away, otherwise it is displayed once the lookup finishes
+        address = self.ipLookup.lookup(self.setExternalIP)
+        if address is not None:
+            self.external_IP = address
+
+    def setExternalIP(self, address):
+        if address is not None:
+            self.external_IP = address
+            self.addToDisplay("External IP of: %s" % address)
+
+    def observeSince(self, name, start):
+        # Record the seconds since a time.perf_counter() reading
+        self.metrics.observe(name, time.perf_counter() - start)
+
+    def capabilities(self):
+        return Protocol.capabilities(self.codecs, self.wires, self.FLOW_WINDOW)
+
+    def startSession(self, sock, send_aes_key, resumed=False):
+        # The peer may be a different program than last session, so start over on JSON until it advertises again
+        self.wireFormat = Protocol.JSON_WIRE
+        self.compressor = None
+        self.ciphers = {}
+        self.heartbeat = Heartbeat.Heartbeat(self.HEARTBEAT_INTERVAL, self.IDLE_TIMEOUT)
+        self.room = None
+        self.roomMembers = {}
+        self.group = None
+        self.credit = None
+        self.peerCredit = None
+        self.outbox = self.Scheduler()
+        self.sessionStarted = time.perf_counter()
+
+        # Tell the peer which wire formats we understand, older peers ignore unknown commands
+        self.send_encrypted(sock, send_aes_key, self.capabilities(), SocketCommands.CAPABILITIES)
+
+        # A resumed session carries on the same conversation and the file transfers in it
+        if resumed:
+            self.files.resume()
+        else:
+            self.addToDisplay(DisplayCommands.clearOutput)
+            self.files.abort()
+
+    def beginCommunication(self, sock, recv_aes_key, send_aes_key):
+        # Returns True if the peer went away, False if this side exited
+
+        self.readyToTransmit = True
+        self.writer = self.Writer(sock)
+        self.reader = self.Reader(sock)
+        Transport.limit_unsent(sock)
+        dropped = False
+
+        try:
+            # Wait however long the timeout is for a response in buffer
+            # Then continue executing code if none is found
+            while self.running:
+                # Wake up early if buffered frames or a ping are due to be written
+                timeout = self.RECV_TIMEOUT
+                for due in (self.writer.timeUntilDue(), self.heartbeat.timeUntilDue()):
+                    if due is not None:
+                        timeout = min(timeout, due)
+
+                # Chat left over from the last round goes right away, file data waits for the socket to have room
+                if self.outbox.waiting(paced=False):
+                    timeout = 0
+                ready, writable, _ = select.select([sock, self.wakeup], [sock] if self.outbox.waiting() else [], [],
+                                                   timeout)
+
+                # Cleared before the queues are drained below so anything queued from here on wakes us again
+                if self.wakeup in ready:
+                    self.wakeup.clear()
+
+                if sock in ready:
+                    self.heartbeat.received()
+
+                    if self.sessionStarted is not None:
+                        self.metrics.observe('handshake_first_message_seconds',
+                                             time.perf_counter() - self.sessionStarted)
+                        self.sessionStarted = None
+
+                    # One read can carry several messages
+                    for data in self.recv_encrypted_all(sock, recv_aes_key):
+
+                        if data == b'':
+                            dropped = True
+                            break
+
+                        command = data['command']
+                        self.metrics.count('messages_in')
+
+                        # TODO Add change username command
+                        # If the data refers to a command like 'change username' then execute that and don't display
+                        # A message that opened fine but isn't shaped like its command is skipped
+                        try:
+                            if command in self.commands:
+                                self.commands[command](sock, send_aes_key, data)
+                            else:
+                                self.unknownCommand(sock, send_aes_key, data)
+                        except (ValueError, KeyError, TypeError, AttributeError) as e:
+                            logger.warning('Skipped a malformed %s message: %s', command, e)
+                            self.metrics.count('malformed_messages')
+
+                    if dropped or not self.running:
+                        break
+
+                else:
+                    # print("No data")
+                    pass
+
+                # A half open connection never sends an EOF, silence is the only sign
+                if self.heartbeat.idle():
+                    self.addToDisplay('>>>No response from peer in %d seconds<<<' % self.IDLE_TIMEOUT)
+                    dropped = True
+                    break
+
+                ping = self.heartbeat.ping()
+                if ping is not None:
+                    self.send_encrypted(sock, send_aes_key, ping, SocketCommands.HEARTBEAT)
+
+                if self.metrics.enabled:
+                    self.metrics.observe('send_queue_depth', len(self.send), Metrics.COUNT_BUCKETS)
+                    self.metrics.observe('display_queue_depth', len(self.received), Metrics.COUNT_BUCKETS)
+
+                for data, command in self.control.drain():
+                    self.queueFrame(data, command)
+
+                # Chat only goes out while the peer has room for it, the rest waits in the queue
+                messages = self.send.drain(self.credit)
+                for msg in messages:
+                    self.outbox.put(Channels.CHAT, msg, SocketCommands.DISPLAY)
+
+                if self.credit is not None:
+                    self.credit -= len(messages)
+                    if not self.credit and len(self.send):
+                        self.metrics.count('flow_blocked')
+
+                self.grantCredit(sock, send_aes_key)
+
+                # Offer queued files and keep a window of chunks in flight
+                for data, command in self.files.pending():
+                    self.queueFrame(data, command)
+
+                # One round of the scheduler, everything it hands out goes out together
+                self.sendFrames(sock, send_aes_key, self.outbox.take(sock in writable))
+                self.writer.flushIfDue()
+
+        except Protocol.MALFORMED as e:
+            # Frames follow one another on the stream, once one is broken nothing after it can be trusted
+            # Checked first, nothing a hostile frame raises should pass for a network error
+            logger.warning('Malformed frame: %s', e)
+            self.addToDisplay('>>>Received a malformed message, closing the connection<<<')
+            self.metrics.count('malformed_frames')
+            dropped = True
+
+        except socket.error as e:
+            # A reset link counts the same as the peer closing it
+            logger.info('Connection error: %s', e)
+            self.metrics.count('connection_errors')
+            dropped = True
+
+        # Chat the scheduler still holds and frames batched in the writer go out before the socket is closed on exit
+        if not dropped:
+            try:
+                while self.outbox.waiting(paced=False):
+                    self.sendFrames(sock, send_aes_key, self.outbox.take(False))
+                self.writer.flush()
+            except socket.error as e:
+                logger.warning('Could not send what was left on exit: %s', e)
+                self.metrics.count('send_errors')
+
+        # Chat the scheduler never got to goes back in front of self.send, all of it waits for the next session
+        # Its credit was spent on this session, the next one counts it again against the new window
+        self.send.putBack(self.outbox.unsent(Channels.CHAT))
+        self.readyToTransmit = False
+        self.writer = None
+        self.reader = None
+        self.files.suspend()
+        return dropped
+
+    def queueFrame(self, data, command):
+        self.outbox.put(Constants.COMMAND_CHANNELS.get(command, Channels.CONTROL), data, command)
+
+    def sendFrames(self, sock, send_aes_key, frames):
+        # Sealed only now, in the order they leave, so the peer sees the message counters go up
+        for data, command in frames:
+            if command == SocketCommands.DISPLAY and self.group is not None:
+                self.send_group(sock, data, command)
+            else:
+                self.send_encrypted(sock, send_aes_key, data, command)
+
+    def unknownCommand(self, sock, send_aes_key, data):
+        # Commands from newer peers are ignored
+        pass
+
+    def grantCredit(self, sock, send_aes_key):
+        # Messages waiting to be displayed plus those the peer may still send never exceed the window
+        # Credit goes back in batches of at least half a window unless the display caught up completely
+        if self.peerCredit is None:
+            return
+
+        room = self.FLOW_WINDOW - len(self.received) - self.peerCredit
+        if room >= self.FLOW_WINDOW // 2 or (room > 0 and not len(self.received)):
+            self.send_encrypted(sock, send_aes_key, {'credit': room}, SocketCommands.CREDIT)
+            self.peerCredit += room
+
+    def addCredit(self, sock, send_aes_key, data):
+        credit = data['data'].get('credit')
+        if self.credit is not None and isinstance(credit, int) and credit > 0:
+            self.credit += credit
+
+    def addToDisplay(self, msg):
+        self.received.put(msg)
+        self.notifyDisplay()
+
+    def drainDisplay(self):
+        # Take everything waiting to be displayed in one go, the network thread may have credit to hand back now
+        messages = self.received.drain()
+        if self.peerCredit is not None and self.peerCredit < self.FLOW_WINDOW:
+            self.wakeup.set()
+        return messages
+
+    def notifyDisplay(self):
+        if self.displayListener:
+            self.displayListener(self)
+
+    def nextToDisplay(self):
+        msg = self.received.get()
+        if self.peerCredit is not None and self.peerCredit < self.FLOW_WINDOW:
+            self.wakeup.set()
+        return msg
+
+    def getRecvTotal(self):
+        return len(self.received)
+
+    def addToSend(self, msg):
+        # Never blocks, returns False when the send queue is full because the peer isn't keeping up
+        if not self.send.put(msg, timeout=0):
+            return False
+        self.wakeup.set()
+
+        if self.log is not None:
+            self.log.append('Me', msg)
+        return True
+
+    def nextToSend(self):
+        return self.send.get()
+
+    def getSendTotal(self):
+        return len(self.send)
+
+    def displayText(self, sock, send_aes_key, data):
+        # TODO Define different decoding like UTF-32
+
+        text = data['data']
+
+        # Room messages say which member sent them
+        if 'member' in data:
+            member = str(data['member'])
+            sender = self.roomMembers.get(member, 'Member ' + member)
+            self.addToDisplay(sender + ': ' + text)
+            if self.log is not None:
+                self.log.append(sender, text)
+            return
+
+        self.addToDisplay(self.identifier + text)
+        if self.log is not None:
+            self.log.append(self.identifier.rstrip(': '), text)
+
+        # Counted against the window we advertised, only peers that advertised one hold back for credit
+        if self.peerCredit is not None:
+            self.peerCredit -= 1
+
+    def joinRoom(self, room):
+        # Safe to call from any thread, the relay answers with the room's key
+        self.control.put(({'room': room}, SocketCommands.ROOM_JOIN))
+        self.wakeup.set()
+
+    def leaveRoom(self):
+        self.control.put(({'room': self.room}, SocketCommands.ROOM_LEAVE))
+        self.wakeup.set()
+
+    def setGroupKey(self, sock, send_aes_key, data):
+        # Sent by the relay whenever someone joins or leaves, the old key keeps working for messages in flight
+        # A key of None means we are no longer in the room
+        info = data['data']
+        if info['key'] is None:
+            self.addToDisplay('Left room %s' % self.room)
+            self.room = None
+            self.roomMembers = {}
+            self.group = None
+            return
+
+        if self.room != info['room']:
+            self.room = info['room']
+            self.roomMembers = {}
+            self.group = None
+            self.addToDisplay('Joined room %s' % self.room)
+
+        for member, name in info['joined'].items():
+            self.roomMembers[member] = name
+            if int(member) != info['member']:
+                self.addToDisplay('%s joined' % name)
+
+        for member in info['left']:
+            self.addToDisplay('%s left' % self.roomMembers.pop(member, 'Member ' + member))
+
+        self.group = Protocol.GroupCipher(bytes.fromhex(info['key']), info['epoch'], info['member'], self.group)
+
+    def setCapabilities(self, sock, send_aes_key, data):
+        # Switch to the best wire format and compression both sides support
+        self.wireFormat = Protocol.choose_wire(data['data'], self.wires)
+
+        codecs = Protocol.choose_codecs(data['data'], self.wires, self.codecs)
+        self.compressor = File.Compressor(codecs) if codecs else None
+
+        self.heartbeat.enabled = bool(data['data'].get('heartbeat'))
+
+        # The peer's window is how many messages we may send before waiting on credit, a peer that advertises
+        # one has ours too since capabilities are the first thing either side sends
+        window = data['data'].get('window')
+        if isinstance(window, int) and window > 0:
+            self.credit = window
+            self.peerCredit = self.FLOW_WINDOW
+        else:
+            self.credit = None
+            self.peerCredit = None
+
+    def handleHeartbeat(self, sock, send_aes_key, data):
+        reply = self.heartbeat.handle(data['data'])
+        if reply is not None:
+            self.send_encrypted(sock, send_aes_key, reply, SocketCommands.HEARTBEAT)
+
+    def latency(self):
+        # Smoothed round trip time to the peer in seconds, None until a ping has been answered
+        return self.heartbeat.srtt
+
+    def handleFile(self, sock, send_aes_key, data):
+        for reply, command in self.files.handle(data['command'], data['data']):
+            self.send_encrypted(sock, send_aes_key, reply, command)
+
+    def sendFile(self, filePath):
+        self.files.queue(filePath)
+        self.wakeup.set()
+
+    def fileOffered(self, transferId, name, size):
+        if self.offerListener:
+            self.offerListener(self, transferId, name, size)
+
+    def answerFile(self, transferId, accepted):
+        # Any thread, the reply goes out from the connection thread
+        self.files.answer(transferId, accepted)
+        self.wakeup.set()
+
+    def send_to(self, sock, data):
+        try:
+            # Length prefixed frames are batched by the writer once communication begins
+            if self.writer is not None:
+                self.writer.write(data)
+            else:
+                Transport.send_frame(sock, data)
+
+            if self.metrics.enabled:
+                self.metrics.count('bytes_out', Protocol.LENGTH_PREFIX.size + len(data))
+                self.metrics.observe('frame_bytes_out', len(data), Metrics.SIZE_BUCKETS)
+            return True
+        except Exception as e:
+            logger.warning('Send failed: %s', e)
+            self.metrics.count('send_errors')
+            return False
+
+    def recv_all(self, sock, len_bytes):
+        # Helper function to receive number bytes or return None if EOF is hit
+        return Transport.recv_exactly(sock, len_bytes)
+
+    def recv_from(self, sock):
+        # Read message length and unpack it into an integer
+        raw_data_len = self.recv_all(sock, 4)
+        if not raw_data_len:
+            return None
+        data_len = Protocol.frame_length(raw_data_len)
+        if data_len > Constants.MAX_FRAME_SIZE:
+            return None
+        # Read the message data
+        self.metrics.count('bytes_in', Protocol.LENGTH_PREFIX.size + data_len)
+        return self.recv_all(sock, data_len)
+
+    def recv_encrypted(self, sock, recv_aes_key):
+
+        formatted_data = self.recv_from(sock)
+
+        if formatted_data is None:
+            return b''
+
+        return self.cipher(recv_aes_key).unseal(formatted_data)
+
+    def recv_encrypted_all(self, sock, recv_aes_key):
+        # Every message from one read, decrypted straight out of the receive buffer. b'' means the peer closed
+        frames = self.reader.read()
+        if frames is None:
+            return [b'']
+
+        cipher = self.cipher(recv_aes_key)
+        measuring = self.metrics.enabled
+        messages = []
+        for formatted_data in frames:
+            if measuring:
+                start = time.perf_counter()
+
+            message = self.unseal(cipher, formatted_data)
+
+            if measuring:
+                self.metrics.observe('unseal_seconds', time.perf_counter() - start)
+                self.metrics.observe('frame_bytes_in', len(formatted_data), Metrics.SIZE_BUCKETS)
+                self.metrics.count('bytes_in', Protocol.LENGTH_PREFIX.size + len(formatted_data))
+
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def unseal(self, cipher, formatted_data):
+        if not Protocol.is_group(formatted_data):
+            return cipher.unseal(formatted_data)
+
+        if self.group is None:
+            return None
+
+        # Any member can send to the room, one bad message shouldn't take this connection down
+        try:
+            return self.group.unseal(formatted_data)
+        except ValueError as e:
+            logger.warning('Rejected a group message: %s', e)
+            self.metrics.count('group_messages_rejected')
+            return None
+
+    def send_encrypted(self, sock, send_aes_key, data, command: SocketCommands):
+
+        # Seal the message, send to the peer and return success
+        if not self.metrics.enabled:
+            return self.send_to(sock, self.cipher(send_aes_key).seal(data, command, self.wireFormat, self.compressor))
+
+        start = time.perf_counter()
+        formatted_data = self.cipher(send_aes_key).seal(data, command, self.wireFormat, self.compressor)
+        self.metrics.observe('seal_seconds', time.perf_counter() - start)
+        return self.send_to(sock, formatted_data)
+
+    def send_group(self, sock, data, command: SocketCommands):
+        # Sealed once under the room's key, the relay hands the same bytes to every member
+        if not self.metrics.enabled:
+            return self.send_to(sock, self.group.seal(data, command))
+
+        start = time.perf_counter()
+        formatted_data = self.group.seal(data, command)
+        self.metrics.observe('group_seal_seconds', time.perf_counter() - start)
+        return self.send_to(sock, formatted_data)
+
+    def cipher(self, aes_key):
+        if aes_key not in self.ciphers:
+            self.ciphers[aes_key] = self.Cipher(aes_key)
+        return self.ciphers[aes_key]
+
+    def exit(self):
+        self.running = False
+        self.stopped.set()
+        self.wakeup.set()
+        self.notifyDisplay()
+
+    def finish(self):
+        # Called once at the end of run, no session follows so what was kept for one is let go
+        self.files.abort()
+        self.wakeup.close()
+
+    def isRunning(self):
+        return self.running
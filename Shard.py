@@ -0,0 +1,411 @@
+# Runs the relay as several processes so handshakes and message crypto spread over every core
+# Workers share the port with SO_REUSEPORT, or accept from one listening socket handed to all of them where the
+# kernel doesn't balance SO_REUSEPORT. Peers on different workers are paired and share rooms over socket pairs
+# between the workers, messages cross as plain (data, command) and are sealed again by the worker that owns the peer
+
+import Constants
+import KeyPool
+import Protocol
+from Constants import SocketCommands
+from Relay import Relay
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import sys
+import time
+import zlib
+
+# Worker that keeps the one waiting slot every worker pairs through
+COORDINATOR = 0
+
+# Only Linux and FreeBSD spread connections over sockets sharing a port, elsewhere the last one bound gets them all
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT') and sys.platform.startswith(('linux', 'freebsd'))
+
+
+class RemotePeer:
+    # Stands in for a connection on another worker, anything sent to it goes over the link to that worker
+
+    __slots__ = ('worker', 'id', 'address', 'writer', 'partner', 'room', 'member')
+
+    def __init__(self, worker, id, address, writer, partner=None):
+        self.worker = worker
+        self.id = id
+        self.address = address
+
+        # The link to the peer's worker, draining it is the backpressure on whoever sends to this peer
+        self.writer = writer
+
+        # Our connection it is paired with, None when it only stands in for a room member
+        self.partner = partner
+
+        self.room = None
+        self.member = None
+
+
+class RemoteRoom:
+    # A room kept by another worker, the home worker checks senders and hands out the group key
+
+    __slots__ = ('name', 'home')
+
+    def __init__(self, name, home):
+        self.name = name
+        self.home = home
+
+
+class ShardRelay(Relay):
+
+    def __init__(self, index, links, listener=None, server_addr=('', Constants.SERVER_PORT), keys=None, **settings):
+        super(ShardRelay, self).__init__(server_addr, keys, **settings)
+
+        # This worker's number and connected sockets to every other worker by number
+        self.index = index
+        self.count = len(links) + 1
+        self.linkSockets = links
+        self.links = {}  # Stream writers once started
+
+        # Listening socket shared by every worker, None when each binds its own with SO_REUSEPORT
+        self.listener = listener
+
+        # Our connections by id, ids are only unique within a worker
+        self.ids = itertools.count()
+        self.byId = {}
+
+        # Members of rooms kept here whose connections live on other workers, by (worker, id)
+        self.remotes = {}
+
+        # Coordinator only, (worker, id) of the peer waiting for a partner
+        self.waitingPeer = None
+
+        self.routes = {'wait': self.onWait,
+                       'cancel': self.onCancel,
+                       'paired': self.onPaired,
+                       'unpaired': self.onUnpaired,
+                       'deliver': self.onDeliver,
+                       'join': self.onJoin,
+                       'leave': self.onLeave,
+                       'group': self.onGroup,
+                       'fanout': self.onFanout}
+
+    async def start(self):
+        for worker, sock in self.linkSockets.items():
+            reader, self.links[worker] = await asyncio.open_connection(sock=sock)
+            asyncio.ensure_future(self.readLink(worker, reader))
+        return await super(ShardRelay, self).start()
+
+    async def listen(self):
+        if self.listener is not None:
+            return await asyncio.start_server(self.handle, sock=self.listener, limit=Constants.RELAY_BUFFER_LIMIT)
+
+        host, port = self.server_addr
+        return await asyncio.start_server(self.handle, host or None, port, reuse_port=True,
+                                          limit=Constants.RELAY_BUFFER_LIMIT, backlog=Constants.RELAY_BACKLOG)
+
+    async def shutdown(self, timeout=Constants.DRAIN_TIMEOUT):
+        closed = await super(ShardRelay, self).shutdown(timeout)
+        for writer in self.links.values():
+            writer.close()
+        return closed
+
+    async def run(self, drainTimeout=Constants.DRAIN_TIMEOUT):
+        # Serve until SIGTERM, the supervisor passes on Ctrl+C as SIGTERM so workers ignore SIGINT themselves
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: loop.call_soon_threadsafe(stopping.set))
+
+        await self.start()
+        await stopping.wait()
+        await self.shutdown(drainTimeout)
+
+    def post(self, worker, message):
+        # Messages to ourselves go through the event loop too so both cases happen in the same order
+        if worker == self.index:
+            asyncio.get_running_loop().call_soon(self.receive, message)
+            return
+
+        writer = self.links.get(worker)
+        if writer is not None and not writer.is_closing():
+            writer.write(Protocol.frame(pickle.dumps(message, pickle.HIGHEST_PROTOCOL)))
+
+    def receive(self, message):
+        self.routes[message[0]](*message[1:])
+
+    async def readLink(self, worker, reader):
+        try:
+            while True:
+                length = Protocol.frame_length(await reader.readexactly(Protocol.LENGTH_PREFIX.size))
+                self.receive(pickle.loads(await reader.readexactly(length)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.lost(worker)
+
+    def lost(self, worker):
+        # A worker went away, whoever was talking through it carries on without it
+        for conn in list(self.connections):
+            partner = conn.partner
+            if isinstance(partner, RemotePeer) and partner.worker == worker:
+                self.onUnpaired(conn.id, worker, partner.id)
+
+            room = conn.room
+            if isinstance(room, RemoteRoom) and room.home == worker:
+                conn.room = None
+                self.send_encrypted(conn, {'room': room.name, 'key': None}, SocketCommands.GROUP_KEY)
+                self.pair(conn)
+
+        for worker_id in [worker_id for worker_id in self.remotes if worker_id[0] == worker]:
+            self.onLeave(*worker_id)
+
+    def key(self, conn):
+        # (worker, id) of a connection wherever it lives
+        if isinstance(conn, RemotePeer):
+            return conn.worker, conn.id
+        return self.index, conn.id
+
+    def home(self, name):
+        # Every worker agrees on where a room lives without asking, hash() is salted differently per process
+        return zlib.crc32(name.encode()) % self.count
+
+    def pair(self, conn):
+        # Every worker pairs through the coordinator so two peers waiting on different workers still find each other
+        if conn.id is None:
+            conn.id = next(self.ids)
+            self.byId[conn.id] = conn
+
+        self.send_encrypted(conn, 'Waiting for someone to connect...', SocketCommands.DISPLAY)
+        self.post(COORDINATOR, ('wait', self.index, conn.id))
+
+    def onWait(self, worker, id):
+        if self.waitingPeer is None or self.waitingPeer == (worker, id):
+            self.waitingPeer = (worker, id)
+            return
+
+        partnerWorker, partnerId = self.waitingPeer
+        self.waitingPeer = None
+
+        # Only one side hears from us, it tells the other once it is ready so neither can send into the void
+        self.post(partnerWorker, ('paired', partnerId, worker, id, True))
+
+    def onCancel(self, worker, id):
+        if self.waitingPeer == (worker, id):
+            self.waitingPeer = None
+
+    def onPaired(self, id, partnerWorker, partnerId, first):
+        conn = self.byId.get(id)
+
+        # Gone or off in a room since it asked to be paired
+        if conn is None or conn.partner is not None or conn.room is not None:
+            if first:
+                # The other side was never told, it simply goes back to waiting
+                self.post(COORDINATOR, ('wait', partnerWorker, partnerId))
+            else:
+                self.post(partnerWorker, ('unpaired', partnerId, self.index, id))
+            return
+
+        if partnerWorker == self.index:
+            partner = self.byId.get(partnerId)
+            if partner is None or partner.partner is not None or partner.room is not None:
+                self.post(COORDINATOR, ('wait', self.index, id))
+                return
+
+            conn.partner = partner
+            partner.partner = conn
+            self.send_encrypted(partner, 'Connected to a peer through the relay', SocketCommands.DISPLAY)
+        else:
+            conn.partner = RemotePeer(partnerWorker, partnerId, None, self.links[partnerWorker], conn)
+            if first:
+                self.post(partnerWorker, ('paired', partnerId, self.index, id, False))
+
+        self.send_encrypted(conn, 'Connected to a peer through the relay', SocketCommands.DISPLAY)
+
+    def onUnpaired(self, id, fromWorker, fromId):
+        # Only acted on if it comes from the current partner, anything older is stale
+        conn = self.byId.get(id)
+        if conn is None or conn.partner is None or self.key(conn.partner) != (fromWorker, fromId):
+            return
+
+        conn.partner = None
+        self.send_encrypted(conn, 'Peer disconnected', SocketCommands.DISPLAY)
+        self.pair(conn)
+
+    def unpair(self, conn):
+        # Stand-ins for room members are never paired, and connections that didn't finish the handshake never asked
+        if isinstance(conn, RemotePeer) or conn.id is None:
+            return
+
+        partner = conn.partner
+        if partner is None:
+            self.post(COORDINATOR, ('cancel', self.index, conn.id))
+            return
+
+        if isinstance(partner, RemotePeer):
+            conn.partner = None
+            self.post(partner.worker, ('unpaired', partner.id, self.index, conn.id))
+            return
+
+        super(ShardRelay, self).unpair(conn)
+
+    def drop(self, conn):
+        super(ShardRelay, self).drop(conn)
+        self.byId.pop(conn.id, None)
+
+    def send_encrypted(self, conn, data, command: SocketCommands):
+        if not isinstance(conn, RemotePeer):
+            return super(ShardRelay, self).send_encrypted(conn, data, command)
+
+        # Sealed by the worker that has the peer's keys. Messages from a partner say who sent them
+        # so one that arrives after the pairing ended is turned away, messages from the relay itself never are
+        sender = conn.partner.id if conn.partner is not None else None
+        self.post(conn.worker, ('deliver', conn.id, self.index, sender, data, command))
+
+    def onDeliver(self, id, fromWorker, fromId, data, command):
+        conn = self.byId.get(id)
+        if conn is None:
+            return
+
+        if fromId is not None and (conn.partner is None or self.key(conn.partner) != (fromWorker, fromId)):
+            self.post(fromWorker, ('unpaired', fromId, self.index, id))
+            return
+
+        super(ShardRelay, self).send_encrypted(conn, data, command)
+
+    def join(self, conn, name):
+        home = self.home(name)
+        if home == self.index:
+            return super(ShardRelay, self).join(conn, name)
+
+        self.leave(conn)
+        self.unpair(conn)
+        conn.room = RemoteRoom(name, home)
+        self.post(home, ('join', self.index, conn.id, conn.address, name))
+
+    def leave(self, conn):
+        room = conn.room
+        if isinstance(room, RemoteRoom):
+            conn.room = None
+            self.post(room.home, ('leave', self.index, conn.id))
+            return
+
+        super(ShardRelay, self).leave(conn)
+
+    def onJoin(self, worker, id, address, name):
+        peer = self.remotes.get((worker, id))
+        if peer is None:
+            peer = self.remotes[(worker, id)] = RemotePeer(worker, id, address, self.links[worker])
+
+        super(ShardRelay, self).join(peer, name)
+
+    def onLeave(self, worker, id):
+        peer = self.remotes.pop((worker, id), None)
+        if peer is not None:
+            super(ShardRelay, self).leave(peer)
+
+    async def broadcast(self, conn, formatted_data):
+        room = conn.room
+        if isinstance(room, RemoteRoom):
+            self.post(room.home, ('group', self.index, conn.id, bytes(formatted_data)))
+            await self.links[room.home].drain()
+            return
+
+        await super(ShardRelay, self).broadcast(conn, formatted_data)
+
+    def onGroup(self, worker, id, formatted_data):
+        peer = self.remotes.get((worker, id))
+        if peer is not None:
+            asyncio.ensure_future(self.broadcast(peer, formatted_data))
+
+    async def fanout(self, conn, members, formatted_data):
+        # Each worker with members gets the frame once and writes it to its own
+        local = []
+        remote = {}
+        for peer in members:
+            if isinstance(peer, RemotePeer):
+                if peer is not conn:
+                    remote.setdefault(peer.worker, []).append(peer.id)
+            else:
+                local.append(peer)
+
+        for worker, ids in remote.items():
+            self.post(worker, ('fanout', ids, formatted_data))
+
+        await super(ShardRelay, self).fanout(conn, local, formatted_data)
+
+    def onFanout(self, ids, formatted_data):
+        members = [self.byId[id] for id in ids if id in self.byId]
+        asyncio.ensure_future(self.fanout(None, members, formatted_data))
+
+
+def work(index, links, listener, server_addr, keyLength, poolSize, keyWorkers, drainTimeout):
+    # Runs in each worker process
+    size = max(poolSize, 2)
+    keys = KeyPool.KeyPool(key_length=keyLength, size=size, watermark=size // 2, workers=keyWorkers)
+    relay = ShardRelay(index, links, listener, server_addr, keys)
+    asyncio.run(relay.run(drainTimeout))
+
+
+class Shards:
+    # Starts and stops the worker processes, the process running this only supervises
+
+    def __init__(self, server_addr=('', Constants.SERVER_PORT), workers=None, keyLength=Constants.RSA_KEY_LENGTH,
+                 poolSize=None, keyWorkers=1, drainTimeout=Constants.DRAIN_TIMEOUT):
+        self.server_addr = server_addr
+        self.workers = workers or os.cpu_count() or 1
+        self.keyLength = keyLength
+
+        # Keys kept ready by each worker, the relay's pool is split between them unless told otherwise
+        self.poolSize = poolSize or Constants.RELAY_KEY_POOL_SIZE // self.workers
+        self.keyWorkers = keyWorkers
+        self.drainTimeout = drainTimeout
+
+        self.processes = []
+
+    def start(self):
+        # One socket pair between every two workers
+        links = [{} for _ in range(self.workers)]
+        for i, j in itertools.combinations(range(self.workers), 2):
+            links[i][j], links[j][i] = socket.socketpair()
+
+        listener = None
+        if not REUSE_PORT:
+            host, port = self.server_addr
+            listener = socket.create_server((host, port), backlog=Constants.RELAY_BACKLOG)
+
+        for index in range(self.workers):
+            process = multiprocessing.Process(target=work, name='relay-%d' % index,
+                                              args=(index, links[index], listener, self.server_addr, self.keyLength,
+                                                    self.poolSize, self.keyWorkers, self.drainTimeout))
+            process.start()
+            self.processes.append(process)
+
+        # The workers have their own copies now
+        for sockets in links:
+            for sock in sockets.values():
+                sock.close()
+        if listener is not None:
+            listener.close()
+        return self
+
+    def alive(self):
+        return all(process.is_alive() for process in self.processes)
+
+    def pids(self):
+        return [process.pid for process in self.processes]
+
+    def stop(self):
+        # SIGTERM, each worker drains its own connections
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    def join(self, timeout=None):
+        # Wait for every worker, anything still running after timeout seconds is killed
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for process in self.processes:
+            process.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
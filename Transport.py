@@ -0,0 +1,350 @@
+# Socket level helpers shared by Server and Client for getting frames on and off the wire efficiently
+
+import Constants
+import Protocol
+from Constants import Channels
+
+import errno
+import os
+import select
+import socket
+import time
+
+from collections import deque
+
+# Most systems cap how many buffers one sendmsg call can take
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# A non-blocking connect that is still under way reports one of these
+CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, getattr(errno, 'WSAEWOULDBLOCK', 10035)}
+
+# How often a connection race checks whether it was cancelled (Seconds)
+CANCEL_POLL = .1
+
+
+class FrameWriter:
+    # Collects outgoing frames and writes them with as few syscalls as possible
+    # Frames are flushed once flushSize bytes are pending or the oldest has waited flushDelay seconds
+
+    def __init__(self, sock, flushSize=Constants.WRITE_FLUSH_SIZE, flushDelay=Constants.WRITE_FLUSH_DELAY):
+        self.sock = sock
+        self.flushSize = flushSize
+        self.flushDelay = flushDelay
+
+        # Length prefixes and payloads are kept as separate buffers so nothing is copied before the write
+        self.buffers = []
+        self.pending = 0
+        self.oldest = None
+
+    def write(self, data):
+        if not self.buffers:
+            self.oldest = time.monotonic()
+
+        self.buffers.append(Protocol.LENGTH_PREFIX.pack(len(data)))
+        self.buffers.append(data)
+        self.pending += Protocol.LENGTH_PREFIX.size + len(data)
+
+        if self.pending >= self.flushSize:
+            self.flush()
+
+    def timeUntilDue(self):
+        # Seconds until pending frames have to go out, None when nothing is pending
+        if not self.buffers:
+            return None
+        return max(self.oldest + self.flushDelay - time.monotonic(), 0)
+
+    def flushIfDue(self):
+        if self.buffers and self.timeUntilDue() == 0:
+            self.flush()
+
+    def flush(self):
+        buffers = self.buffers
+        self.buffers = []
+        self.pending = 0
+        self.oldest = None
+
+        if not buffers:
+            return
+
+        if hasattr(self.sock, 'sendmsg'):
+            self.sendBuffers(buffers)
+        else:
+            # No scatter/gather write on this platform, one join is still a single syscall
+            self.sock.sendall(b''.join(buffers))
+
+    def sendBuffers(self, buffers):
+        # sendmsg may write only part of the data, keep going from wherever it stopped
+        buffers = [memoryview(buffer) for buffer in buffers]
+        start = 0
+        while start < len(buffers):
+            sent = self.sock.sendmsg(buffers[start:start + IOV_MAX])
+
+            while start < len(buffers) and sent >= len(buffers[start]):
+                sent -= len(buffers[start])
+                start += 1
+
+            if sent:
+                buffers[start] = buffers[start][sent:]
+
+
+class FrameReader:
+    # Receives into one reusable buffer and hands out complete frames as memoryview slices of it
+    # A single recv can yield several frames, nothing is copied unless a partial frame has to be moved
+
+    def __init__(self, sock, bufferSize=Constants.READ_BUFFER_SIZE, maxFrameSize=Constants.MAX_FRAME_SIZE):
+        self.sock = sock
+        self.bufferSize = bufferSize
+        self.maxFrameSize = maxFrameSize
+
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+
+        # Unread data lives in buffer[start:end], needed is the size of the frame at start once its prefix is in
+        self.start = 0
+        self.end = 0
+        self.needed = Protocol.LENGTH_PREFIX.size
+
+    def read(self):
+        # Returns the complete frames from one recv, or None once the peer closes
+        # The frames point into the buffer so they are only valid until the next read
+        self.makeRoom()
+
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            return None
+
+        self.end += received
+        return self.frames()
+
+    def frames(self):
+        prefix = Protocol.LENGTH_PREFIX.size
+        frames = []
+
+        while self.end - self.start >= prefix:
+            length = Protocol.LENGTH_PREFIX.unpack_from(self.buffer, self.start)[0]
+            if length > self.maxFrameSize:
+                raise ValueError('Frame of %d bytes is over the limit' % length)
+
+            if self.end - self.start < prefix + length:
+                self.needed = prefix + length
+                return frames
+
+            frames.append(self.view[self.start + prefix:self.start + prefix + length])
+            self.start += prefix + length
+
+        self.needed = prefix
+        return frames
+
+    def makeRoom(self):
+        pending = self.end - self.start
+
+        if pending == 0:
+            # Give back memory from an unusually large frame once it has been handled
+            if len(self.buffer) > self.bufferSize * 4:
+                self.buffer = bytearray(self.bufferSize)
+                self.view = memoryview(self.buffer)
+            self.start = self.end = 0
+
+        elif self.needed > len(self.buffer) - self.start:
+            # The frame being read won't fit where it is, move it to the front and grow if even that isn't enough
+            if self.needed > len(self.buffer):
+                buffer = bytearray(max(self.needed, len(self.buffer) * 2))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+
+
+class Wakeup:
+    # Self-pipe for waking a thread blocked in select, other threads call set() after queueing work
+    # Only the first set() before the next clear() writes, so a burst of messages costs one byte
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.pending = False
+
+    def fileno(self):
+        # Lets select() wait on this directly
+        return self.reader.fileno()
+
+    def set(self):
+        if not self.pending:
+            self.pending = True
+            try:
+                self.writer.send(b'\0')
+            except OSError:
+                # Full or closed, either way select will already see it as readable
+                pass
+
+    def clear(self):
+        # Read first and clear the flag after, a byte written in between would be read here and the flag left set
+        # with nothing to wake select. A set() before the flag is cleared writes nothing, but the caller drains
+        # its queues after this so whatever it queued is still picked up
+        try:
+            while self.reader.recv(4096):
+                pass
+        except OSError:
+            pass
+        self.pending = False
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+class Scheduler:
+    # Outgoing messages queued by channel and handed out in deficit round robin order, a channel may send its
+    # weight times quantum bytes each round so a busy one can't crowd out the rest. Channels weighted None go first
+    # Paced channels only go while the socket has room, so they never pile up in it ahead of everything else
+    # Messages are queued before they are sealed, the nonce counters on the wire stay in order whatever leaves first
+
+    def __init__(self, weights=Constants.CHANNEL_WEIGHTS, quantum=Constants.CHANNEL_QUANTUM, paced=(Channels.BULK,)):
+        self.weights = weights
+        self.quantum = quantum
+        self.paced = set(paced)
+
+        # (data, command, size) per channel, checked in the order weights lists them
+        self.queues = {channel: deque() for channel in weights}
+        self.deficits = dict.fromkeys(weights, 0)
+
+    def put(self, channel, data, command):
+        size = len(data) if isinstance(data, (bytes, bytearray, memoryview, str)) else 0
+        self.queues[channel].append((data, command, size))
+
+    def waiting(self, paced=True):
+        # Whether anything is queued, leaving out paced channels unless asked
+        return any(queue and (paced or channel not in self.paced) for channel, queue in self.queues.items())
+
+    def take(self, writable=True):
+        # One round, returns the (data, command) pairs to send in order
+        taken = []
+        for channel, queue in self.queues.items():
+            if not queue or (channel in self.paced and not writable):
+                continue
+
+            weight = self.weights[channel]
+            if weight is None:
+                taken.extend((data, command) for data, command, _ in queue)
+                queue.clear()
+                continue
+
+            # Whatever a channel doesn't use carries over while it has a message too large for one round
+            self.deficits[channel] += weight * self.quantum
+            while queue and queue[0][2] <= self.deficits[channel]:
+                data, command, size = queue.popleft()
+                self.deficits[channel] -= size
+                taken.append((data, command))
+
+            if not queue:
+                self.deficits[channel] = 0
+
+        return taken
+
+    def unsent(self, channel):
+        # Takes back what is still queued on one channel, oldest first
+        queue = self.queues[channel]
+        data = [data for data, _, _ in queue]
+        queue.clear()
+        self.deficits[channel] = 0
+        return data
+
+
+def limit_unsent(sock, size=Constants.SEND_LOWAT):
+    # Select reports the socket writable only while less than size bytes are waiting unsent, so paced data
+    # never fills the kernel's buffer ahead of chat. Not every platform has the option, those just buffer more
+    if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, size)
+        except OSError:
+            pass
+
+
+def recv_exactly(sock, length):
+    # Receive exactly length bytes into one preallocated buffer, returns None if EOF is hit first
+    data = bytearray(length)
+    view = memoryview(data)
+    received = 0
+    while received < length:
+        packet = sock.recv_into(view[received:])
+        if not packet:
+            return None
+        received += packet
+    return bytes(data)
+
+
+def send_frame(sock, data):
+    # Write a single frame right away, sendall retries partial writes until everything is sent
+    sock.sendall(Protocol.frame(data))
+
+
+def resolve(host, port):
+    # Every address for host as (family, type, proto, address), alternating families so IPv6 and IPv4
+    # both get tried early. The resolver's first answer stays at the front
+    families = {}
+    for family, sock_type, proto, _, address in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        families.setdefault(family, []).append((family, sock_type, proto, address))
+
+    groups = list(families.values())
+    addresses = []
+    for i in range(max((len(group) for group in groups), default=0)):
+        for group in groups:
+            if i < len(group):
+                addresses.append(group[i])
+    return addresses
+
+
+def happy_eyeballs(addresses, stagger=Constants.CONNECT_STAGGER, timeout=Constants.CONNECT_TIMEOUT, cancelled=None):
+    # Race connections to every address, starting the next one after stagger seconds or as soon as one fails
+    # Returns the first socket to connect, or None once every attempt failed, timed out or cancelled() is true
+    addresses = list(addresses)
+    attempts = {}
+    winner = None
+
+    deadline = time.monotonic() + timeout
+    nextStart = time.monotonic()
+
+    try:
+        while winner is None and (addresses or attempts):
+            now = time.monotonic()
+            if now >= deadline or (cancelled is not None and cancelled()):
+                break
+
+            if addresses and (now >= nextStart or not attempts):
+                family, sock_type, proto, address = addresses.pop(0)
+                sock = socket.socket(family, sock_type, proto)
+                sock.setblocking(False)
+
+                if sock.connect_ex(address) in CONNECT_IN_PROGRESS | {0}:
+                    attempts[sock] = address
+                else:
+                    sock.close()
+                nextStart = now + stagger
+                continue
+
+            wait = min(deadline, nextStart) if addresses else deadline
+            _, writable, failed = select.select([], list(attempts), list(attempts),
+                                                max(min(wait - now, CANCEL_POLL), 0))
+
+            for sock in set(writable + failed):
+                del attempts[sock]
+                if winner is None and sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    winner = sock
+                else:
+                    # Refused or unreachable, give the next address a go right away
+                    sock.close()
+                    nextStart = now
+
+    finally:
+        for sock in attempts:
+            sock.close()
+
+    if winner is not None:
+        winner.setblocking(True)
+    return winner